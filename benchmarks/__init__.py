@@ -0,0 +1,25 @@
+"""Medições de desempenho (não fazem parte da suíte de testes).
+
+Cada módulo roda com `python -m benchmarks.<modulo> --help` a partir da raiz
+do repositório e usa um banco SQLite temporário, nunca o DATABASE_URL do
+ambiente.
+"""
+import os
+import tempfile
+
+
+def configurar_ambiente(**extras):
+    """Prepara as variáveis de ambiente antes de importar a aplicação.
+
+    Banco SQLite descartável, cache desligado, credenciais fictícias do
+    Mainô e jobs fora da web; `extras` sobrescrevem qualquer uma delas.
+    """
+    diretorio = tempfile.mkdtemp(prefix="consignacoes-benchmark-")
+    os.environ.update({
+        "DATABASE_URL": f"sqlite:///{os.path.join(diretorio, 'benchmark.db')}",
+        "CACHE_BACKEND": "nenhum",
+        "MAINO_API_KEY": "benchmark",
+        "JOBS_EXECUTAR_NA_WEB": "false",
+        **extras
+    })
+    return diretorio
@@ -0,0 +1,124 @@
+"""Teste de carga de /resumo e /saldo-produto no servidor de desenvolvimento e no gunicorn.
+
+Grava um banco SQLite de exemplo, sobe cada servidor como subprocesso
+(`python src/main.py` e `gunicorn -c gunicorn.conf.py src.main:app`) e
+dispara requisições de vários clientes em paralelo, cada um com a própria
+sessão keep-alive. A saída mostra requisições por segundo e as latências
+p50/p95 por rota. Um servidor que não estiver instalado é pulado.
+
+    python -m benchmarks.carga --clientes 16 --requisicoes 2000 --servidores werkzeug gunicorn
+"""
+import argparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from benchmarks import configurar_ambiente
+from tests.exemplos import chave, xml_nfe
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMANDOS = {
+    "werkzeug": [sys.executable, "src/main.py"],
+    "gunicorn": ["gunicorn", "-c", "gunicorn.conf.py", "src.main:app"],
+}
+
+
+def popular_banco(notas, itens_por_nota):
+    # Remessas do mesmo produto para alguns destinatários: /saldo-produto devolve uma página cheia
+    from src.main import app, inicializar_banco
+    from src.services.estoque_service import EstoqueService
+    from src.services.xml_processor import XMLProcessor
+    inicializar_banco()
+    processor = XMLProcessor()
+    documentos = []
+    for numero in range(1, notas + 1):
+        itens = [("P1" if item == 0 else f"P{item}", f"L{numero}", "10") for item in range(itens_por_nota)]
+        resultado = processor.parse_nfe_xml(xml_nfe(chave(numero), str(numero), "5917", itens,
+                                                    cnpj_destinatario=str(11222333000100 + numero % 50)))
+        documentos.append((resultado["dados_nfe"], resultado["tipo_operacao"]))
+    with app.app_context():
+        EstoqueService().processar_lote(documentos)
+
+
+def porta_livre():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def aguardar(url, processo, limite=60):
+    fim = time.monotonic() + limite
+    while time.monotonic() < fim:
+        if processo.poll() is not None:
+            raise RuntimeError(f"O servidor terminou com código {processo.returncode}")
+        try:
+            if requests.get(url, timeout=1).ok:
+                return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} não respondeu em {limite}s")
+
+
+def carga(url, clientes, total):
+    local = threading.local()
+
+    def requisitar(_):
+        # Uma sessão por thread do pool, reaproveitada entre as requisições
+        if not hasattr(local, "sessao"):
+            local.sessao = requests.Session()
+        sessao = local.sessao
+        inicio = time.perf_counter()
+        resposta = sessao.get(url, timeout=30)
+        resposta.raise_for_status()
+        return time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clientes) as executor:
+        latencias = sorted(executor.map(requisitar, range(total)))
+    duracao = time.perf_counter() - inicio
+    return total / duracao, latencias[len(latencias) // 2], latencias[int(len(latencias) * 0.95)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clientes", type=int, default=16, help="requisições simultâneas")
+    parser.add_argument("--requisicoes", type=int, default=2000, help="requisições por rota")
+    parser.add_argument("--servidores", nargs="+", default=list(COMANDOS), choices=list(COMANDOS))
+    parser.add_argument("--notas", type=int, default=300)
+    parser.add_argument("--itens", type=int, default=5)
+    argumentos = parser.parse_args()
+
+    configurar_ambiente()
+    popular_banco(argumentos.notas, argumentos.itens)
+    rotas = ["/api/estoque/resumo", "/api/estoque/saldo-produto/P1?limite=100"]
+
+    print(f"{argumentos.clientes} clientes, {argumentos.requisicoes} requisições por rota")
+    print(f"{'servidor':>9} {'rota':<42} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    for servidor in argumentos.servidores:
+        comando = COMANDOS[servidor]
+        if shutil.which(comando[0]) is None:
+            print(f"{servidor:>9} não instalado, pulado")
+            continue
+        porta = porta_livre()
+        processo = subprocess.Popen(comando, cwd=RAIZ, env=dict(os.environ, PORT=str(porta)),
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            base = f"http://127.0.0.1:{porta}"
+            aguardar(f"{base}/api/health", processo)
+            for rota in rotas:
+                carga(f"{base}{rota}", argumentos.clientes, min(50, argumentos.requisicoes)) # aquecimento
+                vazao, p50, p95 = carga(f"{base}{rota}", argumentos.clientes, argumentos.requisicoes)
+                print(f"{servidor:>9} {rota:<42} {vazao:>8.1f} {p50 * 1000:>8.1f} {p95 * 1000:>8.1f}")
+        finally:
+            processo.terminate()
+            processo.wait(timeout=30)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Tempo de importação/inicialização de src.main em um processo novo.
+
+Cada medição roda um interpretador novo que importa src.main e informa o
+tempo gasto, em três cenários: só a importação (sem inicializar o banco),
+importação sem credenciais do Mainô (o cliente é criado no primeiro uso,
+então isso não deve falhar nem custar nada) e importação com a
+inicialização do banco. Com --importtime, lista os módulos mais lentos
+(python -X importtime).
+
+    python -m benchmarks.inicializacao --repeticoes 10 --importtime
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from benchmarks import configurar_ambiente
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MEDIR = (
+    "import time; inicio = time.perf_counter(); import src.main; "
+    "print(time.perf_counter() - inicio)"
+)
+
+CENARIOS = [
+    ("importação", {"DB_INICIALIZAR_NA_IMPORTACAO": "false"}, ()),
+    ("sem credenciais", {"DB_INICIALIZAR_NA_IMPORTACAO": "false"}, ("MAINO_API_KEY", "MAINO_BEARER_TOKEN")),
+    ("com banco", {"DB_INICIALIZAR_NA_IMPORTACAO": "true"}, ()),
+]
+
+
+def ambiente(extras, remover):
+    env = dict(os.environ, **extras)
+    for nome in remover:
+        env.pop(nome, None)
+    return env
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeticoes", type=int, default=10)
+    parser.add_argument("--importtime", action="store_true", help="mostra os 15 módulos mais lentos")
+    argumentos = parser.parse_args()
+
+    configurar_ambiente()
+    print(f"{'cenário':<16} {'mediana ms':>11} {'mín ms':>8} {'máx ms':>8}")
+    for nome, extras, remover in CENARIOS:
+        tempos = []
+        for _ in range(argumentos.repeticoes):
+            saida = subprocess.run([sys.executable, "-c", MEDIR], cwd=RAIZ, env=ambiente(extras, remover),
+                                   capture_output=True, text=True, check=True)
+            tempos.append(float(saida.stdout.strip().splitlines()[-1]) * 1000)
+        print(f"{nome:<16} {statistics.median(tempos):>11.1f} {min(tempos):>8.1f} {max(tempos):>8.1f}")
+
+    if argumentos.importtime:
+        saida = subprocess.run([sys.executable, "-X", "importtime", "-c", "import src.main"], cwd=RAIZ,
+                               env=ambiente(*CENARIOS[0][1:]), capture_output=True, text=True, check=True)
+        modulos = []
+        for linha in saida.stderr.splitlines():
+            if not linha.startswith("import time:") or "cumulative" in linha:
+                continue
+            _, acumulado, modulo = [parte.strip() for parte in linha.split(":", 1)[1].split("|")]
+            modulos.append((int(acumulado), modulo))
+        print("\nmódulos mais lentos (acumulado, µs):")
+        for acumulado, modulo in sorted(modulos, reverse=True)[:15]:
+            print(f"{acumulado:>10} {modulo}")
+
+
+if __name__ == "__main__":
+    main()
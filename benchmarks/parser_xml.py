@@ -0,0 +1,49 @@
+"""Parser com árvore completa x parser em streaming, em NF-es grandes.
+
+Gera NF-es com muitos itens (`det`) e mede, para cada modo de
+XMLProcessor.parse_nfe_xml, o tempo médio por nota e o pico de memória
+alocada durante o parse (tracemalloc). O XML é entregue como bytes, como
+chega do ZIP e do Mainô.
+
+    python -m benchmarks.parser_xml --itens 1000 5000 --repeticoes 5
+"""
+import argparse
+import time
+import tracemalloc
+from src.services.xml_processor import XMLProcessor
+from tests.exemplos import chave, xml_nfe
+
+
+def medir(processor, dados, streaming, repeticoes):
+    # Tempo sem o tracemalloc ligado (ele deixa as alocações bem mais lentas)
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        resultado = processor.parse_nfe_xml(dados, streaming=streaming)
+    duracao = (time.perf_counter() - inicio) / repeticoes
+    assert resultado["sucesso"], resultado
+
+    tracemalloc.start()
+    processor.parse_nfe_xml(dados, streaming=streaming)
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return duracao, pico
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--itens", type=int, nargs="+", default=[1000, 5000], help="itens (det) por NF-e")
+    parser.add_argument("--repeticoes", type=int, default=5)
+    argumentos = parser.parse_args()
+
+    processor = XMLProcessor()
+    print(f"{'itens':>6} {'tamanho':>9} {'modo':>9} {'ms/nota':>9} {'pico MiB':>9}")
+    for quantidade in argumentos.itens:
+        itens = [(f"P{item:05d}", f"L{item % 97}", "3.5") for item in range(quantidade)]
+        dados = xml_nfe(chave(quantidade), str(quantidade), "5917", itens).encode("utf-8")
+        for modo, streaming in (("arvore", False), ("streaming", True)):
+            duracao, pico = medir(processor, dados, streaming, argumentos.repeticoes)
+            print(f"{quantidade:>6} {len(dados) / 1024:>7.0f}KB {modo:>9} {duracao * 1000:>9.1f} {pico / 2 ** 20:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Vazão da sincronização com o Mainô contra um servidor falso local.
+
+O servidor (ThreadingHTTPServer) responde a listagem de NF-es emitidas e o
+download do XML com uma latência fixa, imitando a API real. Para cada nível
+de concorrência o banco é esvaziado e a mesma janela é sincronizada de novo
+por SincronizacaoService.executar; a saída mostra NF-es por segundo.
+
+    python -m benchmarks.sincronizacao_maino --nfes 400 --latencia 50 --concorrencia 1 2 4 8 16
+"""
+import argparse
+import json
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from benchmarks import configurar_ambiente
+from tests.exemplos import chave, xml_nfe
+
+ITENS_POR_PAGINA = 100
+
+
+def criar_servidor(total_nfes, latencia):
+    data_emissao = datetime.now().strftime("%Y-%m-%dT%H:%M:%S-03:00")
+    xmls = {
+        chave(numero): xml_nfe(chave(numero), str(numero), "5917",
+                               [(f"P{item}", f"L{numero}", "10") for item in range(5)], data_emissao=data_emissao)
+        for numero in range(1, total_nfes + 1)
+    }
+    chaves = list(xmls)
+    total_paginas = (total_nfes + ITENS_POR_PAGINA - 1) // ITENS_POR_PAGINA
+
+    class MainoFalso(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # keep-alive, como a API real
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            parametros = {nome: valores[0] for nome, valores in parse_qs(url.query).items()}
+            time.sleep(latencia)
+            if url.path == "/api/v1/nfe/emitidas":
+                pagina = int(parametros.get("pagina", 1))
+                inicio = (pagina - 1) * ITENS_POR_PAGINA
+                itens = [{"chaveAcesso": chave_acesso, "numero": chave_acesso[-6:]}
+                         for chave_acesso in chaves[inicio:inicio + ITENS_POR_PAGINA]]
+                self._responder(json.dumps({"itens": itens, "totalPaginas": total_paginas}), "application/json")
+            elif url.path == "/api/v1/nfe/xml" and parametros.get("chaveAcesso") in xmls:
+                self._responder(xmls[parametros["chaveAcesso"]], "application/xml")
+            else:
+                self._responder("{}", "application/json", status=404)
+
+        def _responder(self, corpo, tipo, status=200):
+            dados = corpo.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", tipo)
+            self.send_header("Content-Length", str(len(dados)))
+            self.end_headers()
+            self.wfile.write(dados)
+
+        def log_message(self, *args):
+            pass
+
+    return ThreadingHTTPServer(("127.0.0.1", 0), MainoFalso)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nfes", type=int, default=400, help="NF-es listadas pelo servidor falso")
+    parser.add_argument("--latencia", type=float, default=50, help="latência de cada resposta, em ms")
+    parser.add_argument("--concorrencia", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    argumentos = parser.parse_args()
+
+    # O pool HTTP precisa comportar a maior concorrência medida
+    configurar_ambiente(MAINO_POOL_SIZE=str(max(argumentos.concorrencia)))
+    from src.main import app, inicializar_banco
+    from src.extensions import db
+    from src.services.estoque_service import EstoqueService
+    from src.services.maino_api import MainoAPI
+    from src.services.sincronizacao_service import SincronizacaoService
+    from src.services.xml_processor import XMLProcessor
+    inicializar_banco()
+
+    servidor = criar_servidor(argumentos.nfes, argumentos.latencia / 1000)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    maino_api = MainoAPI()
+    maino_api.base_url = f"http://127.0.0.1:{servidor.server_address[1]}/"
+
+    print(f"{argumentos.nfes} NF-es, latência {argumentos.latencia:g} ms por requisição")
+    print(f"{'concorrência':>12} {'segundos':>9} {'NF-es/s':>9}")
+    with app.app_context():
+        for concorrencia in argumentos.concorrencia:
+            for tabela in reversed(db.metadata.sorted_tables):
+                db.session.execute(tabela.delete())
+            db.session.commit()
+
+            sincronizacao = SincronizacaoService(maino_api, XMLProcessor(), EstoqueService(), concorrencia=concorrencia)
+            inicio = time.perf_counter()
+            resultado = sincronizacao.executar(30, completo=True)
+            duracao = time.perf_counter() - inicio
+            assert resultado["nfes_processadas"] == argumentos.nfes, resultado
+            print(f"{concorrencia:>12} {duracao:>9.2f} {argumentos.nfes / duracao:>9.1f}")
+    servidor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""Configuração do gunicorn para produção.
+
+Uso: gunicorn -c gunicorn.conf.py src.main:app
+
+Todos os valores podem ser ajustados por variáveis de ambiente.
+"""
+import multiprocessing
+import os
+
+# A versão do esquema é conferida uma única vez no processo mestre (on_starting), não ao importar a app em
+# cada worker; as migrações de dados rodam antes, na entrada `release` do Procfile
+os.environ.setdefault("DB_INICIALIZAR_NA_IMPORTACAO", "false")
+# Os jobs ficam com o processo `worker` do Procfile; a web só os grava como PENDENTE
+# (JOBS_EXECUTAR_NA_WEB=true volta a executá-los aqui, para deploys sem o worker)
+os.environ.setdefault("JOBS_EXECUTAR_NA_WEB", "false")
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+
+# Workers com threads: as rotas passam a maior parte do tempo esperando o banco,
+# e os jobs (sincronização/importação) rodam em threads próprias do worker
+worker_class = "gthread"
+workers = int(os.getenv("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv("GUNICORN_THREADS", 4))
+
+# Carrega a app uma vez no mestre e compartilha a memória com os workers (copy-on-write)
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+
+# /processar-xml e as exportações em streaming podem demorar; a sincronização em si roda como job.
+# graceful_timeout dá tempo para terminar requisições (e o lote de jobs em andamento) no restart
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 60))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+
+# O LRU em memória não enxerga as invalidações feitas por outro processo
+from src.cache import exigir_cache_compartilhado
+if workers > 1:
+    exigir_cache_compartilhado(f"{workers} workers do gunicorn")
+if os.environ["JOBS_EXECUTAR_NA_WEB"].lower() != "true":
+    exigir_cache_compartilhado("os jobs gravam no processo worker")
+
+accesslog = os.getenv("GUNICORN_ACCESSLOG", "-")
+errorlog = "-"
+loglevel = os.getenv("GUNICORN_LOGLEVEL", "info")
+
+
+def on_starting(server):
+    from src.main import inicializar_banco
+    inicializar_banco()
@@ -0,0 +1,117 @@
+"""Cache de leitura (read-through) para os resultados de saldo e resumo.
+
+As entradas são associadas a tags (por exemplo `cnpj:<cnpj>` e
+`produto:<codigo>`). Cada tag tem uma geração guardada no próprio backend e
+a chave efetiva de uma entrada inclui as gerações das suas tags; invalidar
+uma tag troca a geração, e as entradas antigas deixam de ser encontradas
+(e saem pelo TTL/LRU). As gerações também expiram pelo TTL: uma geração
+perdida só provoca uma falta.
+
+Sem configuração o cache fica desligado (CACHE_BACKEND=nenhum). Para ligá-lo,
+CACHE_BACKEND aponta para uma fábrica "modulo:funcao" que devolva um objeto
+compartilhado entre os processos, com `get(chave)` e `set(chave, valor, ttl)`
+(por exemplo, um adaptador para Redis).
+
+CACHE_BACKEND=memoria usa um LRU com TTL dentro do processo. A invalidação
+só alcança o processo que gravou, então ele serve apenas quando a mesma
+instância grava e lê (desenvolvimento, um único worker com os jobs na web);
+com vários workers do gunicorn ou com o processo `worker` separado a
+inicialização falha (ver exigir_cache_compartilhado).
+"""
+import importlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from src import metricas
+
+
+def exigir_cache_compartilhado(motivo):
+    """Falha se o cache configurado for o LRU por processo: `motivo` diz por que há mais de um processo."""
+    if os.getenv("CACHE_BACKEND", "nenhum") == "memoria":
+        raise RuntimeError(
+            f"CACHE_BACKEND=memoria não é compartilhado entre processos ({motivo}): "
+            "configure um backend compartilhado (modulo:funcao) ou use CACHE_BACKEND=nenhum"
+        )
+
+
+class CacheLRU:
+    """LRU em memória com expiração por entrada."""
+
+    def __init__(self, capacidade=1024):
+        self.capacidade = capacidade
+        self._entradas = OrderedDict() # chave -> (expira_em ou None, valor)
+        self._lock = threading.Lock()
+
+    def get(self, chave):
+        with self._lock:
+            entrada = self._entradas.get(chave)
+            if entrada is None:
+                return None
+            expira_em, valor = entrada
+            if expira_em is not None and expira_em < time.monotonic():
+                del self._entradas[chave]
+                return None
+            self._entradas.move_to_end(chave)
+            return valor
+
+    def set(self, chave, valor, ttl=None):
+        with self._lock:
+            self._entradas[chave] = (time.monotonic() + ttl if ttl else None, valor)
+            self._entradas.move_to_end(chave)
+            while len(self._entradas) > self.capacidade:
+                self._entradas.popitem(last=False)
+
+
+class Cache:
+    def __init__(self, backend=None, ttl=None, nome="estoque"):
+        self.backend = backend
+        self.ttl = ttl
+        self.nome = nome
+
+    @classmethod
+    def do_ambiente(cls, nome="estoque"):
+        ttl = int(os.getenv("CACHE_TTL", 60))
+        configuracao = os.getenv("CACHE_BACKEND", "nenhum")
+        if configuracao == "nenhum":
+            backend = None
+        elif configuracao == "memoria":
+            backend = CacheLRU(int(os.getenv("CACHE_CAPACIDADE", 1024)))
+        else:
+            modulo, fabrica = configuracao.split(":")
+            backend = getattr(importlib.import_module(modulo), fabrica)()
+        return cls(backend, ttl, nome)
+
+    def versao(self, tags):
+        # Gerações das tags, na ordem recebida; muda sempre que uma delas é invalidada
+        if self.backend is None:
+            return uuid.uuid4().hex
+        geracoes = []
+        for tag in tags:
+            geracao = self.backend.get(f"geracao:{tag}")
+            if geracao is None:
+                geracao = uuid.uuid4().hex[:12]
+                self.backend.set(f"geracao:{tag}", geracao, self.ttl)
+            geracoes.append(geracao)
+        return "-".join(geracoes)
+
+    def obter(self, chave, tags, calcular):
+        """Devolve o valor em cache para `chave` ou calcula, guarda e devolve."""
+        if self.backend is None:
+            return calcular()
+        chave_versionada = f"{chave}|{self.versao(tags)}"
+        valor = self.backend.get(chave_versionada)
+        if valor is not None:
+            metricas.incrementar("consignacoes_cache_total", cache=self.nome, resultado="acerto")
+            return valor
+        metricas.incrementar("consignacoes_cache_total", cache=self.nome, resultado="falta")
+        valor = calcular()
+        self.backend.set(chave_versionada, valor, self.ttl)
+        return valor
+
+    def invalidar(self, tags):
+        if self.backend is None:
+            return
+        for tag in set(tags):
+            self.backend.set(f"geracao:{tag}", uuid.uuid4().hex[:12], self.ttl)
@@ -0,0 +1,326 @@
+"""Migrações versionadas do banco.
+
+`db.create_all()` só cria tabelas que ainda não existem; alterações em
+tabelas existentes (índices, colunas, conversões de dados) ficam aqui, numa
+lista ordenada de passos. A versão aplicada é registrada na tabela
+`schema_migracoes`, então cada passo roda uma única vez por banco.
+Funciona em SQLite e PostgreSQL.
+
+Processos que sobem juntos (web e worker no deploy) se serializam num
+bloqueio: advisory lock no PostgreSQL, arquivo `<banco>.migracoes.lock` no
+SQLite. O segundo só lê as versões depois que o primeiro terminou.
+
+Os passos podem reescrever tabelas inteiras (XML comprimido, conversão das
+quantidades, razão de movimentos), então não rodam na subida da aplicação:
+ficam no comando de release, antes de web e worker subirem.
+
+Uso: python -m src.database.migrations (entrada `release` do Procfile)
+
+Na subida, verificar_migracoes só confere a versão do esquema (ver abaixo).
+"""
+import logging
+import os
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import MetaData, inspect, insert, text
+from sqlalchemy.schema import CreateTable
+from src.extensions import db
+from src.models.nfe import NotaFiscal, XmlNotaFiscal, ItemNotaFiscal, EstoqueConsignacao, MovimentoEstoque
+from src.models.resumo import ResumoEstoque, ResumoProduto, ResumoDestinatario
+from src.services.resumo_service import ResumoService
+
+try:
+    import fcntl
+except ImportError: # Windows: sem bloqueio entre processos no SQLite (uso local)
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Chave do pg_advisory_lock das migrações (número fixo qualquer, exclusivo desta aplicação)
+CHAVE_BLOQUEIO_POSTGRES = 7241_0925
+
+
+def _criar_indices(conn, tabela, nomes):
+    indices = {index.name: index for index in tabela.indexes}
+    for nome in nomes:
+        indices[nome].create(conn, checkfirst=True)
+    # Atualiza as estatísticas para o planejador passar a usar os novos índices
+    conn.execute(text(f"ANALYZE {tabela.name}"))
+
+
+def _m001_indices_consignacao(conn):
+    _criar_indices(conn, NotaFiscal.__table__, ['ix_notas_fiscais_tipo_operacao_data_emissao'])
+    _criar_indices(conn, ItemNotaFiscal.__table__, ['ix_itens_nota_fiscal_nota_fiscal_id'])
+    _criar_indices(conn, EstoqueConsignacao.__table__, [
+        'ix_estoque_consignacao_cnpj_produto_lote',
+        'ix_estoque_consignacao_produto_lote',
+        'ix_estoque_consignacao_nf_saida_produto_lote',
+    ])
+
+
+def _m002_xml_comprimido(conn, tamanho_lote=500):
+    # Move notas_fiscais.xml_content para xml_notas_fiscais (comprimido) e remove a coluna antiga
+    colunas = {coluna["name"] for coluna in inspect(conn).get_columns("notas_fiscais")}
+    if "xml_content" not in colunas:
+        return
+
+    XmlNotaFiscal.__table__.create(conn, checkfirst=True)
+    bytes_originais = 0
+    bytes_comprimidos = 0
+    documentos = 0
+    ultimo_id = 0
+    while True:
+        linhas = conn.execute(text(
+            "SELECT id, xml_content FROM notas_fiscais "
+            "WHERE id > :ultimo_id AND xml_content IS NOT NULL ORDER BY id LIMIT :limite"
+        ), {"ultimo_id": ultimo_id, "limite": tamanho_lote}).fetchall()
+        if not linhas:
+            break
+        valores = []
+        for nota_fiscal_id, xml_content in linhas:
+            comprimido = XmlNotaFiscal.valores_comprimidos(xml_content)
+            bytes_originais += comprimido["tamanho_original"]
+            bytes_comprimidos += len(comprimido["conteudo"])
+            valores.append(dict(comprimido, nota_fiscal_id=nota_fiscal_id))
+        conn.execute(insert(XmlNotaFiscal), valores)
+        documentos += len(linhas)
+        ultimo_id = linhas[-1][0]
+
+    if documentos:
+        logger.info(
+            "XML de %s NF-es comprimido: %.1f MB -> %.1f MB (%.1f%% de redução)",
+            documentos, bytes_originais / 1e6, bytes_comprimidos / 1e6,
+            100 * (1 - bytes_comprimidos / bytes_originais) if bytes_originais else 0
+        )
+    conn.execute(text("ALTER TABLE notas_fiscais DROP COLUMN xml_content"))
+
+
+# Colunas de quantidade/valor que passaram de Float para inteiro escalado (DecimalFixo): (tabela, coluna, casas)
+COLUNAS_DECIMAL_FIXO = [
+    ('itens_nota_fiscal', 'quantidade', 4),
+    ('itens_nota_fiscal', 'valor_unitario', 10),
+    ('itens_nota_fiscal', 'valor_total', 2),
+    ('estoque_consignacao', 'quantidade_consignada_nf', 4),
+    ('estoque_consignacao', 'quantidade_retornada_nf', 4),
+    ('estoque_consignacao', 'quantidade_faturada_nf', 4),
+    ('estoque_consignacao', 'saldo_disponivel_nf', 4),
+    ('resumo_estoque', 'saldo_total_disponivel', 4),
+    ('resumo_estoque', 'limite_saldo_baixo', 4),
+    ('resumo_produto', 'saldo_disponivel', 4),
+    ('resumo_destinatario', 'saldo_disponivel', 4),
+]
+
+
+def _colunas_float(inspetor):
+    # {tabela: [(coluna, casas)]} das colunas de COLUNAS_DECIMAL_FIXO ainda declaradas em ponto flutuante
+    pendentes = {}
+    for tabela, coluna, casas in COLUNAS_DECIMAL_FIXO:
+        if not inspetor.has_table(tabela):
+            continue
+        tipos = {c["name"]: c["type"] for c in inspetor.get_columns(tabela)}
+        if coluna in tipos and tipos[coluna].python_type is float:
+            pendentes.setdefault(tabela, []).append((coluna, casas))
+    return pendentes
+
+
+def _reconstruir_tabela_sqlite(conn, nome, expressoes):
+    """Recria `nome` com a definição atual do modelo, copiando os dados.
+
+    SQLite não altera o tipo declarado de uma coluna (a afinidade FLOAT faria
+    os inteiros escalados serem gravados como REAL), então a tabela é
+    refeita: cria `<nome>_nova`, copia as colunas em comum (usando
+    `expressoes[coluna]` quando houver), apaga a antiga e renomeia.
+    """
+    metadados = MetaData()
+    # As tabelas referenciadas precisam estar no mesmo MetaData para compilar as chaves estrangeiras
+    for tabela in db.metadata.sorted_tables:
+        tabela.to_metadata(metadados)
+    nova = db.metadata.tables[nome].to_metadata(metadados, name=f"{nome}_nova")
+    existentes = {coluna["name"] for coluna in inspect(conn).get_columns(nome)}
+    colunas = [coluna.name for coluna in nova.columns if coluna.name in existentes]
+
+    conn.execute(CreateTable(nova))
+    conn.execute(text(
+        f"INSERT INTO {nome}_nova ({', '.join(colunas)}) "
+        f"SELECT {', '.join(expressoes.get(coluna, coluna) for coluna in colunas)} FROM {nome}"
+    ))
+    conn.execute(text(f"DROP TABLE {nome}"))
+    conn.execute(text(f"ALTER TABLE {nome}_nova RENAME TO {nome}"))
+    for indice in db.metadata.tables[nome].indexes:
+        indice.create(conn, checkfirst=True)
+
+
+def _m003_quantidades_decimal_fixo(conn):
+    # Só converte colunas ainda em ponto flutuante (bancos criados antes desta versão)
+    for tabela, colunas in _colunas_float(inspect(conn)).items():
+        if conn.dialect.name == "postgresql":
+            for coluna, casas in colunas:
+                conn.execute(text(
+                    f"ALTER TABLE {tabela} ALTER COLUMN {coluna} TYPE BIGINT USING ROUND({coluna} * {10 ** casas})::BIGINT"
+                ))
+        else:
+            _reconstruir_tabela_sqlite(conn, tabela, {
+                coluna: f"CAST(ROUND({coluna} * {10 ** casas}) AS INTEGER)" for coluna, casas in colunas
+            })
+
+
+def _m004_movimentos_estoque(conn):
+    """Cria movimentos_estoque a partir dos saldos já gravados.
+
+    Cada registro de estoque ganha o movimento SAIDA da NF de origem. As
+    baixas anteriores não guardaram histórico (NF de entrada e data), então
+    viram um movimento de ajuste por registro, datado da migração.
+    """
+    MovimentoEstoque.__table__.create(conn, checkfirst=True)
+    if conn.execute(text("SELECT 1 FROM movimentos_estoque LIMIT 1")).first():
+        return
+
+    agora = datetime.utcnow()
+    conn.execute(text(
+        "INSERT INTO movimentos_estoque (estoque_id, nota_fiscal_id, tipo_operacao, quantidade, data_movimento, criado_em) "
+        "SELECT e.id, e.nf_saida_id, 'SAIDA', e.quantidade_consignada_nf, COALESCE(n.data_emissao, :agora), :agora "
+        "FROM estoque_consignacao e JOIN notas_fiscais n ON n.id = e.nf_saida_id"
+    ), {"agora": agora})
+    for tipo, coluna in (("ENTRADA_RETORNO", "quantidade_retornada_nf"), ("ENTRADA_VENDA", "quantidade_faturada_nf")):
+        conn.execute(text(
+            "INSERT INTO movimentos_estoque (estoque_id, tipo_operacao, quantidade, data_movimento, criado_em) "
+            f"SELECT id, :tipo, {coluna}, :agora, :agora FROM estoque_consignacao WHERE {coluna} > 0"
+        ), {"tipo": tipo, "agora": agora})
+    conn.execute(text("ANALYZE movimentos_estoque"))
+
+
+def _m005_versao_estoque(conn):
+    colunas = {coluna["name"] for coluna in inspect(conn).get_columns("estoque_consignacao")}
+    if "versao" not in colunas:
+        conn.execute(text("ALTER TABLE estoque_consignacao ADD COLUMN versao INTEGER NOT NULL DEFAULT 0"))
+
+
+def _m006_decimal_fixo_inteiro_sqlite(conn):
+    # Bancos SQLite em que a versão anterior da migração 3 só escalou os valores:
+    # a coluna seguiu FLOAT e os inteiros ficaram gravados como REAL. Refaz a tabela com BIGINT
+    if conn.dialect.name != "sqlite":
+        return
+    for tabela, colunas in _colunas_float(inspect(conn)).items():
+        _reconstruir_tabela_sqlite(conn, tabela, {
+            coluna: f"CAST({coluna} AS INTEGER)" for coluna, casas in colunas
+        })
+
+
+def _m007_resumo_estoque(conn):
+    # Cria a linha de resumo_estoque (com ESTOQUE_LIMITE_SALDO_BAIXO) a partir do estoque já gravado;
+    # depois disso o GET /resumo só lê e as gravações só aplicam incrementos
+    for modelo in (ResumoEstoque, ResumoProduto, ResumoDestinatario):
+        modelo.__table__.create(conn, checkfirst=True)
+    if conn.execute(text("SELECT 1 FROM resumo_estoque WHERE id = 1")).first():
+        return
+    ResumoService().reconstruir(conn)
+
+
+# (versão, nome, função) — sempre acrescentar no final, nunca renumerar
+MIGRACOES = [
+    (1, 'indices_consignacao', _m001_indices_consignacao),
+    (2, 'xml_comprimido', _m002_xml_comprimido),
+    (3, 'quantidades_decimal_fixo', _m003_quantidades_decimal_fixo),
+    (4, 'movimentos_estoque', _m004_movimentos_estoque),
+    (5, 'versao_estoque', _m005_versao_estoque),
+    (6, 'decimal_fixo_inteiro_sqlite', _m006_decimal_fixo_inteiro_sqlite),
+    (7, 'resumo_estoque', _m007_resumo_estoque),
+]
+
+
+@contextmanager
+def bloqueio_migracoes(engine):
+    if engine.dialect.name == "postgresql":
+        # Advisory lock de sessão: fica com esta conexão até o unlock, independente das transações
+        with engine.connect() as conn:
+            conn.execute(text("SELECT pg_advisory_lock(:chave)"), {"chave": CHAVE_BLOQUEIO_POSTGRES})
+            conn.commit()
+            try:
+                yield
+            finally:
+                conn.execute(text("SELECT pg_advisory_unlock(:chave)"), {"chave": CHAVE_BLOQUEIO_POSTGRES})
+                conn.commit()
+        return
+
+    caminho = engine.url.database if engine.dialect.name == "sqlite" else None
+    if fcntl is None or not caminho or caminho == ":memory:":
+        yield
+        return
+    # Trava um arquivo ao lado do banco: os passos usam outras conexões, então um
+    # BEGIN IMMEDIATE na conexão do bloqueio travaria o próprio processo
+    with open(os.path.abspath(caminho) + ".migracoes.lock", "a") as arquivo:
+        fcntl.flock(arquivo, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(arquivo, fcntl.LOCK_UN)
+
+
+def aplicar_migracoes(engine=None, criar_tabelas=False):
+    """Aplica os passos pendentes; com `criar_tabelas`, roda antes o create_all dos modelos.
+
+    Tudo acontece dentro de bloqueio_migracoes, então processos concorrentes
+    não criam a mesma tabela nem aplicam o mesmo passo duas vezes.
+    """
+    engine = engine or db.engine
+    with bloqueio_migracoes(engine):
+        if criar_tabelas:
+            db.metadata.create_all(engine)
+        _aplicar_pendentes(engine)
+
+
+class MigracoesPendentes(RuntimeError):
+    """O banco está numa versão de esquema anterior à do código."""
+
+
+def verificar_migracoes(engine=None):
+    """Checagem feita na subida de web e worker, sem migrar dados.
+
+    Banco novo (sem as tabelas da aplicação): cria tudo e registra os passos,
+    que são instantâneos com as tabelas vazias. Banco existente: cria só as
+    tabelas que faltarem e levanta MigracoesPendentes se algum passo ainda
+    não foi aplicado pelo comando de release.
+    """
+    engine = engine or db.engine
+    with bloqueio_migracoes(engine):
+        novo = not inspect(engine).has_table(NotaFiscal.__tablename__)
+        db.metadata.create_all(engine)
+        if novo:
+            _aplicar_pendentes(engine)
+            return
+        pendentes = [f"{versao} ({nome})" for versao, nome, _ in _pendentes(engine)]
+    if pendentes:
+        raise MigracoesPendentes(
+            f"Migrações pendentes: {', '.join(pendentes)}. Rode `python -m src.database.migrations` antes de subir a aplicação."
+        )
+
+
+def _pendentes(engine):
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migracoes ("
+            "versao INTEGER PRIMARY KEY, nome VARCHAR(100) NOT NULL, aplicada_em TIMESTAMP NOT NULL)"
+        ))
+        aplicadas = {versao for (versao,) in conn.execute(text("SELECT versao FROM schema_migracoes"))}
+    return [(versao, nome, migracao) for versao, nome, migracao in MIGRACOES if versao not in aplicadas]
+
+
+def _aplicar_pendentes(engine):
+    for versao, nome, migracao in _pendentes(engine):
+        logger.info("Aplicando migração %s (%s)", versao, nome)
+        # Cada passo roda na própria transação junto com o registro da versão
+        with engine.begin() as conn:
+            migracao(conn)
+            conn.execute(
+                text("INSERT INTO schema_migracoes (versao, nome, aplicada_em) VALUES (:versao, :nome, :aplicada_em)"),
+                {"versao": versao, "nome": nome, "aplicada_em": datetime.utcnow()}
+            )
+
+
+if __name__ == '__main__':
+    # A importação da app não pode fazer a checagem de subida: é justamente este comando que migra
+    os.environ['DB_INICIALIZAR_NA_IMPORTACAO'] = 'false'
+    from src.main import app
+    logging.basicConfig(level=logging.INFO)
+    with app.app_context():
+        aplicar_migracoes(criar_tabelas=True)
@@ -1,2 +1,54 @@
+from contextlib import contextmanager
+from decimal import Decimal
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
-db = SQLAlchemy()
\ No newline at end of file
+
+# Instância única: todos os modelos (usuários, NF-es, jobs, resumo) usam o mesmo engine e pool,
+# configurados em main.py (SQLALCHEMY_ENGINE_OPTIONS)
+db = SQLAlchemy()
+
+
+class ProvedorJSON(DefaultJSONProvider):
+    """JSON da aplicação: Decimal sai como número, como as colunas Float de antes.
+
+    As rotas que precisam do valor exato acrescentam campos "<campo>_exato" em string.
+    """
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, Decimal):
+            return float(o)
+        return DefaultJSONProvider.default(o)
+
+
+@contextmanager
+def sessao_ingestao():
+    """Desliga expire_on_commit na sessão da thread corrente durante uma gravação em lote.
+
+    Com o padrão (True), cada commit por chunk expira os objetos carregados e
+    o próximo acesso refaz um SELECT por objeto; a ingestão grava por INSERT/
+    UPDATE em massa e não depende desse recarregamento. A sessão volta ao
+    comportamento padrão ao sair do bloco.
+    """
+    sessao = db.session()
+    anterior = sessao.expire_on_commit
+    sessao.expire_on_commit = False
+    try:
+        yield sessao
+    finally:
+        sessao.expire_on_commit = anterior
+
+
+def executar_leitura(consulta, **opcoes_execucao):
+    """Executa uma consulta somente leitura na réplica (bind "leitura"), se configurada.
+
+    Sem DATABASE_REPLICA_URL a consulta vai para o banco principal, como as demais.
+    Aceita um Query do ORM ou um select(); devolve o Result.
+    """
+    if hasattr(consulta, "statement"):
+        consulta = consulta.statement
+    return db.session.execute(
+        consulta,
+        execution_options=opcoes_execucao,
+        bind_arguments={"bind": db.engines.get("leitura", db.engine)}
+    )
@@ -13,21 +13,25 @@ load_dotenv(dotenv_path=env_path)
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
 # 3. Agora importar os componentes do projeto
-from src.models.user import db
+from src.extensions import db, ProvedorJSON
 from src.routes.user import user_bp
 from src.routes.estoque import estoque_bp
+from src.database.migrations import verificar_migracoes
+from src import metricas
 
 # 4. Inicializar aplicação Flask
 app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
 app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY', 'fallback-secret-key')
+app.json = ProvedorJSON(app) # Decimal -> número JSON
 
 # 5. Health Check - ESSENCIAL PARA DEPLOY
 @app.route('/api/health')
 def health_check():
     return {'status': 'ok', 'message': 'API funcionando'}, 200
 
-# 6. Configurar CORS
+# 6. Configurar CORS e métricas (/api/metrics)
 CORS(app)
+metricas.instrumentar(app)
 
 # 7. Registrar Blueprints
 app.register_blueprint(user_bp, url_prefix='/api')
@@ -37,11 +41,42 @@ app.register_blueprint(estoque_bp, url_prefix='/api/estoque')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL') or \
     f"sqlite:///{os.path.join(os.path.dirname(__file__), 'database', 'app.db')}"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+def opcoes_engine(uri):
+    # Pool de conexões configurável por ambiente (valores padrão do SQLAlchemy quando não informados)
+    opcoes = {
+        'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true',
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+    }
+    if not uri.startswith('sqlite'):
+        opcoes['pool_size'] = int(os.getenv('DB_POOL_SIZE', 5))
+        opcoes['max_overflow'] = int(os.getenv('DB_MAX_OVERFLOW', 10))
+        opcoes['pool_timeout'] = int(os.getenv('DB_POOL_TIMEOUT', 30))
+        if os.getenv('DB_STATEMENT_TIMEOUT_MS'):
+            # PostgreSQL: cancela consultas que passarem do limite (em milissegundos)
+            opcoes['connect_args'] = {'options': f"-c statement_timeout={os.getenv('DB_STATEMENT_TIMEOUT_MS')}"}
+    return opcoes
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = opcoes_engine(app.config['SQLALCHEMY_DATABASE_URI'])
+# Réplica opcional para as consultas de saldo e resumo (ver src.extensions.executar_leitura)
+if os.getenv('DATABASE_REPLICA_URL'):
+    app.config['SQLALCHEMY_BINDS'] = {
+        'leitura': dict(opcoes_engine(os.environ['DATABASE_REPLICA_URL']), url=os.environ['DATABASE_REPLICA_URL'])
+    }
 db.init_app(app)
 
-# 9. Criar tabelas se não existirem
-with app.app_context():
-    db.create_all()
+# 9. Criar tabelas que faltarem e conferir a versão do esquema; as migrações de dados
+# rodam antes, no comando de release (python -m src.database.migrations)
+def inicializar_banco():
+    with app.app_context():
+        verificar_migracoes()
+        # Conexões abertas aqui não devem ser herdadas pelos processos filhos (fork do gunicorn)
+        db.engine.dispose()
+
+# No gunicorn isso roda uma única vez no processo mestre (ver gunicorn.conf.py), não em cada worker.
+# Filhos "spawn" do parse em lote (__mp_main__ ao rodar `python src/main.py`) nunca inicializam
+if __name__ != '__mp_main__' and os.getenv('DB_INICIALIZAR_NA_IMPORTACAO', 'true').lower() == 'true':
+    inicializar_banco()
 
 # 10. Rota para servir o frontend
 @app.route('/', defaults={'path': ''})
@@ -51,9 +86,8 @@ def serve(path):
         return send_from_directory(app.static_folder, path)
     return send_from_directory(app.static_folder, 'index.html')
 
-# 11. Inicialização do Servidor
+# 11. Inicialização do Servidor (desenvolvimento; em produção use: gunicorn -c gunicorn.conf.py src.main:app)
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
-    # Mude debug=False para produção!
-    app.run(debug=True, host='0.0.0.0', port=port)
+    app.run(debug=os.getenv('FLASK_DEBUG', 'false').lower() == 'true', host='0.0.0.0', port=port)
 
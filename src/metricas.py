@@ -0,0 +1,177 @@
+"""Métricas de desempenho em memória, expostas em /api/metrics (formato texto do Prometheus).
+
+Tudo é agrupado por "endpoint": o endpoint Flask da requisição ou `job:<tipo>`
+para os jobs em segundo plano. São registrados:
+
+- duração das requisições (`consignacoes_requisicao_segundos`);
+- duração de cada etapa instrumentada com `etapa(nome)`, por exemplo a busca
+  HTTP no Mainô, o parse do XML e a gravação (`consignacoes_etapa_segundos`);
+- quantidade e duração das consultas SQL, via eventos do engine do
+  SQLAlchemy (`consignacoes_sql_segundos`);
+- acertos e faltas do cache de leitura (`consignacoes_cache_total`).
+
+Os valores são por processo: com vários workers do gunicorn, cada um expõe
+os próprios números (o Prometheus agrega pelo rótulo da instância).
+"""
+import cProfile
+import io
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import Response, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_endpoint = ContextVar("metricas_endpoint", default="sem_endpoint")
+
+_lock = threading.Lock()
+# nome da métrica -> {rótulos (tupla ordenada): [contagem, soma em segundos]}
+_resumos = {}
+# nome da métrica -> {rótulos (tupla ordenada): total}
+_contadores = {}
+
+DESCRICOES = {
+    "consignacoes_requisicao_segundos": "Duração das requisições HTTP",
+    "consignacoes_etapa_segundos": "Duração das etapas instrumentadas (busca no Mainô, parse, gravação)",
+    "consignacoes_sql_segundos": "Duração das consultas SQL",
+    "consignacoes_cache_total": "Consultas ao cache de leitura, por resultado (acerto/falta)",
+}
+
+
+def definir_endpoint(nome):
+    # Devolve o token para restaurar o valor anterior com restaurar_endpoint
+    return _endpoint.set(nome)
+
+
+def restaurar_endpoint(token):
+    _endpoint.reset(token)
+
+
+def observar(nome, duracao, **rotulos):
+    rotulos.setdefault("endpoint", _endpoint.get())
+    chave = tuple(sorted(rotulos.items()))
+    with _lock:
+        resumo = _resumos.setdefault(nome, {}).setdefault(chave, [0, 0.0])
+        resumo[0] += 1
+        resumo[1] += duracao
+
+
+def contagem(nome, **rotulos):
+    # Observações já registradas em um resumo (por exemplo, consultas SQL de um endpoint)
+    rotulos.setdefault("endpoint", _endpoint.get())
+    with _lock:
+        return _resumos.get(nome, {}).get(tuple(sorted(rotulos.items())), [0, 0.0])[0]
+
+
+def incrementar(nome, quantidade=1, **rotulos):
+    chave = tuple(sorted(rotulos.items()))
+    with _lock:
+        serie = _contadores.setdefault(nome, {})
+        serie[chave] = serie.get(chave, 0) + quantidade
+
+
+@contextmanager
+def etapa(nome):
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        observar("consignacoes_etapa_segundos", time.perf_counter() - inicio, etapa=nome)
+
+
+def medir_iteracao(nome, iteravel):
+    # Como etapa(), mas soma só o tempo gasto produzindo os itens, não o do consumidor
+    iterador = iter(iteravel)
+    total = 0.0
+    try:
+        while True:
+            inicio = time.perf_counter()
+            try:
+                item = next(iterador)
+            except StopIteration:
+                break
+            finally:
+                total += time.perf_counter() - inicio
+            yield item
+    finally:
+        observar("consignacoes_etapa_segundos", total, etapa=nome)
+
+
+def exportar_prometheus():
+    linhas = []
+    with _lock:
+        for nome, series in sorted(_resumos.items()):
+            linhas.append(f"# HELP {nome} {DESCRICOES.get(nome, nome)}")
+            linhas.append(f"# TYPE {nome} summary")
+            for rotulos, (contagem, soma) in sorted(series.items()):
+                texto_rotulos = ",".join(f'{chave}="{_escapar(valor)}"' for chave, valor in rotulos)
+                linhas.append(f"{nome}_count{{{texto_rotulos}}} {contagem}")
+                linhas.append(f"{nome}_sum{{{texto_rotulos}}} {soma:.6f}")
+        for nome, series in sorted(_contadores.items()):
+            linhas.append(f"# HELP {nome} {DESCRICOES.get(nome, nome)}")
+            linhas.append(f"# TYPE {nome} counter")
+            for rotulos, total in sorted(series.items()):
+                texto_rotulos = ",".join(f'{chave}="{_escapar(valor)}"' for chave, valor in rotulos)
+                linhas.append(f"{nome}{{{texto_rotulos}}} {total}")
+    return "\n".join(linhas) + "\n"
+
+
+def _escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def perfilar(funcao, *args, limite=40, **kwargs):
+    """Executa `funcao` sob o cProfile e devolve (resultado, resumo em texto).
+
+    O resumo traz as `limite` funções com maior tempo acumulado.
+    """
+    perfil = cProfile.Profile()
+    resultado = perfil.runcall(funcao, *args, **kwargs)
+    saida = io.StringIO()
+    pstats.Stats(perfil, stream=saida).sort_stats("cumulative").print_stats(limite)
+    return resultado, saida.getvalue()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _antes_consulta(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metricas_inicio", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _depois_consulta(conn, cursor, statement, parameters, context, executemany):
+    inicios = conn.info.get("metricas_inicio")
+    if inicios:
+        observar("consignacoes_sql_segundos", time.perf_counter() - inicios.pop())
+
+
+@event.listens_for(Engine, "handle_error")
+def _erro_consulta(contexto):
+    # Consulta com erro não dispara after_cursor_execute: descarta o início pendente
+    if contexto.connection is not None:
+        inicios = contexto.connection.info.get("metricas_inicio")
+        if inicios:
+            inicios.pop()
+
+
+def instrumentar(app):
+    """Registra a medição das requisições e a rota /api/metrics na aplicação."""
+
+    @app.before_request
+    def _inicio_requisicao():
+        g.metricas_inicio = time.perf_counter()
+        g.metricas_token = definir_endpoint(request.endpoint or "sem_endpoint")
+
+    @app.teardown_request
+    def _fim_requisicao(erro=None):
+        inicio = g.pop("metricas_inicio", None)
+        if inicio is not None:
+            observar("consignacoes_requisicao_segundos", time.perf_counter() - inicio)
+        token = g.pop("metricas_token", None)
+        if token is not None:
+            restaurar_endpoint(token)
+
+    @app.route("/api/metrics")
+    def metricas():
+        return Response(exportar_prometheus(), mimetype="text/plain; version=0.0.4")
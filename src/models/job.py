@@ -0,0 +1,53 @@
+import json
+from src.extensions import db
+from datetime import datetime
+
+class Job(db.Model):
+    __tablename__ = 'jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(50), nullable=False) # SINCRONIZACAO_MAINO, IMPORTACAO_XML, RECONSTRUCAO_SALDOS
+    status = db.Column(db.String(20), nullable=False, default='PENDENTE', index=True) # PENDENTE, EXECUTANDO, CONCLUIDO, ERRO
+    parametros = db.Column(db.Text) # JSON
+    documentos_buscados = db.Column(db.Integer, default=0)
+    documentos_processados = db.Column(db.Integer, default=0) # XMLs interpretados
+    documentos_persistidos = db.Column(db.Integer, default=0)
+    erros = db.Column(db.Text) # JSON (lista de mensagens)
+    resultado = db.Column(db.Text) # JSON
+    criado_em = db.Column(db.DateTime, default=datetime.utcnow)
+    iniciado_em = db.Column(db.DateTime)
+    atualizado_em = db.Column(db.DateTime) # Heartbeat do worker, usado para detectar jobs órfãos
+    finalizado_em = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.tipo} - {self.status}>'
+
+    def get_parametros(self):
+        return json.loads(self.parametros) if self.parametros else {}
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'tipo': self.tipo,
+            'status': self.status,
+            'documentos_buscados': self.documentos_buscados or 0,
+            'documentos_processados': self.documentos_processados or 0,
+            'documentos_persistidos': self.documentos_persistidos or 0,
+            'erros': json.loads(self.erros) if self.erros else [],
+            'resultado': json.loads(self.resultado) if self.resultado else None,
+            'criado_em': self.criado_em.isoformat() if self.criado_em else None,
+            'iniciado_em': self.iniciado_em.isoformat() if self.iniciado_em else None,
+            'finalizado_em': self.finalizado_em.isoformat() if self.finalizado_em else None
+        }
+
+
+class ArquivoImportacao(db.Model):
+    # ZIP enviado para /importar-xmls, guardado no banco até o job de importação rodar:
+    # o job pode ser executado por outra instância, que não enxerga o disco local da web
+    __tablename__ = 'arquivos_importacao'
+    id = db.Column(db.Integer, primary_key=True)
+    nome = db.Column(db.String(255))
+    conteudo = db.Column(db.LargeBinary, nullable=False)
+    criado_em = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<ArquivoImportacao {self.id} {self.nome}>'
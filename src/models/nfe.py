@@ -1,8 +1,23 @@
+import gzip
+import os
+import zlib
 from src.extensions import db
+from src.models.tipos import Quantidade, ValorUnitario, Valor
 from datetime import datetime
 
+try:
+    import zstandard
+except ImportError: # Dependência opcional: sem ela o XML é comprimido com gzip
+    zstandard = None
+
+COMPRESSAO_XML = os.getenv("XML_COMPRESSAO", "zstd" if zstandard else "gzip")
+TAMANHO_BLOCO_XML = 64 * 1024
+
 class NotaFiscal(db.Model):
     __tablename__ = 'notas_fiscais'
+    __table_args__ = (
+        db.Index('ix_notas_fiscais_tipo_operacao_data_emissao', 'tipo_operacao', 'data_emissao'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     numero_nf = db.Column(db.String(20), nullable=False)
     serie = db.Column(db.String(5))
@@ -12,29 +27,88 @@ class NotaFiscal(db.Model):
     cfop = db.Column(db.String(4), nullable=False)
     tipo_operacao = db.Column(db.String(50), nullable=False) # SAIDA, ENTRADA_RETORNO, ENTRADA_DEVOLUCAO, ENTRADA_VENDA
     data_emissao = db.Column(db.DateTime, default=datetime.utcnow)
-    xml_content = db.Column(db.Text) # Armazenar o XML completo
+    # XML completo fica comprimido em xml_notas_fiscais e só é lido quando acessado
+    xml = db.relationship('XmlNotaFiscal', uselist=False, lazy='select', cascade='all, delete-orphan')
 
     itens = db.relationship('ItemNotaFiscal', backref='nota_fiscal', lazy=True)
 
+    @property
+    def xml_content(self):
+        return self.xml.texto() if self.xml else None
+
+    @xml_content.setter
+    def xml_content(self, texto):
+        self.xml = XmlNotaFiscal.comprimir(texto) if texto is not None else None
+
     def __repr__(self):
         return f'<NotaFiscal {self.numero_nf} - {self.nome_destinatario}>'
 
+class XmlNotaFiscal(db.Model):
+    __tablename__ = 'xml_notas_fiscais'
+    nota_fiscal_id = db.Column(db.Integer, db.ForeignKey('notas_fiscais.id'), primary_key=True)
+    compressao = db.Column(db.String(10), nullable=False) # zstd ou gzip
+    tamanho_original = db.Column(db.Integer, nullable=False) # Bytes do XML em UTF-8
+    conteudo = db.Column(db.LargeBinary, nullable=False)
+
+    @classmethod
+    def comprimir(cls, texto, nota_fiscal_id=None):
+        return cls(nota_fiscal_id=nota_fiscal_id, **cls.valores_comprimidos(texto))
+
+    @staticmethod
+    def valores_comprimidos(texto):
+        # Colunas comprimidas para inserção em massa (sem nota_fiscal_id)
+        dados = texto.encode("utf-8") if isinstance(texto, str) else texto
+        if COMPRESSAO_XML == "zstd":
+            conteudo = zstandard.ZstdCompressor(level=10).compress(dados)
+        else:
+            conteudo = gzip.compress(dados, compresslevel=9)
+        return {"compressao": COMPRESSAO_XML, "tamanho_original": len(dados), "conteudo": conteudo}
+
+    def texto(self):
+        return b"".join(self.iter_blocos()).decode("utf-8")
+
+    def iter_blocos(self):
+        # Descompressão incremental, para devolver o XML em streaming
+        if self.compressao == "zstd":
+            if zstandard is None:
+                raise RuntimeError("XML comprimido com zstd, mas o pacote 'zstandard' não está instalado.")
+            yield from zstandard.ZstdDecompressor().read_to_iter(self.conteudo, read_size=TAMANHO_BLOCO_XML)
+            return
+        descompressor = zlib.decompressobj(wbits=31) # 31 = formato gzip
+        for inicio in range(0, len(self.conteudo), TAMANHO_BLOCO_XML):
+            yield descompressor.decompress(self.conteudo[inicio:inicio + TAMANHO_BLOCO_XML])
+        yield descompressor.flush()
+
+    def __repr__(self):
+        return f'<XmlNotaFiscal {self.nota_fiscal_id} - {self.compressao} {len(self.conteudo)}/{self.tamanho_original} bytes>'
+
 class ItemNotaFiscal(db.Model):
     __tablename__ = 'itens_nota_fiscal'
+    __table_args__ = (
+        db.Index('ix_itens_nota_fiscal_nota_fiscal_id', 'nota_fiscal_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     nota_fiscal_id = db.Column(db.Integer, db.ForeignKey('notas_fiscais.id'), nullable=False)
     codigo_produto = db.Column(db.String(50), nullable=False)
     descricao_produto = db.Column(db.String(255), nullable=False)
     numero_lote = db.Column(db.String(50))
-    quantidade = db.Column(db.Float, nullable=False)
-    valor_unitario = db.Column(db.Float)
-    valor_total = db.Column(db.Float)
+    quantidade = db.Column(Quantidade, nullable=False)
+    valor_unitario = db.Column(ValorUnitario)
+    valor_total = db.Column(Valor)
 
     def __repr__(self):
         return f'<ItemNF {self.codigo_produto} - {self.quantidade}>'
 
 class EstoqueConsignacao(db.Model):
     __tablename__ = 'estoque_consignacao'
+    __table_args__ = (
+        # Consultas por destinatário e validação de faturamento (cnpj + produto + lote)
+        db.Index('ix_estoque_consignacao_cnpj_produto_lote', 'cnpj_destinatario', 'codigo_produto', 'numero_lote'),
+        # Consultas por produto
+        db.Index('ix_estoque_consignacao_produto_lote', 'codigo_produto', 'numero_lote'),
+        # Baixa das entradas contra a NF de saída referenciada
+        db.Index('ix_estoque_consignacao_nf_saida_produto_lote', 'nf_saida_id', 'codigo_produto', 'numero_lote'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     codigo_produto = db.Column(db.String(50), nullable=False)
     descricao_produto = db.Column(db.String(255), nullable=False)
@@ -42,14 +116,36 @@ class EstoqueConsignacao(db.Model):
     cnpj_destinatario = db.Column(db.String(14), nullable=False)
     nome_destinatario = db.Column(db.String(255), nullable=False)
     # Saldo agora é específico para a NF de saída
-    quantidade_consignada_nf = db.Column(db.Float, default=0.0) # Quantidade original enviada nesta NF
-    quantidade_retornada_nf = db.Column(db.Float, default=0.0) # Quantidade retornada desta NF
-    quantidade_faturada_nf = db.Column(db.Float, default=0.0) # Quantidade faturada desta NF
-    saldo_disponivel_nf = db.Column(db.Float, default=0.0) # Saldo restante desta NF
+    quantidade_consignada_nf = db.Column(Quantidade, default=0) # Quantidade original enviada nesta NF
+    quantidade_retornada_nf = db.Column(Quantidade, default=0) # Quantidade retornada desta NF
+    quantidade_faturada_nf = db.Column(Quantidade, default=0) # Quantidade faturada desta NF
+    saldo_disponivel_nf = db.Column(Quantidade, default=0) # Saldo restante desta NF
 
     nf_saida_id = db.Column(db.Integer, db.ForeignKey('notas_fiscais.id'), nullable=False) # Link para a NF de saída
+    versao = db.Column(db.Integer, nullable=False, default=0, server_default='0') # Incrementada a cada baixa (controle otimista)
 
     def __repr__(self):
         return f'<Estoque NF {self.nf_saida_id} - {self.codigo_produto} - {self.cnpj_destinatario} - Saldo: {self.saldo_disponivel_nf}>'
 
 
+
+class MovimentoEstoque(db.Model):
+    # Razão de movimentos: só recebe INSERTs. EstoqueConsignacao é o saldo acumulado
+    # (snapshot) desses movimentos e pode ser recalculado a partir daqui.
+    __tablename__ = 'movimentos_estoque'
+    __table_args__ = (
+        db.Index('ix_movimentos_estoque_estoque_id', 'estoque_id'),
+        # Saldos em uma data (as-of)
+        db.Index('ix_movimentos_estoque_data_movimento', 'data_movimento'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    estoque_id = db.Column(db.Integer, db.ForeignKey('estoque_consignacao.id'), nullable=False)
+    nota_fiscal_id = db.Column(db.Integer, db.ForeignKey('notas_fiscais.id')) # NF que gerou o movimento
+    item_nota_fiscal_id = db.Column(db.Integer, db.ForeignKey('itens_nota_fiscal.id'))
+    tipo_operacao = db.Column(db.String(50), nullable=False) # SAIDA soma ao consignado; as entradas baixam o saldo
+    quantidade = db.Column(Quantidade, nullable=False) # Sempre positiva; o sentido vem do tipo_operacao
+    data_movimento = db.Column(db.DateTime, nullable=False) # Emissão da NF
+    criado_em = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<MovimentoEstoque {self.tipo_operacao} - Estoque {self.estoque_id} - {self.quantidade}>'
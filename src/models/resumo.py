@@ -0,0 +1,36 @@
+from src.extensions import db
+from src.models.tipos import Quantidade
+
+# Agregados mantidos incrementalmente por EstoqueService a cada NF-e gravada (ver ResumoService)
+
+class ResumoEstoque(db.Model):
+    __tablename__ = 'resumo_estoque'
+    id = db.Column(db.Integer, primary_key=True) # Linha única (id = 1)
+    total_produtos = db.Column(db.Integer, nullable=False, default=0)
+    total_destinatarios = db.Column(db.Integer, nullable=False, default=0)
+    saldo_total_disponivel = db.Column(Quantidade, nullable=False, default=0)
+    produtos_saldo_baixo = db.Column(db.Integer, nullable=False, default=0) # Registros com 0 < saldo < limite
+    limite_saldo_baixo = db.Column(Quantidade, nullable=False) # Limite usado no cálculo acima
+
+    def __repr__(self):
+        return f'<ResumoEstoque Produtos: {self.total_produtos} - Saldo: {self.saldo_total_disponivel}>'
+
+class ResumoProduto(db.Model):
+    __tablename__ = 'resumo_produto'
+    codigo_produto = db.Column(db.String(50), primary_key=True)
+    saldo_disponivel = db.Column(Quantidade, nullable=False, default=0)
+    linhas = db.Column(db.Integer, nullable=False, default=0) # Registros de estoque (um por NF de saída)
+    linhas_saldo_baixo = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<ResumoProduto {self.codigo_produto} - Saldo: {self.saldo_disponivel}>'
+
+class ResumoDestinatario(db.Model):
+    __tablename__ = 'resumo_destinatario'
+    cnpj_destinatario = db.Column(db.String(14), primary_key=True)
+    nome_destinatario = db.Column(db.String(255), nullable=False)
+    saldo_disponivel = db.Column(Quantidade, nullable=False, default=0)
+    linhas = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<ResumoDestinatario {self.cnpj_destinatario} - Saldo: {self.saldo_disponivel}>'
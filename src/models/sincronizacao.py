@@ -0,0 +1,26 @@
+from src.extensions import db
+
+class SincronizacaoMaino(db.Model):
+    __tablename__ = 'sincronizacao_maino'
+    id = db.Column(db.Integer, primary_key=True)
+    # Maior data de emissão já persistida a partir do Mainô (marca d'água)
+    ultima_data_emissao = db.Column(db.DateTime)
+    # Janela da última listagem e a última página lida nela, para retomar a paginação
+    data_inicial_janela = db.Column(db.Date)
+    ultima_pagina = db.Column(db.Integer, default=1)
+    ultima_sincronizacao = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<SincronizacaoMaino {self.ultima_data_emissao} - Página {self.ultima_pagina}>'
+
+class FalhaSincronizacao(db.Model):
+    # NF-es listadas no Mainô que não foram gravadas; seguram a marca d'água até o limite de tentativas
+    __tablename__ = 'falhas_sincronizacao'
+    chave_acesso = db.Column(db.String(44), primary_key=True)
+    data_emissao = db.Column(db.DateTime) # Desconhecida se o XML não foi baixado ou interpretado
+    tentativas = db.Column(db.Integer, nullable=False, default=0)
+    ultimo_erro = db.Column(db.Text)
+    atualizado_em = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<FalhaSincronizacao {self.chave_acesso} - {self.tentativas} tentativas>'
@@ -0,0 +1,32 @@
+from decimal import Decimal, ROUND_HALF_EVEN
+from src.extensions import db
+
+class DecimalFixo(db.TypeDecorator):
+    """Decimal exato gravado como inteiro escalado (ex.: 4 casas -> 1.5 é gravado como 15000).
+
+    Soma, subtração e comparação no banco viram aritmética inteira, exata e
+    igual em SQLite e PostgreSQL; no Python os valores chegam como Decimal.
+    """
+    impl = db.BigInteger
+    cache_ok = True
+
+    def __init__(self, casas, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.casas = casas
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if not isinstance(value, Decimal):
+            value = Decimal(str(value)) # str evita herdar o erro binário de um float
+        return int(value.scaleb(self.casas).to_integral_value(rounding=ROUND_HALF_EVEN))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return Decimal(int(value)).scaleb(-self.casas)
+
+# Escalas usadas no estoque: qCom tem até 4 casas, vUnCom até 10 e vProd 2 (leiaute da NF-e)
+Quantidade = DecimalFixo(4)
+ValorUnitario = DecimalFixo(10)
+Valor = DecimalFixo(2)
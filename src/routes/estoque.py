@@ -1,15 +1,30 @@
-from flask import Blueprint, request, jsonify
+import csv
+import hashlib
+import io
+import json
+import os
+import tempfile
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from flask import Blueprint, Response, current_app, request, jsonify, stream_with_context
 from src.services.xml_processor import XMLProcessor
 from src.services.estoque_service import EstoqueService
-from src.services.maino_api import MainoAPI
+from src.services.maino_api import get_maino_api
+from src.services.sincronizacao_service import SincronizacaoService
+from src.services.job_service import JobService
+from src.services.importacao_service import ImportacaoService
 from src.models.nfe import NotaFiscal
-from datetime import datetime, timedelta
 
 estoque_bp = Blueprint("estoque", __name__)
 
 xml_processor = XMLProcessor()
 estoque_service = EstoqueService()
-maino_api = MainoAPI()
+job_service = JobService()
+importacao_service = ImportacaoService(xml_processor, estoque_service)
+
+# Paginação das consultas de saldo
+LIMITE_PADRAO_SALDOS = int(os.getenv("SALDOS_LIMITE_PADRAO", 500))
+LIMITE_MAXIMO_SALDOS = int(os.getenv("SALDOS_LIMITE_MAXIMO", 5000))
 
 @estoque_bp.route("/teste", methods=["GET"])
 def teste():
@@ -17,8 +32,22 @@ def teste():
 
 @estoque_bp.route("/resumo", methods=["GET"])
 def resumo():
-    resumo_data = estoque_service.get_resumo_estoque()
-    return jsonify(resumo_data)
+    return _resposta_condicional(jsonify(_com_valores_exatos(estoque_service.get_resumo_estoque())))
+
+@estoque_bp.route("/resumo/produtos", methods=["GET"])
+def resumo_produtos():
+    limite = min(request.args.get("limite", 100, type=int), LIMITE_MAXIMO_SALDOS)
+    apenas_saldo_baixo = request.args.get("apenas_saldo_baixo", "false").lower() == "true"
+    return _resposta_condicional(jsonify({
+        "produtos": _com_valores_exatos(estoque_service.resumo_service.get_resumo_produtos(apenas_saldo_baixo, limite))
+    }))
+
+@estoque_bp.route("/resumo/destinatarios", methods=["GET"])
+def resumo_destinatarios():
+    limite = min(request.args.get("limite", 100, type=int), LIMITE_MAXIMO_SALDOS)
+    return _resposta_condicional(jsonify({
+        "destinatarios": _com_valores_exatos(estoque_service.resumo_service.get_resumo_destinatarios(limite))
+    }))
 
 @estoque_bp.route("/processar-xml", methods=["POST"])
 def processar_xml():
@@ -36,11 +65,6 @@ def processar_xml():
     
     # Adiciona o XML content aos dados da NF-e
     resultado_xml["dados_nfe"]["xml_content"] = xml_content
-
-    # Tenta extrair a chave de acesso da NF de saída referenciada do XML
-    nf_saida_referenciada_chave_acesso = xml_processor.extract_referenced_nfe_chave_acesso(xml_content)
-    if nf_saida_referenciada_chave_acesso:
-        resultado_xml["dados_nfe"]["nf_saida_referenciada_chave_acesso"] = nf_saida_referenciada_chave_acesso
     
     # Salva no banco de dados
     try:
@@ -62,15 +86,221 @@ def processar_xml():
         "nfe_id": resultado_estoque["nfe_id"]
     })
 
+@estoque_bp.route("/nfe/<chave_acesso>/xml", methods=["GET"])
+def xml_nfe(chave_acesso):
+    xml = estoque_service.get_xml_nfe(chave_acesso)
+    if not xml:
+        return jsonify({"sucesso": False, "erro": "XML da NF-e não encontrado"}), 404
+    # Descomprime e envia em blocos, sem montar o XML inteiro em memória
+    return Response(
+        stream_with_context(xml.iter_blocos()),
+        mimetype="application/xml",
+        headers={"Content-Disposition": f'attachment; filename="{chave_acesso}.xml"'}
+    )
+
 @estoque_bp.route("/saldo-destinatario/<cnpj>", methods=["GET"])
 def saldo_destinatario(cnpj):
-    saldos = estoque_service.get_saldo_por_destinatario(cnpj)
-    return jsonify({"saldos": saldos})
+    try:
+        filtros, limite = _filtros_saldo()
+    except ValueError as e:
+        return jsonify({"sucesso": False, "erro": str(e)}), 400
+    return _resposta_saldos(lambda: estoque_service.get_saldo_por_destinatario(cnpj, limite=limite + 1, **filtros), limite)
 
 @estoque_bp.route("/saldo-produto/<codigo_produto>", methods=["GET"])
 def saldo_produto(codigo_produto):
-    saldos = estoque_service.get_saldo_por_produto(codigo_produto)
-    return jsonify({"saldos": saldos})
+    try:
+        filtros, limite = _filtros_saldo()
+    except ValueError as e:
+        return jsonify({"sucesso": False, "erro": str(e)}), 400
+    return _resposta_saldos(lambda: estoque_service.get_saldo_por_produto(codigo_produto, limite=limite + 1, **filtros), limite)
+
+def _filtros_saldo():
+    # Parâmetros de consulta comuns: ?apenas_com_saldo=true&lote=&data_inicio=AAAA-MM-DD&data_fim=&apos_id=&limite=
+    limite = min(request.args.get("limite", LIMITE_PADRAO_SALDOS, type=int), LIMITE_MAXIMO_SALDOS)
+    if limite < 1:
+        raise ValueError("O limite deve ser maior que zero")
+    data_inicio = request.args.get("data_inicio")
+    data_fim = request.args.get("data_fim")
+    filtros = {
+        "apenas_com_saldo": request.args.get("apenas_com_saldo", "false").lower() == "true",
+        "numero_lote": request.args.get("lote"),
+        "data_inicio": datetime.strptime(data_inicio, "%Y-%m-%d") if data_inicio else None,
+        "data_fim": datetime.strptime(data_fim, "%Y-%m-%d") if data_fim else None,
+        "apos_id": request.args.get("apos_id", type=int)
+    }
+    return filtros, limite
+
+def _resposta_condicional(resposta, etag=None):
+    # ETag = hash do corpo: não depende do estado do cache deste processo, então uma escrita
+    # feita em outro worker muda a ETag em todos; o 304 só economiza a transferência
+    if etag:
+        resposta.set_etag(etag)
+    else:
+        resposta.add_etag()
+    resposta.headers["Cache-Control"] = "no-cache" # O navegador sempre revalida com If-None-Match
+    return resposta.make_conditional(request)
+
+def _resposta_saldos(buscar_saldos, limite):
+    """Página de saldos serializada linha a linha; "proximo_cursor" vai no final.
+
+    `buscar_saldos` devolve as linhas a cada chamada (a lista do cache ou um
+    novo cursor). A primeira passagem só alimenta o hash da ETag, sem guardar
+    o corpo; a segunda é enviada em streaming (e nem roda quando a resposta
+    é um 304).
+    """
+    def gerar():
+        yield '{"saldos": ['
+        ultimo_id = None
+        proximo_cursor = None
+        for posicao, saldo in enumerate(buscar_saldos()):
+            if posicao == limite:
+                # Há uma linha além do limite: existe próxima página
+                proximo_cursor = ultimo_id
+                break
+            yield ("," if posicao else "") + current_app.json.dumps(_com_valores_exatos(saldo), ensure_ascii=False)
+            ultimo_id = saldo["id"]
+        yield '], "proximo_cursor": ' + json.dumps(proximo_cursor) + '}'
+
+    hash_corpo = hashlib.sha1()
+    for parte in gerar():
+        hash_corpo.update(parte.encode())
+    return _resposta_condicional(
+        Response(stream_with_context(gerar()), mimetype="application/json"),
+        etag=hash_corpo.hexdigest()
+    )
+
+def _com_valores_exatos(dados):
+    # Quantidades seguem como número JSON; "<campo>_exato" traz o Decimal em string, sem arredondamento de float
+    if isinstance(dados, list):
+        return [_com_valores_exatos(item) for item in dados]
+    if not isinstance(dados, dict):
+        return dados
+    resultado = {}
+    for campo, valor in dados.items():
+        resultado[campo] = _com_valores_exatos(valor)
+        if isinstance(valor, Decimal):
+            resultado[f"{campo}_exato"] = str(valor)
+    return resultado
+
+@estoque_bp.route("/saldo-em", methods=["GET"])
+def saldo_em():
+    # Posição em uma data, a partir dos movimentos: ?data=AAAA-MM-DD&cnpj=&produto=
+    try:
+        data_referencia = datetime.strptime(request.args["data"], "%Y-%m-%d").date()
+    except (KeyError, ValueError):
+        return jsonify({"sucesso": False, "erro": "Informe a data no formato AAAA-MM-DD"}), 400
+    saldos = estoque_service.get_saldos_em(
+        data_referencia,
+        cnpj_destinatario=request.args.get("cnpj"),
+        codigo_produto=request.args.get("produto")
+    )
+    return jsonify(_com_valores_exatos({
+        "data_referencia": data_referencia.isoformat(),
+        "saldo_total_disponivel": sum((s["saldo_disponivel"] for s in saldos), Decimal(0)),
+        "saldos": saldos
+    }))
+
+@estoque_bp.route("/aging", methods=["GET"])
+def aging():
+    # Saldo por idade da NF de saída (atual, ou ao fim de data_referencia): ?agrupar=destinatario|produto|lote&cnpj=&produto=&data_referencia=
+    try:
+        data_referencia = request.args.get("data_referencia")
+        resultado = estoque_service.get_aging(
+            agrupar=request.args.get("agrupar", "destinatario"),
+            cnpj=request.args.get("cnpj"),
+            codigo_produto=request.args.get("produto"),
+            data_referencia=datetime.strptime(data_referencia, "%Y-%m-%d").date() if data_referencia else None
+        )
+    except ValueError as e:
+        return jsonify({"sucesso": False, "erro": str(e)}), 400
+    return jsonify(_com_valores_exatos(resultado))
+
+# Colunas da exportação de posições: (cabeçalho, campo de EstoqueService.iter_posicoes)
+COLUNAS_EXPORTACAO = [
+    ("CNPJ Destinatário", "cnpj_destinatario"),
+    ("Destinatário", "nome_destinatario"),
+    ("Código Produto", "codigo_produto"),
+    ("Descrição", "descricao_produto"),
+    ("Lote", "numero_lote"),
+    ("NF Saída", "nf_saida_numero"),
+    ("Data Emissão NF Saída", "nf_saida_data_emissao"),
+    ("Qtd Consignada", "quantidade_consignada_nf"),
+    ("Qtd Retornada", "quantidade_retornada_nf"),
+    ("Qtd Faturada", "quantidade_faturada_nf"),
+    ("Saldo Disponível", "saldo_disponivel_nf"),
+]
+
+@estoque_bp.route("/exportar-posicoes", methods=["GET"])
+def exportar_posicoes():
+    # ?formato=csv|xlsx&cnpj=&produto=&data_inicio=AAAA-MM-DD&data_fim=&apenas_com_saldo=true
+    formato = request.args.get("formato", "csv").lower()
+    try:
+        data_inicio = request.args.get("data_inicio")
+        data_fim = request.args.get("data_fim")
+        filtros = {
+            "cnpj": request.args.get("cnpj"),
+            "codigo_produto": request.args.get("produto"),
+            "apenas_com_saldo": request.args.get("apenas_com_saldo", "false").lower() == "true",
+            "data_inicio": datetime.strptime(data_inicio, "%Y-%m-%d") if data_inicio else None,
+            "data_fim": datetime.strptime(data_fim, "%Y-%m-%d") if data_fim else None
+        }
+    except ValueError as e:
+        return jsonify({"sucesso": False, "erro": str(e)}), 400
+    nome_arquivo = f"posicoes-consignacao-{datetime.now():%Y%m%d}"
+
+    if formato == "xlsx":
+        return _exportar_xlsx(estoque_service.iter_posicoes(**filtros), nome_arquivo)
+    if formato != "csv":
+        return jsonify({"sucesso": False, "erro": "Formato deve ser csv ou xlsx"}), 400
+
+    def gerar():
+        buffer = io.StringIO()
+        escritor = csv.writer(buffer)
+        buffer.write("\ufeff") # BOM: o Excel reconhece o UTF-8 (acentos)
+        escritor.writerow([cabecalho for cabecalho, _ in COLUNAS_EXPORTACAO])
+        for posicao, linha in enumerate(estoque_service.iter_posicoes(**filtros), start=1):
+            escritor.writerow([linha[campo] for _, campo in COLUNAS_EXPORTACAO])
+            if posicao % 500 == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    return Response(
+        stream_with_context(gerar()),
+        mimetype="text/csv; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="{nome_arquivo}.csv"'}
+    )
+
+def _exportar_xlsx(posicoes, nome_arquivo):
+    try:
+        from openpyxl import Workbook
+    except ImportError: # Dependência opcional
+        return jsonify({"sucesso": False, "erro": "Exportação XLSX requer o pacote openpyxl; use formato=csv"}), 400
+
+    # write_only grava as linhas em disco à medida que chegam; o arquivo final é enviado em blocos
+    planilha = Workbook(write_only=True)
+    aba = planilha.create_sheet("Posições")
+    aba.append([cabecalho for cabecalho, _ in COLUNAS_EXPORTACAO])
+    for linha in posicoes:
+        aba.append([linha[campo] for _, campo in COLUNAS_EXPORTACAO])
+    arquivo = tempfile.TemporaryFile()
+    planilha.save(arquivo)
+    arquivo.seek(0)
+
+    def gerar():
+        with arquivo:
+            while True:
+                bloco = arquivo.read(64 * 1024)
+                if not bloco:
+                    break
+                yield bloco
+
+    return Response(
+        gerar(),
+        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        headers={"Content-Disposition": f'attachment; filename="{nome_arquivo}.xlsx"'}
+    )
 
 @estoque_bp.route("/validar-faturamento", methods=["POST"])
 def validar_faturamento():
@@ -80,120 +310,147 @@ def validar_faturamento():
     
     if not cnpj_destinatario or not itens:
         return jsonify({"sucesso": False, "erro": "CNPJ do destinatário e itens são obrigatórios"}), 400
+
+    # "alocar" aceita booleano JSON ou "true"/"false" (a string "false" não pode virar verdadeiro)
+    alocar = data.get("alocar", False)
+    if isinstance(alocar, str) and alocar.lower() in ("true", "false"):
+        alocar = alocar.lower() == "true"
+    if not isinstance(alocar, bool):
+        return jsonify({"sucesso": False, "erro": "alocar deve ser true ou false"}), 400
+
+    try:
+        resultado = estoque_service.validar_disponibilidade_faturamento(cnpj_destinatario, itens, alocar=alocar)
+    except ValueError as e:
+        return jsonify({"sucesso": False, "erro": str(e)}), 400
+    return jsonify(_com_valores_exatos(resultado))
+
+@estoque_bp.route("/importar-xmls", methods=["POST"])
+def importar_xmls():
+    # Aceita um JSON {"xmls": [...]} ou um arquivo ZIP enviado no campo "arquivo"
+    arquivo = request.files.get("arquivo")
+    if arquivo:
+        if not arquivo.filename.lower().endswith(".zip"):
+            return jsonify({"sucesso": False, "erro": "O arquivo enviado deve ser um ZIP de XMLs"}), 400
+        parametros = {
+            "arquivo_id": importacao_service.guardar_arquivo(arquivo.filename, arquivo.read()),
+            "workers": request.form.get("workers", type=int),
+            "perfilar": request.form.get("perfilar", "false").lower() == "true"
+        }
+    else:
+        data = request.get_json(silent=True) or {}
+        xmls = data.get("xmls") or []
+        if not xmls:
+            return jsonify({"sucesso": False, "erro": "Lista de XMLs ou arquivo ZIP não fornecido"}), 400
+        parametros = {"xmls": xmls, "workers": data.get("workers"), "perfilar": data.get("perfilar", False)}
     
-    resultado = estoque_service.validar_disponibilidade_faturamento(cnpj_destinatario, itens)
-    return jsonify(resultado)
+    job = job_service.enfileirar("IMPORTACAO_XML", parametros)
+    return jsonify({"sucesso": True, "job_id": job.id, "status": job.status}), 202
 
 @estoque_bp.route("/sincronizar-maino", methods=["POST"])
 def sincronizar_maino():
     data = request.get_json()
-    dias_atras = data.get("dias_atras", 7)
     
     try:
-        # Testa a conexão
-        teste_conexao = maino_api.test_connection()
+        # Testa a conexão antes de enfileirar, para falhar rápido com credenciais inválidas
+        teste_conexao = get_maino_api().test_connection()
         if not teste_conexao["sucesso"]:
             return jsonify(teste_conexao), 400
         
-        # Busca NF-es emitidas do período
-        end_date = datetime.now()
-        start_date = end_date - timedelta(days=dias_atras)
-        resultado_nfes = maino_api.get_nfes_emitidas(start_date, end_date)
-
-        if not resultado_nfes["sucesso"]:
-            return jsonify(resultado_nfes), 400
-        
-        nfes_para_processar = resultado_nfes["nfes"]
-        
-        xmls_processados = 0
-        nfes_saida = 0
-        nfes_entrada = 0
-        erros = []
-        
-        for nfe_item in nfes_para_processar:
-            chave_acesso = nfe_item.get("chaveAcesso")
-            if not chave_acesso:
-                erros.append(f"NF-e sem chave de acesso: {nfe_item.get("numero")}")
-                continue
-
-            # Busca o XML completo da NF-e
-            resultado_xml_completo = maino_api.get_nfe_xml_by_chave(chave_acesso)
-            if not resultado_xml_completo["sucesso"]:
-                erros.append(f"Erro ao buscar XML da NF-e {chave_acesso}: {resultado_xml_completo["erro"]}")
-                continue
-            xml_content = resultado_xml_completo["xml_content"]
-
-            # Processa o XML
-            resultado_xml = xml_processor.parse_nfe_xml(xml_content)
-            
-            if resultado_xml["sucesso"]:
-                # Adiciona o XML content aos dados da NF-e
-                resultado_xml["dados_nfe"]["xml_content"] = xml_content
-
-                # Tenta extrair a chave de acesso da NF de saída referenciada do XML
-                nf_saida_referenciada_chave_acesso = xml_processor.extract_referenced_nfe_chave_acesso(xml_content)
-                if nf_saida_referenciada_chave_acesso:
-                    resultado_xml["dados_nfe"]["nf_saida_referenciada_chave_acesso"] = nf_saida_referenciada_chave_acesso
-                
-                # Salva no banco de dados
-                try:
-                    resultado_estoque = estoque_service.processar_nfe(
-                        resultado_xml["dados_nfe"], 
-                        resultado_xml["tipo_operacao"]
-                    )
-                except ValueError as e:
-                    erros.append(f"NF {resultado_xml["dados_nfe"]["numero_nf"]}: {str(e)}")
-                    continue
-                
-                if resultado_estoque["sucesso"]:
-                    xmls_processados += 1
-                    if resultado_xml["tipo_operacao"] == "SAIDA":
-                        nfes_saida += 1
-                    else:
-                        nfes_entrada += 1
-                else:
-                    erros.append(f"NF {resultado_xml["dados_nfe"]["numero_nf"]}: {resultado_estoque["erro"]}")
-            else:
-                erros.append(f"Erro ao processar XML: {resultado_xml["erro"]}")
-        
-        return jsonify({
-            "sucesso": True,
-            "nfes_encontradas": len(nfes_para_processar),
-            "nfes_processadas": xmls_processados,
-            "nfes_saida": nfes_saida,
-            "nfes_entrada": nfes_entrada,
-            "erros": erros
+        job = job_service.enfileirar("SINCRONIZACAO_MAINO", {
+            "dias_atras": data.get("dias_atras", 7),
+            "completo": data.get("completo", False),
+            "concorrencia": data.get("concorrencia"),
+            "perfilar": data.get("perfilar", False) # Resumo do cProfile no resultado do job
         })
+        return jsonify({"sucesso": True, "job_id": job.id, "status": job.status}), 202
         
     except ValueError as e:
         return jsonify({"sucesso": False, "erro": str(e)}), 400
     except Exception as e:
         return jsonify({"sucesso": False, "erro": f"Erro interno: {e}"}), 500
 
+@estoque_bp.route("/reconstruir-saldos", methods=["POST"])
+def reconstruir_saldos():
+    # Recalcula os saldos de estoque a partir de movimentos_estoque, em segundo plano.
+    # {"limite_saldo_baixo": n} troca o limite de saldo baixo usado pelo resumo
+    data = request.get_json(silent=True) or {}
+    parametros = {}
+    if data.get("limite_saldo_baixo") is not None:
+        try:
+            limite = Decimal(str(data["limite_saldo_baixo"]))
+        except InvalidOperation:
+            limite = None
+        if limite is None or not limite.is_finite() or limite < 0:
+            return jsonify({"sucesso": False, "erro": "limite_saldo_baixo deve ser um número não negativo"}), 400
+        parametros["limite_saldo_baixo"] = str(limite)
+    job = job_service.enfileirar("RECONSTRUCAO_SALDOS", parametros)
+    return jsonify({"sucesso": True, "job_id": job.id, "status": job.status}), 202
+
+@estoque_bp.route("/jobs/<int:job_id>", methods=["GET"])
+def status_job(job_id):
+    job = job_service.get_job(job_id)
+    if not job:
+        return jsonify({"sucesso": False, "erro": "Job não encontrado"}), 404
+    return jsonify(job.to_dict())
+
+def _job_sincronizar_maino(parametros, progresso):
+    sincronizacao = SincronizacaoService(
+        get_maino_api(),
+        xml_processor,
+        estoque_service,
+        concorrencia=parametros.get("concorrencia")
+    )
+    return sincronizacao.executar(
+        parametros.get("dias_atras", 7),
+        completo=parametros.get("completo", False),
+        progresso=progresso
+    )
+
+def _job_importar_xmls(parametros, progresso):
+    return importacao_service.importar(
+        xmls=parametros.get("xmls"),
+        arquivo_id=parametros.get("arquivo_id"),
+        arquivo_zip=parametros.get("arquivo_zip"), # Jobs enfileirados antes do ZIP ir para o banco
+        progresso=progresso,
+        workers=parametros.get("workers")
+    )
+
+def _job_reconstruir_saldos(parametros, progresso):
+    return estoque_service.reconstruir_saldos(parametros.get("limite_saldo_baixo"))
+
+job_service.registrar("SINCRONIZACAO_MAINO", _job_sincronizar_maino)
+job_service.registrar("IMPORTACAO_XML", _job_importar_xmls)
+job_service.registrar("RECONSTRUCAO_SALDOS", _job_reconstruir_saldos)
+
 @estoque_bp.route("/status-integracao", methods=["GET"])
 def status_integracao():
     try:
-        teste_conexao = maino_api.test_connection()
+        teste_conexao = get_maino_api().test_connection()
         
         return jsonify({
             "integração_configurada": True,
             "conexao_api": teste_conexao["sucesso"],
-            "ultima_sincronizacao": None  # Pode ser implementado para armazenar a última sincronização
+            "ultima_sincronizacao": _ultima_sincronizacao()
         })
         
     except ValueError:
         return jsonify({
             "integração_configurada": False,
             "conexao_api": False,
-            "ultima_sincronizacao": None
+            "ultima_sincronizacao": _ultima_sincronizacao()
         })
     except Exception as e:
         return jsonify({
             "integração_configurada": True,
             "conexao_api": False,
             "erro": str(e),
-            "ultima_sincronizacao": None
+            "ultima_sincronizacao": _ultima_sincronizacao()
         })
 
+def _ultima_sincronizacao():
+    # Só lê o estado gravado: não precisa do cliente do Mainô (nem de credenciais)
+    ultima = SincronizacaoService(None, xml_processor, estoque_service).get_ultima_sincronizacao()
+    return ultima.isoformat() if ultima else None
+
 
 
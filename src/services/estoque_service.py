@@ -1,189 +1,824 @@
-from src.extensions import db
-from src.models.nfe import NotaFiscal, ItemNotaFiscal, EstoqueConsignacao
+import os
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal, InvalidOperation
+from src import metricas
+from src.cache import Cache
+from src.extensions import db, executar_leitura
+from src.models.nfe import NotaFiscal, XmlNotaFiscal, ItemNotaFiscal, EstoqueConsignacao, MovimentoEstoque
+from src.models.tipos import Quantidade
+from src.services.resumo_service import ResumoService
+from sqlalchemy import and_, bindparam, case, func, insert, or_, select, true, tuple_, update
 from sqlalchemy.exc import IntegrityError
 
+# Coluna do registro de estoque baixada por cada tipo de entrada
+COLUNA_BAIXA = {
+    "ENTRADA_RETORNO": "quantidade_retornada_nf",
+    "ENTRADA_DEVOLUCAO": "quantidade_retornada_nf", # Devolução simbólica também reduz o saldo consignado
+    "ENTRADA_VENDA": "quantidade_faturada_nf",
+}
+TIPOS_RETORNO = [tipo for tipo, coluna in COLUNA_BAIXA.items() if coluna == "quantidade_retornada_nf"]
+TIPOS_FATURAMENTO = [tipo for tipo, coluna in COLUNA_BAIXA.items() if coluna == "quantidade_faturada_nf"]
+
+
+# Faixas do aging por idade da NF de saída, em dias: (nome, idade mínima); a última não tem limite
+FAIXAS_AGING = [("0_30", 0), ("31_60", 31), ("61_90", 61), ("90_mais", 91)]
+
+# Agrupamentos do aging: colunas de agrupamento e colunas descritivas (max)
+AGRUPAMENTOS_AGING = {
+    "destinatario": (["cnpj_destinatario"], ["nome_destinatario"]),
+    "produto": (["codigo_produto"], ["descricao_produto"]),
+    "lote": (["cnpj_destinatario", "codigo_produto", "numero_lote"], ["nome_destinatario", "descricao_produto"]),
+}
+
+# Tags do cache de leitura: "estoque" invalida tudo; cada escrita invalida só os cnpjs/produtos afetados
+TAGS_RESUMO = ["estoque", "resumo"]
+
+
+class ConflitoConcorrencia(Exception):
+    """Outro processo alterou o registro de estoque entre a leitura e a baixa."""
+
 class EstoqueService:
     def __init__(self):
-        pass
+        # Quantidade de NF-es gravadas por transação na importação em lote
+        self.tamanho_chunk = int(os.getenv("IMPORTACAO_TAMANHO_CHUNK", 200))
+        self.resumo_service = ResumoService()
+        # Tentativas de gravar uma NF-e quando a baixa conflita com outro processo (ver ConflitoConcorrencia)
+        self.tentativas_conflito = max(1, int(os.getenv("ESTOQUE_TENTATIVAS_CONFLITO", 5)))
+        # Cache dos saldos e do resumo, invalidado a cada NF-e gravada (ver src/cache.py)
+        self.cache = Cache.do_ambiente()
 
     def processar_nfe(self, dados_nfe, tipo_operacao):
         try:
             # Verifica se a NF-e já existe para evitar duplicidade
             existing_nfe = NotaFiscal.query.filter_by(chave_acesso=dados_nfe["chave_acesso"]).first()
             if existing_nfe:
-                return {"sucesso": False, "erro": "NF-e já processada anteriormente.", "nfe_id": existing_nfe.id}
-
-            nfe = NotaFiscal(
-                numero_nf=dados_nfe["numero_nf"],
-                serie=dados_nfe["serie"],
-                chave_acesso=dados_nfe["chave_acesso"],
-                cnpj_destinatario=dados_nfe["cnpj_destinatario"],
-                nome_destinatario=dados_nfe["nome_destinatario"],
-                cfop=dados_nfe["cfop"],
-                tipo_operacao=tipo_operacao,
-                data_emissao=dados_nfe["data_emissao"],
-                xml_content=dados_nfe["xml_content"]
+                return {"sucesso": False, "erro": "NF-e já processada anteriormente.", "duplicada": True, "nfe_id": existing_nfe.id}
+
+            # Mesmo caminho da importação em lote, com um único documento
+            for tentativa in range(1, self.tentativas_conflito + 1):
+                try:
+                    nfe_id, = self._inserir_chunk([(dados_nfe, tipo_operacao)])
+                    db.session.commit()
+                    break
+                except ConflitoConcorrencia:
+                    db.session.rollback()
+                    if tentativa == self.tentativas_conflito:
+                        raise
+            self._invalidar_cache([(dados_nfe, tipo_operacao)])
+            return {"sucesso": True, "nfe_id": nfe_id, "itens_processados": len(dados_nfe["itens"])}
+
+        except IntegrityError:
+            db.session.rollback()
+            # A mesma chave gravada por outro worker ao mesmo tempo: a NF-e é tratada como já processada
+            existing_nfe = NotaFiscal.query.filter_by(chave_acesso=dados_nfe["chave_acesso"]).first()
+            if existing_nfe:
+                return {"sucesso": False, "erro": "NF-e já processada anteriormente.", "duplicada": True, "nfe_id": existing_nfe.id}
+            return {"sucesso": False, "erro": "Erro de integridade: Chave de acesso duplicada ou dados inválidos."}
+        except Exception as e:
+            db.session.rollback()
+            return {"sucesso": False, "erro": f"Erro ao salvar NF-e e atualizar estoque: {e}"}
+
+    def processar_lote(self, documentos, tamanho_chunk=None, progresso=None):
+        """Grava muitas NF-es já interpretadas com inserções em lote.
+
+        `documentos` é uma lista de tuplas (dados_nfe, tipo_operacao). Faz uma
+        única verificação de duplicidade para o lote, insere NotaFiscal,
+        ItemNotaFiscal e o estoque das SAIDAs com INSERTs em massa e faz commit
+        a cada `tamanho_chunk` documentos. Se um chunk falhar, ele é refeito
+        documento a documento com `processar_nfe` para isolar o erro.
+        Retorna o resultado de cada documento, na ordem recebida.
+        """
+        tamanho_chunk = tamanho_chunk or self.tamanho_chunk
+        resultados = [None] * len(documentos)
+
+        chaves_existentes = self.get_chaves_existentes(dados["chave_acesso"] for dados, _ in documentos)
+        pendentes = []
+        chaves_no_lote = set()
+        for indice, (dados_nfe, tipo_operacao) in enumerate(documentos):
+            chave_acesso = dados_nfe["chave_acesso"]
+            if chave_acesso in chaves_existentes or chave_acesso in chaves_no_lote:
+                resultados[indice] = self._resultado_lote(dados_nfe, {"sucesso": False, "erro": "NF-e já processada anteriormente.", "duplicada": True})
+                continue
+            chaves_no_lote.add(chave_acesso)
+            pendentes.append(indice)
+
+        # SAIDAs primeiro, para que entradas do mesmo lote encontrem o estoque de origem
+        pendentes.sort(key=lambda indice: documentos[indice][1] != "SAIDA")
+
+        for inicio in range(0, len(pendentes), tamanho_chunk):
+            chunk = pendentes[inicio:inicio + tamanho_chunk]
+            try:
+                gravados = self._inserir_chunk([documentos[indice] for indice in chunk])
+                db.session.commit()
+                self._invalidar_cache([documentos[indice] for indice in chunk])
+            except Exception:
+                db.session.rollback()
+                gravados = None
+
+            for posicao, indice in enumerate(chunk):
+                dados_nfe, tipo_operacao = documentos[indice]
+                if gravados is not None:
+                    resultado = {"sucesso": True, "nfe_id": gravados[posicao], "itens_processados": len(dados_nfe["itens"])}
+                else:
+                    try:
+                        resultado = self.processar_nfe(dados_nfe, tipo_operacao)
+                    except ValueError as e:
+                        resultado = {"sucesso": False, "erro": str(e)}
+                resultados[indice] = self._resultado_lote(dados_nfe, resultado)
+                if progresso:
+                    if resultado["sucesso"]:
+                        progresso.persistido()
+                    else:
+                        progresso.erro(f"NF {dados_nfe['numero_nf']}: {resultado['erro']}")
+
+        return resultados
+
+    def _inserir_chunk(self, documentos):
+        linhas_nfe = [
+            {
+                "numero_nf": dados_nfe["numero_nf"],
+                "serie": dados_nfe["serie"],
+                "chave_acesso": dados_nfe["chave_acesso"],
+                "cnpj_destinatario": dados_nfe["cnpj_destinatario"],
+                "nome_destinatario": dados_nfe["nome_destinatario"],
+                "cfop": dados_nfe["cfop"],
+                "tipo_operacao": tipo_operacao,
+                "data_emissao": dados_nfe["data_emissao"]
+            }
+            for dados_nfe, tipo_operacao in documentos
+        ]
+        ids_por_chave = dict(
+            (chave, nfe_id) for nfe_id, chave in db.session.execute(
+                insert(NotaFiscal).returning(NotaFiscal.id, NotaFiscal.chave_acesso), linhas_nfe
             )
-            db.session.add(nfe)
-            db.session.flush() # Para ter acesso ao nfe.id antes do commit
+        )
 
-            itens_processados = 0
+        linhas_xml = []
+        linhas_itens = []
+        for dados_nfe, tipo_operacao in documentos:
+            nfe_id = ids_por_chave[dados_nfe["chave_acesso"]]
+            if dados_nfe.get("xml_content") is not None:
+                linhas_xml.append(dict(XmlNotaFiscal.valores_comprimidos(dados_nfe["xml_content"]), nota_fiscal_id=nfe_id))
             for item_data in dados_nfe["itens"]:
-                item_nfe = ItemNotaFiscal(
-                    nota_fiscal_id=nfe.id,
-                    codigo_produto=item_data["codigo_produto"],
-                    descricao_produto=item_data["descricao_produto"],
-                    numero_lote=item_data["numero_lote"],
-                    quantidade=item_data["quantidade"],
-                    valor_unitario=item_data["valor_unitario"],
-                    valor_total=item_data["valor_total"]
-                )
-                db.session.add(item_nfe)
+                linhas_itens.append({
+                    "nota_fiscal_id": nfe_id,
+                    "codigo_produto": item_data["codigo_produto"],
+                    "descricao_produto": item_data["descricao_produto"],
+                    "numero_lote": item_data["numero_lote"],
+                    "quantidade": item_data["quantidade"],
+                    "valor_unitario": item_data["valor_unitario"],
+                    "valor_total": item_data["valor_total"]
+                })
+        if linhas_xml:
+            db.session.execute(insert(XmlNotaFiscal), linhas_xml)
+        ids_itens = []
+        if linhas_itens:
+            ids_itens = db.session.execute(
+                insert(ItemNotaFiscal).returning(ItemNotaFiscal.id, sort_by_parameter_order=True), linhas_itens
+            ).scalars().all()
 
-                # Atualiza o estoque de consignação
-                self._atualizar_estoque_consignacao(
+        # Itens de cada documento com o id gravado, na ordem da inserção
+        itens_por_documento = []
+        posicao = 0
+        for dados_nfe, _ in documentos:
+            itens_por_documento.append(list(zip(ids_itens[posicao:posicao + len(dados_nfe["itens"])], dados_nfe["itens"])))
+            posicao += len(dados_nfe["itens"])
+
+        variacao = self.resumo_service.nova_variacao()
+        self._inserir_estoque_saida(documentos, itens_por_documento, ids_por_chave, variacao)
+
+        # Entradas baixam o estoque da NF de saída referenciada (já gravada acima, se estiver no lote)
+        for (dados_nfe, tipo_operacao), itens in zip(documentos, itens_por_documento):
+            if tipo_operacao != "SAIDA":
+                self._baixar_entrada(dados_nfe, tipo_operacao, ids_por_chave[dados_nfe["chave_acesso"]], itens, variacao)
+        self.resumo_service.aplicar(variacao)
+
+        return [ids_por_chave[dados_nfe["chave_acesso"]] for dados_nfe, _ in documentos]
+
+    def _inserir_estoque_saida(self, documentos, itens_por_documento, ids_por_chave, variacao):
+        # Cada item de SAIDA abre um registro de estoque e o movimento que o originou
+        linhas_estoque = []
+        origens = []
+        for (dados_nfe, tipo_operacao), itens in zip(documentos, itens_por_documento):
+            if tipo_operacao != "SAIDA":
+                continue
+            nfe_id = ids_por_chave[dados_nfe["chave_acesso"]]
+            for item_id, item_data in itens:
+                linhas_estoque.append({
+                    "codigo_produto": item_data["codigo_produto"],
+                    "descricao_produto": item_data["descricao_produto"],
+                    "numero_lote": item_data["numero_lote"],
+                    "cnpj_destinatario": dados_nfe["cnpj_destinatario"],
+                    "nome_destinatario": dados_nfe["nome_destinatario"],
+                    "quantidade_consignada_nf": item_data["quantidade"],
+                    "quantidade_retornada_nf": 0,
+                    "quantidade_faturada_nf": 0,
+                    "saldo_disponivel_nf": item_data["quantidade"],
+                    "nf_saida_id": nfe_id
+                })
+                origens.append((nfe_id, item_id, dados_nfe["data_emissao"], item_data["quantidade"]))
+                variacao.nova_linha(
                     item_data["codigo_produto"],
-                    item_data["descricao_produto"],
-                    item_data["numero_lote"],
                     dados_nfe["cnpj_destinatario"],
                     dados_nfe["nome_destinatario"],
-                    item_data["quantidade"],
-                    tipo_operacao,
-                    nfe,
-                    dados_nfe.get("nf_saida_referenciada_chave_acesso") # Passa a chave da NF de saída referenciada
+                    item_data["quantidade"]
                 )
-                itens_processados += 1
+        if not linhas_estoque:
+            return
 
-            db.session.commit()
-            return {"sucesso": True, "nfe_id": nfe.id, "itens_processados": itens_processados}
+        ids_estoque = db.session.execute(
+            insert(EstoqueConsignacao).returning(EstoqueConsignacao.id, sort_by_parameter_order=True), linhas_estoque
+        ).scalars().all()
+        db.session.execute(insert(MovimentoEstoque), [
+            {
+                "estoque_id": estoque_id,
+                "nota_fiscal_id": nfe_id,
+                "item_nota_fiscal_id": item_id,
+                "tipo_operacao": "SAIDA",
+                "quantidade": quantidade,
+                "data_movimento": data_emissao
+            }
+            for estoque_id, (nfe_id, item_id, data_emissao, quantidade) in zip(ids_estoque, origens)
+        ])
 
-        except IntegrityError:
-            db.session.rollback()
-            return {"sucesso": False, "erro": "Erro de integridade: Chave de acesso duplicada ou dados inválidos."}
-        except Exception as e:
-            db.session.rollback()
-            return {"sucesso": False, "erro": f"Erro ao salvar NF-e e atualizar estoque: {e}"}
+    def _invalidar_cache(self, documentos):
+        # Uma NF-e só altera registros do próprio destinatário e dos produtos dos seus itens
+        tags = ["resumo"]
+        for dados_nfe, _ in documentos:
+            tags.append(f"cnpj:{dados_nfe['cnpj_destinatario']}")
+            tags.extend(f"produto:{item_data['codigo_produto']}" for item_data in dados_nfe["itens"])
+        self.cache.invalidar(tags)
+
+    def tags_saldo_destinatario(self, cnpj):
+        return ["estoque", f"cnpj:{cnpj}"]
+
+    def tags_saldo_produto(self, codigo_produto):
+        return ["estoque", f"produto:{codigo_produto}"]
+
+    def _resultado_lote(self, dados_nfe, resultado):
+        return dict(resultado, chave_acesso=dados_nfe["chave_acesso"], numero_nf=dados_nfe["numero_nf"])
 
-    def _atualizar_estoque_consignacao(self, codigo_produto, descricao_produto, numero_lote, cnpj_destinatario, nome_destinatario, quantidade, tipo_operacao, nfe, nf_saida_referenciada_chave_acesso=None):
-        # Se for SAIDA, cria um novo registro de estoque por NF
-        if tipo_operacao == "SAIDA":
-            estoque = EstoqueConsignacao(
-                codigo_produto=codigo_produto,
-                descricao_produto=descricao_produto,
-                numero_lote=numero_lote,
-                cnpj_destinatario=cnpj_destinatario,
-                nome_destinatario=nome_destinatario,
-                quantidade_consignada_nf=quantidade,
-                saldo_disponivel_nf=quantidade,
-                nf_saida_id=nfe.id
+    def get_xml_nfe(self, chave_acesso):
+        # Carrega só o XML comprimido da NF-e, sem passar pelo cabeçalho
+        return XmlNotaFiscal.query.join(NotaFiscal, NotaFiscal.id == XmlNotaFiscal.nota_fiscal_id).filter(
+            NotaFiscal.chave_acesso == chave_acesso
+        ).first()
+
+    def get_chaves_existentes(self, chaves_acesso, tamanho_lote=500):
+        # Retorna o subconjunto de chaves já gravadas em notas_fiscais, em consultas IN por lote
+        chaves_acesso = list(chaves_acesso)
+        existentes = set()
+        for inicio in range(0, len(chaves_acesso), tamanho_lote):
+            lote = chaves_acesso[inicio:inicio + tamanho_lote]
+            existentes.update(
+                chave for (chave,) in db.session.query(NotaFiscal.chave_acesso).filter(NotaFiscal.chave_acesso.in_(lote))
             )
-            db.session.add(estoque)
-        else:
-            # Para ENTRADA_RETORNO, ENTRADA_DEVOLUCAO, ENTRADA_VENDA, precisamos encontrar a NF de SAIDA original
-            # A NF de entrada/retorno/venda DEVE referenciar a NF de saída original (ex: pela chave de acesso)
-            if not nf_saida_referenciada_chave_acesso:
-                raise ValueError("Para operações de ENTRADA (RETORNO, DEVOLUCAO, VENDA), a chave de acesso da NF de saída referenciada é obrigatória.")
-
-            # Busca a NF de saída original
-            nf_saida_original = NotaFiscal.query.filter_by(chave_acesso=nf_saida_referenciada_chave_acesso, tipo_operacao="SAIDA").first()
-            if not nf_saida_original:
-                raise ValueError(f"NF de Saída original com chave {nf_saida_referenciada_chave_acesso} não encontrada.")
-
-            # Encontra o registro de EstoqueConsignacao correspondente à NF de saída original
-            estoque = EstoqueConsignacao.query.filter_by(
-                nf_saida_id=nf_saida_original.id,
-                codigo_produto=codigo_produto,
-                numero_lote=numero_lote,
-                cnpj_destinatario=cnpj_destinatario
-            ).first()
-
-            if not estoque:
+        return existentes
+
+    def get_ultima_emissao(self, chaves_acesso, tamanho_lote=500):
+        # Maior data de emissão entre as chaves informadas (None se nenhuma estiver gravada)
+        chaves_acesso = list(chaves_acesso)
+        ultima = None
+        for inicio in range(0, len(chaves_acesso), tamanho_lote):
+            data_emissao = db.session.query(func.max(NotaFiscal.data_emissao)).filter(
+                NotaFiscal.chave_acesso.in_(chaves_acesso[inicio:inicio + tamanho_lote])
+            ).scalar()
+            if data_emissao and (ultima is None or data_emissao > ultima):
+                ultima = data_emissao
+        return ultima
+
+    def _carregar_estoques_referenciados(self, chaves_referenciadas):
+        # Para ENTRADA_RETORNO, ENTRADA_DEVOLUCAO, ENTRADA_VENDA, precisamos encontrar as NFs de SAIDA originais
+        # A NF de entrada/retorno/venda DEVE referenciar a(s) NF(s) de saída original(is) (NFref/refNFe)
+        if not chaves_referenciadas:
+            raise ValueError("Para operações de ENTRADA (RETORNO, DEVOLUCAO, VENDA), a chave de acesso da NF de saída referenciada é obrigatória.")
+
+        # Busca as NFs de saída referenciadas em uma única consulta (sem carregar o XML);
+        # referências a notas que não são remessas de consignação são ignoradas
+        nfs_saida = db.session.query(NotaFiscal.id, NotaFiscal.numero_nf).filter(
+            NotaFiscal.chave_acesso.in_(chaves_referenciadas),
+            NotaFiscal.tipo_operacao == "SAIDA"
+        ).all()
+        if not nfs_saida:
+            raise ValueError(f"NF de Saída original com chave {', '.join(chaves_referenciadas)} não encontrada.")
+
+        # Carrega de uma vez os saldos dessas NFs, agrupados por (produto, lote, cnpj) na ordem
+        # de emissão da NF de saída, para a baixa FIFO quando o item aparece em mais de uma.
+        # No PostgreSQL as linhas ficam bloqueadas (FOR UPDATE) até o commit, serializando entradas
+        # concorrentes contra a mesma NF de saída; no SQLite o bloqueio é ignorado e vale o controle por versão
+        estoques = db.session.query(
+            EstoqueConsignacao.id,
+            EstoqueConsignacao.versao,
+            EstoqueConsignacao.codigo_produto,
+            EstoqueConsignacao.numero_lote,
+            EstoqueConsignacao.cnpj_destinatario,
+            EstoqueConsignacao.nome_destinatario,
+            EstoqueConsignacao.saldo_disponivel_nf
+        ).join(
+            NotaFiscal, NotaFiscal.id == EstoqueConsignacao.nf_saida_id
+        ).filter(
+            EstoqueConsignacao.nf_saida_id.in_([nf.id for nf in nfs_saida])
+        ).order_by(NotaFiscal.data_emissao, EstoqueConsignacao.id).with_for_update(of=EstoqueConsignacao)
+        mapa = {}
+        for e in estoques:
+            mapa.setdefault((e.codigo_produto, e.numero_lote, e.cnpj_destinatario), []).append({
+                "id": e.id,
+                "versao": e.versao,
+                "nome_destinatario": e.nome_destinatario,
+                "saldo": e.saldo_disponivel_nf # Atualizado em memória conforme as baixas desta NF
+            })
+        return ", ".join(nf.numero_nf for nf in nfs_saida), mapa
+
+    def _baixar_entrada(self, dados_nfe, tipo_operacao, nfe_id, itens, variacao):
+        """Grava os movimentos de uma NF de entrada e baixa os saldos correspondentes.
+
+        `itens` é a lista de (id do ItemNotaFiscal, dados do item). Os saldos são
+        alterados com incrementos atômicos (col = col + :quantidade), sem ler e
+        regravar a linha inteira. A divisão FIFO depende dos saldos lidos, então
+        o UPDATE confere a versão lida e levanta ConflitoConcorrencia se outro
+        processo baixou o mesmo registro nesse intervalo.
+        """
+        numeros_nf_saida, mapa = self._carregar_estoques_referenciados(dados_nfe.get("nf_saida_referenciada_chaves"))
+        coluna = COLUNA_BAIXA.get(tipo_operacao)
+
+        movimentos = []
+        baixas = {}
+        for item_id, item_data in itens:
+            codigo_produto = item_data["codigo_produto"]
+            candidatos = mapa.get((codigo_produto, item_data["numero_lote"], dados_nfe["cnpj_destinatario"]))
+            if not candidatos:
                 # Isso pode acontecer se a NF de saída original não foi processada ou se os dados não batem
-                raise ValueError(f"Registro de estoque consignado para NF de saída {nf_saida_original.numero_nf} e produto {codigo_produto} não encontrado.")
+                raise ValueError(f"Registro de estoque consignado para NF de saída {numeros_nf_saida} e produto {codigo_produto} não encontrado.")
+            if coluna is None:
+                continue
+
+            for estoque, parcela in self._alocar_baixa(candidatos, item_data["quantidade"]):
+                movimentos.append({
+                    "estoque_id": estoque["id"],
+                    "nota_fiscal_id": nfe_id,
+                    "item_nota_fiscal_id": item_id,
+                    "tipo_operacao": tipo_operacao,
+                    "quantidade": parcela,
+                    "data_movimento": dados_nfe["data_emissao"]
+                })
+                baixas.setdefault(estoque["id"], [estoque["versao"], 0])[1] += parcela
+                saldo_anterior = estoque["saldo"]
+                estoque["saldo"] -= parcela
+                variacao.saldo_alterado(codigo_produto, dados_nfe["cnpj_destinatario"], estoque["nome_destinatario"], saldo_anterior, estoque["saldo"])
+
+        if movimentos:
+            db.session.execute(insert(MovimentoEstoque), movimentos)
+            tabela = EstoqueConsignacao.__table__
+            quantidade = bindparam("b_quantidade", type_=Quantidade)
+            atualizados = db.session.execute(
+                update(tabela).where(
+                    tabela.c.id == bindparam("b_id"),
+                    tabela.c.versao == bindparam("b_versao")
+                ).values({
+                    coluna: tabela.c[coluna] + quantidade,
+                    tabela.c.saldo_disponivel_nf: tabela.c.saldo_disponivel_nf - quantidade,
+                    tabela.c.versao: tabela.c.versao + 1
+                }),
+                [
+                    {"b_id": estoque_id, "b_versao": versao, "b_quantidade": total}
+                    for estoque_id, (versao, total) in baixas.items()
+                ]
+            ).rowcount
+            if atualizados != len(baixas):
+                raise ConflitoConcorrencia(f"Estoque da NF de saída {numeros_nf_saida} alterado por outro processo.")
 
-            if tipo_operacao == "ENTRADA_RETORNO":
-                estoque.quantidade_retornada_nf += quantidade
-            elif tipo_operacao == "ENTRADA_DEVOLUCAO":
-                estoque.quantidade_retornada_nf += quantidade # Devolução simbólica também reduz o saldo consignado
-            elif tipo_operacao == "ENTRADA_VENDA":
-                estoque.quantidade_faturada_nf += quantidade
+    def _alocar_baixa(self, candidatos, quantidade):
+        # Baixa FIFO entre as NFs de saída referenciadas; o excedente fica na última, como numa NF única
+        restante = quantidade
+        for posicao, estoque in enumerate(candidatos):
+            if posicao == len(candidatos) - 1:
+                parcela = restante
+            else:
+                parcela = min(restante, max(estoque["saldo"], 0))
+            if parcela <= 0:
+                continue
+            yield estoque, parcela
+            restante -= parcela
+            if restante <= 0:
+                break
 
-            estoque.saldo_disponivel_nf = estoque.quantidade_consignada_nf - estoque.quantidade_retornada_nf - estoque.quantidade_faturada_nf
+    def reconstruir_saldos(self, limite_saldo_baixo=None):
+        """Recalcula todos os registros de estoque a partir de movimentos_estoque.
+
+        Um único UPDATE com subconsultas agrupadas por registro, seguido da
+        reconstrução dos agregados do resumo (com `limite_saldo_baixo`, se
+        informado, gravado como o novo limite).
+        """
+        def total(tipos):
+            return select(func.coalesce(func.sum(MovimentoEstoque.quantidade), 0)).where(
+                MovimentoEstoque.estoque_id == EstoqueConsignacao.id,
+                MovimentoEstoque.tipo_operacao.in_(tipos)
+            ).scalar_subquery()
+
+        consignada = total(["SAIDA"])
+        retornada = total(TIPOS_RETORNO)
+        faturada = total(TIPOS_FATURAMENTO)
+        atualizados = db.session.query(EstoqueConsignacao).update({
+            EstoqueConsignacao.quantidade_consignada_nf: consignada,
+            EstoqueConsignacao.quantidade_retornada_nf: retornada,
+            EstoqueConsignacao.quantidade_faturada_nf: faturada,
+            EstoqueConsignacao.saldo_disponivel_nf: consignada - retornada - faturada,
+            EstoqueConsignacao.versao: EstoqueConsignacao.versao + 1
+        }, synchronize_session=False)
+        self.resumo_service.reconstruir(limite=limite_saldo_baixo)
+        db.session.commit()
+        self.cache.invalidar(["estoque"])
+        return {"sucesso": True, "registros_atualizados": atualizados}
+
+    def get_saldos_em(self, data_referencia, cnpj_destinatario=None, codigo_produto=None):
+        """Saldos por (destinatário, produto, lote) ao fim do dia `data_referencia`.
+
+        Soma os movimentos até a data em uma consulta agrupada (na réplica de
+        leitura, se configurada), sem depender do saldo atual nem do XML das notas.
+        """
+        def total(condicao):
+            return func.coalesce(func.sum(case((condicao, MovimentoEstoque.quantidade), else_=0)), 0)
+
+        consignada = total(MovimentoEstoque.tipo_operacao == "SAIDA")
+        retornada = total(MovimentoEstoque.tipo_operacao.in_(TIPOS_RETORNO))
+        faturada = total(MovimentoEstoque.tipo_operacao.in_(TIPOS_FATURAMENTO))
+        consulta = db.session.query(
+            EstoqueConsignacao.cnpj_destinatario,
+            func.max(EstoqueConsignacao.nome_destinatario).label("nome_destinatario"),
+            EstoqueConsignacao.codigo_produto,
+            EstoqueConsignacao.numero_lote,
+            consignada.label("consignada"),
+            retornada.label("retornada"),
+            faturada.label("faturada")
+        ).join(
+            MovimentoEstoque, MovimentoEstoque.estoque_id == EstoqueConsignacao.id
+        ).filter(
+            MovimentoEstoque.data_movimento < datetime.combine(data_referencia, time.min) + timedelta(days=1)
+        )
+        if cnpj_destinatario:
+            consulta = consulta.filter(EstoqueConsignacao.cnpj_destinatario == cnpj_destinatario)
+        if codigo_produto:
+            consulta = consulta.filter(EstoqueConsignacao.codigo_produto == codigo_produto)
+        consulta = consulta.group_by(
+            EstoqueConsignacao.cnpj_destinatario, EstoqueConsignacao.codigo_produto, EstoqueConsignacao.numero_lote
+        ).order_by(EstoqueConsignacao.cnpj_destinatario, EstoqueConsignacao.codigo_produto, EstoqueConsignacao.numero_lote)
+
+        return [
+            {
+                "cnpj_destinatario": s.cnpj_destinatario,
+                "nome_destinatario": s.nome_destinatario,
+                "codigo_produto": s.codigo_produto,
+                "numero_lote": s.numero_lote,
+                "quantidade_consignada": s.consignada,
+                "quantidade_retornada": s.retornada,
+                "quantidade_faturada": s.faturada,
+                "saldo_disponivel": s.consignada - s.retornada - s.faturada
+            }
+            for s in executar_leitura(consulta)
+        ]
 
     def get_resumo_estoque(self):
-        # Este método agora pode ser mais complexo, somando saldos por produto/destinatário
-        # ou pode ser removido se a granularidade por NF for a principal
-        total_produtos = EstoqueConsignacao.query.distinct(EstoqueConsignacao.codigo_produto).count()
-        total_destinatarios = EstoqueConsignacao.query.distinct(EstoqueConsignacao.cnpj_destinatario).count()
-        saldo_total_disponivel = db.session.query(db.func.sum(EstoqueConsignacao.saldo_disponivel_nf)).scalar() or 0
-        
-        # Produtos com saldo baixo pode ser mais complexo agora, talvez por NF ou por produto geral
-        # Por simplicidade, vamos manter a soma geral por enquanto
-        produtos_saldo_baixo = EstoqueConsignacao.query.filter(EstoqueConsignacao.saldo_disponivel_nf < 10, EstoqueConsignacao.saldo_disponivel_nf > 0).count()
+        # Lido dos agregados mantidos a cada NF-e gravada (ver ResumoService), sem varrer o estoque
+        return self.cache.obter("resumo", TAGS_RESUMO, self.resumo_service.get_resumo)
+
+    def get_saldo_por_destinatario(self, cnpj, **filtros):
+        # Registros de estoque de um CNPJ com os dados da NF de saída, em uma única consulta paginada
+        return self._saldos(
+            f"saldo_destinatario:{cnpj}:{sorted(filtros.items())}",
+            self.tags_saldo_destinatario(cnpj),
+            EstoqueConsignacao.cnpj_destinatario == cnpj,
+            filtros
+        )
+
+    def get_saldo_por_produto(self, codigo_produto, **filtros):
+        # Registros de estoque de um produto com os dados da NF de saída, em uma única consulta paginada
+        return self._saldos(
+            f"saldo_produto:{codigo_produto}:{sorted(filtros.items())}",
+            self.tags_saldo_produto(codigo_produto),
+            EstoqueConsignacao.codigo_produto == codigo_produto,
+            filtros
+        )
+
+    def _saldos(self, chave, tags, criterio, filtros):
+        # Sem cache, devolve o gerador sobre o cursor (a página não é montada em memória);
+        # com cache, a lista guardada
+        if self.cache.backend is None:
+            return self._iter_saldos(criterio, **filtros)
+        return self.cache.obter(chave, tags, lambda: list(self._iter_saldos(criterio, **filtros)))
+
+    def iter_posicoes(self, cnpj=None, codigo_produto=None, **filtros):
+        """Todas as posições de estoque (sem paginação), para exportação.
+
+        É um gerador sobre um cursor do servidor (yield_per), então a memória
+        não cresce com o número de linhas; não passa pelo cache.
+        """
+        criterios = []
+        if cnpj:
+            criterios.append(EstoqueConsignacao.cnpj_destinatario == cnpj)
+        if codigo_produto:
+            criterios.append(EstoqueConsignacao.codigo_produto == codigo_produto)
+        return self._iter_saldos(and_(true(), *criterios), **filtros)
+
+    def get_aging(self, agrupar="destinatario", cnpj=None, codigo_produto=None, data_referencia=None):
+        """Saldo disponível distribuído por idade da NF de saída (0-30, 31-60, 61-90, 90+ dias).
+
+        Uma única consulta agrupada: os limites das faixas são calculados aqui
+        como datas e cada faixa é um SUM(CASE ...) sobre o saldo, então o banco
+        faz uma só passagem pelas linhas com saldo (na réplica, se configurada).
+
+        Sem `data_referencia` usa o saldo atual. Com ela, a posição é a do fim
+        daquele dia: só entram NFs de saída emitidas até a data e o saldo de
+        cada registro vem dos movimentos até ela, como em get_saldos_em (assim
+        as faixas somam o saldo_total da data).
+        """
+        if agrupar not in AGRUPAMENTOS_AGING:
+            raise ValueError(f"Agrupamento inválido: {agrupar}. Use {', '.join(AGRUPAMENTOS_AGING)}.")
+        colunas_grupo, colunas_descricao = AGRUPAMENTOS_AGING[agrupar]
+
+        if data_referencia is None:
+            data_referencia = date.today()
+            saldo = EstoqueConsignacao.saldo_disponivel_nf
+            origem = None
+        else:
+            fim_do_dia = datetime.combine(data_referencia, time.min) + timedelta(days=1)
+            sinal = case(
+                (MovimentoEstoque.tipo_operacao == "SAIDA", MovimentoEstoque.quantidade),
+                (MovimentoEstoque.tipo_operacao.in_(TIPOS_RETORNO + TIPOS_FATURAMENTO), -MovimentoEstoque.quantidade),
+                else_=0
+            )
+            origem = db.session.query(
+                MovimentoEstoque.estoque_id,
+                func.sum(sinal).label("saldo")
+            ).filter(MovimentoEstoque.data_movimento < fim_do_dia).group_by(MovimentoEstoque.estoque_id).subquery()
+            saldo = origem.c.saldo
+        faixas = []
+        for posicao, (nome, idade_minima) in enumerate(FAIXAS_AGING):
+            # Emitidas até o fim do dia (referência - idade mínima) e depois do início da faixa seguinte
+            condicoes = [NotaFiscal.data_emissao < datetime.combine(data_referencia - timedelta(days=idade_minima - 1), time.min)]
+            if posicao + 1 < len(FAIXAS_AGING):
+                idade_seguinte = FAIXAS_AGING[posicao + 1][1]
+                condicoes.append(NotaFiscal.data_emissao >= datetime.combine(data_referencia - timedelta(days=idade_seguinte - 1), time.min))
+            faixas.append(func.coalesce(func.sum(case((and_(*condicoes), saldo), else_=0)), 0).label(nome))
+
+        grupo = [getattr(EstoqueConsignacao, coluna) for coluna in colunas_grupo]
+        consulta = db.session.query(
+            *grupo,
+            *[func.max(getattr(EstoqueConsignacao, coluna)).label(coluna) for coluna in colunas_descricao],
+            func.sum(saldo).label("saldo_total"),
+            func.count().label("registros"),
+            *faixas
+        ).join(NotaFiscal, NotaFiscal.id == EstoqueConsignacao.nf_saida_id)
+        if origem is not None:
+            consulta = consulta.join(origem, origem.c.estoque_id == EstoqueConsignacao.id).filter(
+                NotaFiscal.data_emissao < fim_do_dia
+            )
+        consulta = consulta.filter(saldo > 0)
+        if cnpj:
+            consulta = consulta.filter(EstoqueConsignacao.cnpj_destinatario == cnpj)
+        if codigo_produto:
+            consulta = consulta.filter(EstoqueConsignacao.codigo_produto == codigo_produto)
+        consulta = consulta.group_by(*grupo).order_by(faixas[-1].desc(), *grupo)
 
         return {
-            "total_produtos": total_produtos,
-            "total_destinatarios": total_destinatarios,
-            "saldo_total_disponivel": saldo_total_disponivel,
-            "produtos_saldo_baixo": produtos_saldo_baixo
+            "data_referencia": data_referencia.isoformat(),
+            "agrupar": agrupar,
+            "linhas": [
+                {
+                    **{coluna: linha._mapping[coluna] for coluna in colunas_grupo + colunas_descricao},
+                    "saldo_total": linha.saldo_total,
+                    "registros": linha.registros,
+                    "faixas": {nome: linha._mapping[nome] for nome, _ in FAIXAS_AGING}
+                }
+                for linha in executar_leitura(consulta)
+            ]
         }
 
-    def get_saldo_por_destinatario(self, cnpj):
-        # Retorna todos os registros de estoque para um CNPJ, incluindo detalhes da NF de saída
-        saldos = EstoqueConsignacao.query.filter_by(cnpj_destinatario=cnpj).all()
-        results = []
-        for s in saldos:
-            nf_saida = NotaFiscal.query.get(s.nf_saida_id)
-            results.append({
+    def _iter_saldos(self, criterio, apenas_com_saldo=False, numero_lote=None, data_inicio=None, data_fim=None, apos_id=None, limite=None):
+        """Gera os registros de estoque em ordem de id (paginação por cursor).
+
+        Junta a NF de saída na mesma consulta e seleciona só as colunas
+        exibidas (sem o XML). Roda na réplica de leitura, se configurada. `apos_id` é o cursor devolvido pela página
+        anterior; `data_inicio`/`data_fim` filtram pela emissão da NF de saída.
+        """
+        consulta = db.session.query(
+            EstoqueConsignacao.id,
+            EstoqueConsignacao.codigo_produto,
+            EstoqueConsignacao.descricao_produto,
+            EstoqueConsignacao.numero_lote,
+            EstoqueConsignacao.cnpj_destinatario,
+            EstoqueConsignacao.nome_destinatario,
+            EstoqueConsignacao.quantidade_consignada_nf,
+            EstoqueConsignacao.quantidade_retornada_nf,
+            EstoqueConsignacao.quantidade_faturada_nf,
+            EstoqueConsignacao.saldo_disponivel_nf,
+            NotaFiscal.numero_nf,
+            NotaFiscal.data_emissao
+        ).join(NotaFiscal, NotaFiscal.id == EstoqueConsignacao.nf_saida_id).filter(criterio)
+
+        if apenas_com_saldo:
+            consulta = consulta.filter(EstoqueConsignacao.saldo_disponivel_nf > 0)
+        if numero_lote:
+            consulta = consulta.filter(EstoqueConsignacao.numero_lote == numero_lote)
+        if data_inicio:
+            consulta = consulta.filter(NotaFiscal.data_emissao >= data_inicio)
+        if data_fim:
+            consulta = consulta.filter(NotaFiscal.data_emissao < data_fim + timedelta(days=1))
+        if apos_id:
+            consulta = consulta.filter(EstoqueConsignacao.id > apos_id)
+        consulta = consulta.order_by(EstoqueConsignacao.id)
+        if limite:
+            consulta = consulta.limit(limite)
+
+        for s in executar_leitura(consulta, yield_per=500):
+            yield {
+                "id": s.id,
                 "codigo_produto": s.codigo_produto,
                 "descricao_produto": s.descricao_produto,
                 "numero_lote": s.numero_lote,
-                "quantidade_consignada_nf": s.quantidade_consignada_nf,
-                "quantidade_retornada_nf": s.quantidade_retornada_nf,
-                "quantidade_faturada_nf": s.quantidade_faturada_nf,
-                "saldo_disponivel_nf": s.saldo_disponivel_nf,
-                "nf_saida_numero": nf_saida.numero_nf if nf_saida else None,
-                "nf_saida_data_emissao": nf_saida.data_emissao.strftime("%Y-%m-%d") if nf_saida else None
-            })
-        return results
-
-    def get_saldo_por_produto(self, codigo_produto):
-        # Retorna todos os registros de estoque para um produto, incluindo detalhes da NF de saída
-        saldos = EstoqueConsignacao.query.filter_by(codigo_produto=codigo_produto).all()
-        results = []
-        for s in saldos:
-            nf_saida = NotaFiscal.query.get(s.nf_saida_id)
-            results.append({
                 "cnpj_destinatario": s.cnpj_destinatario,
                 "nome_destinatario": s.nome_destinatario,
-                "numero_lote": s.numero_lote,
                 "quantidade_consignada_nf": s.quantidade_consignada_nf,
                 "quantidade_retornada_nf": s.quantidade_retornada_nf,
                 "quantidade_faturada_nf": s.quantidade_faturada_nf,
                 "saldo_disponivel_nf": s.saldo_disponivel_nf,
-                "nf_saida_numero": nf_saida.numero_nf if nf_saida else None,
-                "nf_saida_data_emissao": nf_saida.data_emissao.strftime("%Y-%m-%d") if nf_saida else None
-            })
-        return results
+                "nf_saida_numero": s.numero_nf,
+                "nf_saida_data_emissao": s.data_emissao.strftime("%Y-%m-%d") if s.data_emissao else None
+            }
+
+    def validar_disponibilidade_faturamento(self, cnpj_destinatario, itens_faturamento, alocar=False):
+        """Valida o saldo de todos os itens com uma única consulta agrupada.
+
+        Lê sempre do banco principal: a réplica pode estar atrasada em relação
+        a baixas recém-gravadas.
+
+        Linhas repetidas (mesmo produto e lote) são somadas antes da validação.
+        Com `alocar=True`, informa também quais NFs de saída seriam consumidas,
+        da mais antiga para a mais nova (FIFO por data de emissão).
+
+        Levanta ValueError para item sem produto ou com quantidade inválida.
+        """
+        # Soma as quantidades solicitadas por (produto, lote), preservando a ordem da requisição
+        solicitados = {}
+        for posicao, item_req in enumerate(itens_faturamento, start=1):
+            if not isinstance(item_req, dict) or not item_req.get("codigo_produto"):
+                raise ValueError(f"Item {posicao}: codigo_produto é obrigatório")
+            try:
+                quantidade = Decimal(str(item_req["quantidade"]))
+            except (KeyError, InvalidOperation):
+                raise ValueError(f"Item {posicao}: quantidade inválida: {item_req.get('quantidade')!r}")
+            if not quantidade.is_finite() or quantidade <= 0:
+                raise ValueError(f"Item {posicao}: a quantidade deve ser um número positivo")
+            chave = (item_req["codigo_produto"], item_req.get("numero_lote"))
+            solicitados[chave] = solicitados.get(chave, 0) + quantidade
+
+        criterio = self._criterio_produto_lote(solicitados.keys())
+        # O saldo validado é sempre a soma agrupada; a alocação só escolhe as NFs que o cobrem
+        saldos = {
+            (codigo_produto, numero_lote): total or 0
+            for codigo_produto, numero_lote, total in db.session.query(
+                EstoqueConsignacao.codigo_produto,
+                EstoqueConsignacao.numero_lote,
+                db.func.sum(EstoqueConsignacao.saldo_disponivel_nf)
+            ).filter(
+                EstoqueConsignacao.cnpj_destinatario == cnpj_destinatario,
+                criterio
+            ).group_by(EstoqueConsignacao.codigo_produto, EstoqueConsignacao.numero_lote)
+        }
+        alocacoes = self._alocar_fifo(cnpj_destinatario, criterio, solicitados) if alocar else {}
 
-    def validar_disponibilidade_faturamento(self, cnpj_destinatario, itens_faturamento):
         erros = []
-        for item_req in itens_faturamento:
-            # Para validar faturamento, agora precisamos saber qual NF de saída está sendo faturada
-            # ou somar o saldo total disponível para o produto/lote/destinatário
-            # Por simplicidade, vamos somar o saldo total para o produto/lote/destinatário
-            total_saldo_produto = db.session.query(db.func.sum(EstoqueConsignacao.saldo_disponivel_nf)).filter_by(
-                cnpj_destinatario=cnpj_destinatario,
-                codigo_produto=item_req["codigo_produto"],
-                numero_lote=item_req["numero_lote"]
-            ).scalar() or 0
+        itens = []
+        for (codigo_produto, numero_lote), quantidade in solicitados.items():
+            saldo_disponivel = saldos.get((codigo_produto, numero_lote), 0)
+            suficiente = saldo_disponivel >= quantidade
+            if not suficiente:
+                erros.append(f"Produto {codigo_produto} (Lote: {numero_lote}) não possui saldo suficiente para faturamento no destinatário {cnpj_destinatario}.")
+            item = {
+                "codigo_produto": codigo_produto,
+                "numero_lote": numero_lote,
+                "quantidade_solicitada": quantidade,
+                "saldo_disponivel": saldo_disponivel,
+                "suficiente": suficiente
+            }
+            if alocar:
+                item["alocacoes"] = alocacoes.get((codigo_produto, numero_lote), [])
+            itens.append(item)
 
-            if total_saldo_produto < item_req["quantidade"]:
-                erros.append(f"Produto {item_req["codigo_produto"]} (Lote: {item_req["numero_lote"]}) não possui saldo suficiente para faturamento no destinatário {cnpj_destinatario}.")
-        
-        return {"sucesso": len(erros) == 0, "erros": erros}
+        return {"sucesso": len(erros) == 0, "erros": erros, "itens": itens}
 
+    def _criterio_produto_lote(self, chaves):
+        # (produto, lote) IN (...) em uma condição; lote nulo não casa em IN, então vai em separado
+        pares = [(codigo_produto, numero_lote) for codigo_produto, numero_lote in chaves if numero_lote is not None]
+        sem_lote = [codigo_produto for codigo_produto, numero_lote in chaves if numero_lote is None]
+        criterios = []
+        if pares:
+            criterios.append(tuple_(EstoqueConsignacao.codigo_produto, EstoqueConsignacao.numero_lote).in_(pares))
+        if sem_lote:
+            criterios.append(and_(EstoqueConsignacao.numero_lote.is_(None), EstoqueConsignacao.codigo_produto.in_(sem_lote)))
+        return or_(*criterios)
 
+    def _alocar_fifo(self, cnpj_destinatario, criterio, solicitados):
+        # Só NFs com saldo positivo entram na alocação
+        linhas = db.session.query(
+            EstoqueConsignacao.codigo_produto,
+            EstoqueConsignacao.numero_lote,
+            EstoqueConsignacao.saldo_disponivel_nf,
+            NotaFiscal.numero_nf,
+            NotaFiscal.chave_acesso,
+            NotaFiscal.data_emissao
+        ).join(NotaFiscal, NotaFiscal.id == EstoqueConsignacao.nf_saida_id).filter(
+            EstoqueConsignacao.cnpj_destinatario == cnpj_destinatario,
+            EstoqueConsignacao.saldo_disponivel_nf > 0,
+            criterio
+        ).order_by(NotaFiscal.data_emissao, EstoqueConsignacao.id)
 
+        alocacoes = {}
+        for linha in linhas:
+            chave = (linha.codigo_produto, linha.numero_lote)
+            alocado = sum(a["quantidade"] for a in alocacoes.get(chave, []))
+            restante = solicitados[chave] - alocado
+            if restante <= 0:
+                continue
+            alocacoes.setdefault(chave, []).append({
+                "nf_saida_numero": linha.numero_nf,
+                "nf_saida_chave_acesso": linha.chave_acesso,
+                "nf_saida_data_emissao": linha.data_emissao.strftime("%Y-%m-%d") if linha.data_emissao else None,
+                "quantidade": min(restante, linha.saldo_disponivel_nf)
+            })
+        return alocacoes
+
+
+class GravacaoIncremental:
+    """Grava NF-es já interpretadas em chunks de `processar_lote`, à medida que chegam.
+
+    Dentro de cada chunk as SAIDAs vão antes das entradas. Uma entrada cuja
+    NF de saída referenciada ainda não está no banco nem no chunk fica retida
+    e volta nos chunks seguintes, até a saída chegar ou até `finalizar()`.
+    Para a memória não crescer sem limite, quando as retidas passam de
+    `limite_retidas` as mais antigas são gravadas mesmo assim (e falham com
+    o erro de NF de saída não encontrada).
+
+    `ao_gravar(referencia, dados_nfe, tipo_operacao, resultado)` recebe o
+    resultado de cada documento; em seguida o XML do documento é descartado.
+    """
+
+    def __init__(self, estoque_service, ao_gravar, progresso=None, tamanho_chunk=None, limite_retidas=None):
+        self.estoque_service = estoque_service
+        self.ao_gravar = ao_gravar
+        self.progresso = progresso
+        self.tamanho_chunk = tamanho_chunk or estoque_service.tamanho_chunk
+        self.limite_retidas = limite_retidas or self.tamanho_chunk * 10
+        self._fila = []
+        self._retidas = []
+
+    def adicionar(self, referencia, dados_nfe, tipo_operacao):
+        self._fila.append((referencia, dados_nfe, tipo_operacao))
+        if len(self._fila) >= self.tamanho_chunk:
+            self._gravar()
+
+    def finalizar(self):
+        self._gravar(finalizar=True)
+
+    def _gravar(self, finalizar=False):
+        documentos = self._retidas + self._fila
+        self._fila = []
+        if finalizar:
+            prontos, self._retidas = documentos, []
+        else:
+            prontos, self._retidas = self._separar_retidas(documentos)
+            excesso = len(self._retidas) - self.limite_retidas
+            if excesso > 0:
+                prontos.extend(self._retidas[:excesso])
+                self._retidas = self._retidas[excesso:]
+        if not prontos:
+            return
+
+        with metricas.etapa("gravacao"):
+            resultados = self.estoque_service.processar_lote(
+                [(dados_nfe, tipo_operacao) for _, dados_nfe, tipo_operacao in prontos],
+                progresso=self.progresso
+            )
+        for (referencia, dados_nfe, tipo_operacao), resultado in zip(prontos, resultados):
+            dados_nfe.pop("xml_content", None)
+            self.ao_gravar(referencia, dados_nfe, tipo_operacao, resultado)
 
+    def _separar_retidas(self, documentos):
+        # Entradas só seguem se ao menos uma NF referenciada já está gravada ou vem neste chunk
+        saidas = {dados_nfe["chave_acesso"] for _, dados_nfe, tipo_operacao in documentos if tipo_operacao == "SAIDA"}
+        referenciadas = {
+            chave
+            for _, dados_nfe, tipo_operacao in documentos if tipo_operacao != "SAIDA"
+            for chave in dados_nfe.get("nf_saida_referenciada_chaves") or []
+        } - saidas
+        disponiveis = saidas | (self.estoque_service.get_chaves_existentes(referenciadas) if referenciadas else set())
 
+        prontos = []
+        retidas = []
+        for documento in documentos:
+            _, dados_nfe, tipo_operacao = documento
+            chaves = dados_nfe.get("nf_saida_referenciada_chaves") or []
+            if tipo_operacao != "SAIDA" and chaves and not any(chave in disponiveis for chave in chaves):
+                retidas.append(documento)
+            else:
+                prontos.append(documento)
+        return prontos, retidas
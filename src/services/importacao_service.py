@@ -0,0 +1,94 @@
+import os
+import tempfile
+from src import metricas
+from src.extensions import db, sessao_ingestao
+from src.models.job import ArquivoImportacao
+from src.services.estoque_service import GravacaoIncremental
+
+
+class ImportacaoService:
+    """Importação em lote de XMLs (lista ou arquivo ZIP) com gravação em massa."""
+
+    def __init__(self, xml_processor, estoque_service):
+        self.xml_processor = xml_processor
+        self.estoque_service = estoque_service
+
+    def guardar_arquivo(self, nome, conteudo):
+        # O ZIP fica no banco, visível para qualquer instância que pegar o job
+        arquivo = ArquivoImportacao(nome=nome, conteudo=conteudo)
+        db.session.add(arquivo)
+        db.session.commit()
+        return arquivo.id
+
+    def importar(self, xmls=None, arquivo_id=None, arquivo_zip=None, progresso=None, workers=None):
+        if arquivo_id is None:
+            return self._importar(xmls, arquivo_zip, progresso, workers)
+
+        conteudo = db.session.query(ArquivoImportacao.conteudo).filter_by(id=arquivo_id).scalar()
+        if conteudo is None:
+            return {"sucesso": False, "erro": f"Arquivo de importação {arquivo_id} não encontrado"}
+        # Os filhos do parse em lote leem o ZIP do disco: grava uma cópia local só durante o job
+        descritor, caminho = tempfile.mkstemp(suffix=".zip")
+        with os.fdopen(descritor, "wb") as destino:
+            destino.write(conteudo)
+        del conteudo
+        try:
+            return self._importar(None, caminho, progresso, workers)
+        finally:
+            if os.path.exists(caminho):
+                os.remove(caminho)
+            # O ZIP sai do banco também quando a importação falha (o job fica em ERRO, sem nova tentativa)
+            db.session.rollback()
+            db.session.query(ArquivoImportacao).filter_by(id=arquivo_id).delete()
+            db.session.commit()
+
+    def _importar(self, xmls, arquivo_zip, progresso, workers):
+        # O parse roda em um pool de processos (XMLProcessor.parse_em_lote); a gravação fica neste processo
+        payloads = self.xml_processor.membros_zip(arquivo_zip) if arquivo_zip else (xmls or [])
+        if progresso:
+            progresso.buscado(len(payloads))
+
+        # Um resultado por XML recebido, na ordem de entrada, com o índice (e o nome no ZIP)
+        resultados = [None] * len(payloads)
+
+        def ao_gravar(indice, dados_nfe, tipo_operacao, resultado):
+            resultados[indice] = resultado
+
+        # Cada chunk interpretado é gravado enquanto os filhos interpretam o seguinte
+        gravacao = GravacaoIncremental(self.estoque_service, ao_gravar, progresso=progresso)
+        indice = 0
+        with sessao_ingestao():
+            chunks = self.xml_processor.parse_em_lote(payloads, workers=workers)
+            for chunk in metricas.medir_iteracao("parse_xml", chunks):
+                for resultado_xml in chunk:
+                    if not resultado_xml["sucesso"]:
+                        resultados[indice] = {"sucesso": False, "erro": resultado_xml["erro"]}
+                        if progresso:
+                            progresso.erro(f"{self._identificar(payloads[indice], indice)}: {resultado_xml['erro']}")
+                    else:
+                        dados_nfe = resultado_xml["dados_nfe"]
+                        dados_nfe["xml_content"] = resultado_xml["xml_content"]
+                        gravacao.adicionar(indice, dados_nfe, resultado_xml["tipo_operacao"])
+                        if progresso:
+                            progresso.processado()
+                    indice += 1
+            gravacao.finalizar()
+
+        for indice, payload in enumerate(payloads):
+            resultados[indice] = dict(resultados[indice], indice=indice)
+            if arquivo_zip:
+                resultados[indice]["arquivo"] = payload[1]
+
+        if arquivo_zip and os.path.exists(arquivo_zip):
+            os.remove(arquivo_zip)
+
+        return {
+            "sucesso": True,
+            "nfes_recebidas": len(payloads),
+            "nfes_processadas": sum(1 for resultado in resultados if resultado["sucesso"]),
+            "resultados": resultados
+        }
+
+    def _identificar(self, payload, indice):
+        # Membro do ZIP pelo nome; XML enviado na lista pela posição
+        return payload[1] if isinstance(payload, tuple) else f"XML {indice}"
@@ -0,0 +1,202 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from flask import current_app
+from src import metricas
+from src.extensions import db
+from src.models.job import Job
+
+logger = logging.getLogger(__name__)
+
+
+class JobProgresso:
+    """Contadores de progresso de um job, gravados no banco de forma espaçada."""
+
+    def __init__(self, job_id, intervalo=1.0):
+        self.job_id = job_id
+        self.intervalo = intervalo
+        self.buscados = 0
+        self.processados = 0
+        self.persistidos = 0
+        self.erros = []
+        self._ultimo_salvamento = 0.0
+
+    def buscado(self, quantidade=1):
+        self.buscados += quantidade
+        self._talvez_salvar()
+
+    def processado(self, quantidade=1):
+        self.processados += quantidade
+        self._talvez_salvar()
+
+    def persistido(self, quantidade=1):
+        self.persistidos += quantidade
+        self._talvez_salvar()
+
+    def erro(self, mensagem):
+        self.erros.append(mensagem)
+        self._talvez_salvar()
+
+    def _talvez_salvar(self):
+        if time.monotonic() - self._ultimo_salvamento >= self.intervalo:
+            self.salvar()
+
+    def salvar(self, campos=None):
+        # UPDATE direto + commit: não depende do estado da sessão usada pelo processamento
+        campos = dict(campos or {})
+        campos.update({
+            Job.documentos_buscados: self.buscados,
+            Job.documentos_processados: self.processados,
+            Job.documentos_persistidos: self.persistidos,
+            Job.erros: json.dumps(self.erros, ensure_ascii=False),
+            Job.atualizado_em: datetime.utcnow()
+        })
+        db.session.query(Job).filter(Job.id == self.job_id).update(campos, synchronize_session=False)
+        db.session.commit()
+        self._ultimo_salvamento = time.monotonic()
+
+
+class JobService:
+    """Fila de jobs persistida na tabela `jobs`.
+
+    Os jobs são gravados como PENDENTE e executados por um pool de threads
+    local (criado sob demanda, para sobreviver ao fork dos workers do
+    gunicorn) ou por um processo separado (`python -m src.worker`) quando
+    JOBS_EXECUTAR_NA_WEB=false.
+
+    Enquanto um job roda, uma thread de heartbeat atualiza `atualizado_em` a
+    cada JOBS_INTERVALO_HEARTBEAT segundos (padrão: um terço de
+    JOBS_TIMEOUT_ORFAO), então etapas longas sem eventos de progresso (a
+    listagem do Mainô, reconstruir_saldos) não fazem o job parecer órfão.
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = int(max_workers or os.getenv("JOBS_MAX_WORKERS", 2))
+        self.executar_na_web = os.getenv("JOBS_EXECUTAR_NA_WEB", "true").lower() == "true"
+        self.timeout_orfao = timedelta(seconds=int(os.getenv("JOBS_TIMEOUT_ORFAO", 900)))
+        self.intervalo_heartbeat = float(os.getenv("JOBS_INTERVALO_HEARTBEAT", self.timeout_orfao.total_seconds() / 3))
+        self.handlers = {}
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def registrar(self, tipo, handler):
+        # handler(parametros, progresso) -> dict com o resultado do job
+        self.handlers[tipo] = handler
+
+    def enfileirar(self, tipo, parametros=None):
+        if tipo not in self.handlers:
+            raise ValueError(f"Tipo de job desconhecido: {tipo}")
+        job = Job(tipo=tipo, status="PENDENTE", parametros=json.dumps(parametros or {}, ensure_ascii=False))
+        db.session.add(job)
+        db.session.commit()
+        if self.executar_na_web:
+            self._submeter(current_app._get_current_object(), job.id)
+        return job
+
+    def get_job(self, job_id):
+        return db.session.get(Job, job_id)
+
+    def retomar_pendentes(self):
+        # Devolve para a fila jobs cujo worker morreu (sem heartbeat) e submete os pendentes
+        limite = datetime.utcnow() - self.timeout_orfao
+        db.session.query(Job).filter(Job.status == "EXECUTANDO", Job.atualizado_em < limite).update(
+            {Job.status: "PENDENTE"}, synchronize_session=False
+        )
+        db.session.commit()
+        ids = [job_id for (job_id,) in db.session.query(Job.id).filter(Job.status == "PENDENTE").order_by(Job.id)]
+        return ids
+
+    def executar_pendentes(self, app, intervalo=2.0):
+        # Laço do processo worker dedicado
+        while True:
+            with app.app_context():
+                ids = self.retomar_pendentes()
+            for job_id in ids:
+                self.executar(app, job_id)
+            if not ids:
+                time.sleep(intervalo)
+
+    def executar(self, app, job_id):
+        with app.app_context():
+            if not self._reservar(job_id):
+                return
+            job = db.session.get(Job, job_id)
+            parametros = job.get_parametros()
+            progresso = JobProgresso(job_id)
+            token = metricas.definir_endpoint(f"job:{job.tipo}")
+            try:
+                with self._heartbeat(app, job_id):
+                    resultado = self._executar_handler(job.tipo, parametros, progresso)
+                status = "CONCLUIDO"
+            except Exception as e:
+                logger.exception("Job %s falhou", job_id)
+                db.session.rollback()
+                resultado = {"sucesso": False, "erro": f"Erro interno: {e}"}
+                progresso.erros.append(resultado["erro"])
+                status = "ERRO"
+            finally:
+                metricas.restaurar_endpoint(token)
+            progresso.salvar({
+                Job.status: status,
+                Job.resultado: json.dumps(resultado, ensure_ascii=False, default=str),
+                Job.finalizado_em: datetime.utcnow()
+            })
+
+    def _executar_handler(self, tipo, parametros, progresso):
+        if parametros.get("perfilar"):
+            # Perfil do cProfile de uma única execução, devolvido junto com o resultado
+            resultado, perfil = metricas.perfilar(self.handlers[tipo], parametros, progresso)
+            return dict(resultado, perfil=perfil)
+        return self.handlers[tipo](parametros, progresso)
+
+    @contextmanager
+    def _heartbeat(self, app, job_id):
+        # Thread própria, com a própria sessão (outro app context): o UPDATE não passa pela
+        # transação do processamento, que pode ficar aberta durante uma etapa longa
+        parar = threading.Event()
+
+        def bater():
+            while not parar.wait(self.intervalo_heartbeat):
+                try:
+                    with app.app_context():
+                        db.session.query(Job).filter(Job.id == job_id, Job.status == "EXECUTANDO").update(
+                            {Job.atualizado_em: datetime.utcnow()}, synchronize_session=False
+                        )
+                        db.session.commit()
+                except Exception:
+                    # Um batimento perdido (por exemplo, banco ocupado) é tentado de novo no próximo intervalo
+                    logger.warning("Falha no heartbeat do job %s", job_id, exc_info=True)
+
+        thread = threading.Thread(target=bater, name=f"job-{job_id}-heartbeat", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            parar.set()
+            thread.join()
+
+    def _reservar(self, job_id):
+        # UPDATE condicional: só um worker consegue passar o job de PENDENTE para EXECUTANDO
+        agora = datetime.utcnow()
+        reservados = db.session.query(Job).filter(Job.id == job_id, Job.status == "PENDENTE").update(
+            {Job.status: "EXECUTANDO", Job.iniciado_em: agora, Job.atualizado_em: agora}, synchronize_session=False
+        )
+        db.session.commit()
+        return reservados == 1
+
+    def _submeter(self, app, job_id):
+        with self._lock:
+            # Recria o pool após fork (gunicorn com preload) e, na primeira vez, retoma os pendentes
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="job")
+                self._pid = os.getpid()
+                for pendente_id in self.retomar_pendentes():
+                    if pendente_id != job_id:
+                        self._executor.submit(self.executar, app, pendente_id)
+        self._executor.submit(self.executar, app, job_id)
@@ -1,9 +1,32 @@
 import requests
 import os
+import threading
+from flask import current_app
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import zipfile
 import io
 from datetime import datetime, timedelta
 
+_lock_extensao = threading.Lock()
+
+
+def get_maino_api(app=None):
+    """Cliente do Mainô da aplicação, criado no primeiro uso.
+
+    Fica em `app.extensions`, então todas as requisições e jobs de um
+    processo compartilham a mesma sessão HTTP (pool de conexões). Levanta
+    ValueError se as credenciais não estiverem configuradas; nesse caso nada
+    é guardado e a próxima chamada tenta de novo.
+    """
+    app = app or current_app._get_current_object()
+    with _lock_extensao:
+        maino_api = app.extensions.get("maino_api")
+        if maino_api is None:
+            maino_api = app.extensions["maino_api"] = MainoAPI()
+    return maino_api
+
+
 class MainoAPI:
     def __init__(self):
         self.base_url = "https://api.maino.com.br/"
@@ -21,27 +44,69 @@ class MainoAPI:
         elif self.bearer_token:
             self.headers["Authorization"] = f"Bearer {self.bearer_token}"
 
+        # Timeouts separados de conexão e leitura (segundos)
+        self.connect_timeout = float(os.getenv("MAINO_CONNECT_TIMEOUT", 5))
+        self.read_timeout = float(os.getenv("MAINO_READ_TIMEOUT", 60))
+
+        # Sessão persistente: reaproveita conexões TCP/TLS entre chamadas (keep-alive)
+        self.session = self._criar_sessao(
+            pool_size=int(os.getenv("MAINO_POOL_SIZE", 10)),
+            max_retries=int(os.getenv("MAINO_MAX_RETRIES", 5)),
+            backoff_factor=float(os.getenv("MAINO_BACKOFF_FACTOR", 0.5)),
+            backoff_max=float(os.getenv("MAINO_BACKOFF_MAX", 30)),
+            backoff_jitter=float(os.getenv("MAINO_BACKOFF_JITTER", 0.5))
+        )
+
+    def _criar_sessao(self, pool_size, max_retries, backoff_factor, backoff_max, backoff_jitter):
+        # Retenta 429/5xx com backoff exponencial + jitter, respeitando o cabeçalho Retry-After
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=max_retries,
+            status=max_retries,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["GET"]),
+            backoff_factor=backoff_factor,
+            backoff_max=backoff_max,
+            backoff_jitter=backoff_jitter,
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True, max_retries=retry)
+        session = requests.Session()
+        session.headers.update(self.headers)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
     def test_connection(self):
         try:
             # Endpoint para testar a conexão e autenticação usando um endpoint de NF-e
-            response = requests.get(f"{self.base_url}api/v1/nfe/emitidas?dataInicial=2024-01-01&dataFinal=2024-01-01", headers=self.headers, timeout=5)
+            response = self.session.get(
+                f"{self.base_url}api/v1/nfe/emitidas?dataInicial=2024-01-01&dataFinal=2024-01-01",
+                timeout=(self.connect_timeout, min(self.read_timeout, 5))
+            )
             response.raise_for_status()
             return {"sucesso": True, "mensagem": "Conexão com Mainô estabelecida."}
         except requests.exceptions.RequestException as e:
             return {"sucesso": False, "erro": f"Erro de conexão com Mainô: {e}"}
 
-    def get_nfes_emitidas(self, start_date: datetime, end_date: datetime):
+    def get_nfes_emitidas(self, start_date: datetime, end_date: datetime, pagina_inicial: int = 1):
         params = {
             "dataInicial": start_date.strftime("%Y-%m-%d"),
             "dataFinal": end_date.strftime("%Y-%m-%d"),
             "tipoDocumento": "NFE", # Filtrar apenas por NF-e
-            "pagina": 1, # Começar na primeira página
+            "pagina": pagina_inicial, # Página inicial (permite retomar uma listagem interrompida)
             "limite": 100 # Limite de itens por página
         }
         nfes_data = []
         while True:
             try:
-                response = requests.get(f"{self.base_url}api/v1/nfe/emitidas", headers=self.headers, params=params, timeout=60)
+                response = self.session.get(f"{self.base_url}api/v1/nfe/emitidas", params=params, timeout=self.timeout)
                 response.raise_for_status()
                 data = response.json()
                 if not data or not data.get("itens"): # Verifica se há itens na resposta
@@ -53,18 +118,19 @@ class MainoAPI:
                     break
             except requests.exceptions.RequestException as e:
                 return {"sucesso": False, "erro": f"Erro ao buscar NF-es emitidas do Mainô: {e}"}
-        return {"sucesso": True, "nfes": nfes_data}
+        return {"sucesso": True, "nfes": nfes_data, "ultima_pagina": params["pagina"]}
 
     def get_nfe_xml_by_chave(self, chave_acesso: str):
         try:
-            response = requests.get(f"{self.base_url}api/v1/nfe/xml?chaveAcesso={chave_acesso}", headers=self.headers, timeout=60)
+            response = self.session.get(f"{self.base_url}api/v1/nfe/xml", params={"chaveAcesso": chave_acesso}, timeout=self.timeout)
             response.raise_for_status()
             return {"sucesso": True, "xml_content": response.text}
         except requests.exceptions.RequestException as e:
             return {"sucesso": False, "erro": f"Erro ao buscar XML da NF-e {chave_acesso}: {e}"}
 
-    def extract_xmls_from_zip(self, zip_content):
-        # Este método pode ser removido se não for mais usado para exportar ZIPs
+    @staticmethod
+    def extract_xmls_from_zip(zip_content):
+        # Lê todos os XMLs de um ZIP para memória (aceita caminho ou objeto de arquivo)
         xml_contents = []
         with zipfile.ZipFile(zip_content, "r") as zf:
             for name in zf.namelist():
@@ -0,0 +1,231 @@
+import os
+from decimal import Decimal
+from sqlalchemy import case, delete, func, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+from src.extensions import db, executar_leitura
+from src.models.nfe import EstoqueConsignacao
+from src.models.resumo import ResumoEstoque, ResumoProduto, ResumoDestinatario
+
+
+ZERO = Decimal(0)
+
+
+class VariacaoResumo:
+    """Acumula, durante a gravação de uma ou mais NF-es, as variações dos agregados."""
+
+    def __init__(self, limite_saldo_baixo):
+        self.limite_saldo_baixo = limite_saldo_baixo
+        self.produtos = {} # codigo_produto -> [saldo, linhas, linhas_saldo_baixo]
+        self.destinatarios = {} # cnpj -> [nome, saldo, linhas]
+
+    def _saldo_baixo(self, saldo):
+        return 1 if 0 < saldo < self.limite_saldo_baixo else 0
+
+    def nova_linha(self, codigo_produto, cnpj_destinatario, nome_destinatario, saldo):
+        produto = self.produtos.setdefault(codigo_produto, [ZERO, 0, 0])
+        produto[0] += saldo
+        produto[1] += 1
+        produto[2] += self._saldo_baixo(saldo)
+        destinatario = self.destinatarios.setdefault(cnpj_destinatario, [nome_destinatario, ZERO, 0])
+        destinatario[1] += saldo
+        destinatario[2] += 1
+
+    def saldo_alterado(self, codigo_produto, cnpj_destinatario, nome_destinatario, saldo_anterior, saldo_novo):
+        produto = self.produtos.setdefault(codigo_produto, [ZERO, 0, 0])
+        produto[0] += saldo_novo - saldo_anterior
+        produto[2] += self._saldo_baixo(saldo_novo) - self._saldo_baixo(saldo_anterior)
+        destinatario = self.destinatarios.setdefault(cnpj_destinatario, [nome_destinatario, ZERO, 0])
+        destinatario[1] += saldo_novo - saldo_anterior
+
+
+class ResumoService:
+    """Mantém os agregados de /resumo (resumo_estoque, resumo_produto, resumo_destinatario).
+
+    As variações são aplicadas na mesma transação que grava a NF-e, com
+    incrementos atômicos (UPDATE col = col + delta / upsert), então a leitura
+    do resumo é uma consulta por chave primária, sem escrita.
+
+    O limite de saldo baixo fica só na linha de resumo_estoque: todos os
+    processos usam o mesmo valor. ESTOQUE_LIMITE_SALDO_BAIXO é o valor com
+    que a linha é criada (migração 7); para trocá-lo, reconstruir com outro
+    limite (job RECONSTRUCAO_SALDOS com "limite_saldo_baixo").
+    """
+
+    def __init__(self):
+        self.limite_padrao = Decimal(os.getenv("ESTOQUE_LIMITE_SALDO_BAIXO", "10"))
+
+    def limite_saldo_baixo(self, conexao=None):
+        limite = (conexao or db.session).execute(
+            select(ResumoEstoque.limite_saldo_baixo).where(ResumoEstoque.id == 1)
+        ).scalar()
+        return self.limite_padrao if limite is None else limite
+
+    def nova_variacao(self):
+        return VariacaoResumo(self.limite_saldo_baixo())
+
+    def aplicar(self, variacao):
+        novos_produtos = 0
+        novos_destinatarios = 0
+        saldo_total = ZERO
+        saldo_baixo = 0
+
+        totais_produtos = self._upsert(ResumoProduto, "codigo_produto", [
+            {
+                "codigo_produto": codigo_produto,
+                "saldo_disponivel": saldo,
+                "linhas": linhas,
+                "linhas_saldo_baixo": linhas_saldo_baixo
+            }
+            for codigo_produto, (saldo, linhas, linhas_saldo_baixo) in variacao.produtos.items()
+        ], ["saldo_disponivel", "linhas", "linhas_saldo_baixo"])
+        for codigo_produto, (saldo, linhas, linhas_saldo_baixo) in variacao.produtos.items():
+            # Registros de estoque nunca são apagados: se o total é igual ao incremento, o produto é novo
+            if linhas and totais_produtos[codigo_produto] == linhas:
+                novos_produtos += 1
+            saldo_total += saldo
+            saldo_baixo += linhas_saldo_baixo
+
+        totais_destinatarios = self._upsert(ResumoDestinatario, "cnpj_destinatario", [
+            {
+                "cnpj_destinatario": cnpj_destinatario,
+                "nome_destinatario": nome_destinatario,
+                "saldo_disponivel": saldo,
+                "linhas": linhas
+            }
+            for cnpj_destinatario, (nome_destinatario, saldo, linhas) in variacao.destinatarios.items()
+        ], ["saldo_disponivel", "linhas"])
+        for cnpj_destinatario, (_, _, linhas) in variacao.destinatarios.items():
+            if linhas and totais_destinatarios[cnpj_destinatario] == linhas:
+                novos_destinatarios += 1
+
+        if not (novos_produtos or novos_destinatarios or saldo_total or saldo_baixo):
+            return
+        atualizados = db.session.query(ResumoEstoque).filter(
+            ResumoEstoque.id == 1,
+            ResumoEstoque.limite_saldo_baixo == variacao.limite_saldo_baixo
+        ).update({
+            ResumoEstoque.total_produtos: ResumoEstoque.total_produtos + novos_produtos,
+            ResumoEstoque.total_destinatarios: ResumoEstoque.total_destinatarios + novos_destinatarios,
+            ResumoEstoque.saldo_total_disponivel: ResumoEstoque.saldo_total_disponivel + saldo_total,
+            ResumoEstoque.produtos_saldo_baixo: ResumoEstoque.produtos_saldo_baixo + saldo_baixo
+        }, synchronize_session=False)
+        if not atualizados:
+            # Linha ausente (banco sem a migração 7) ou limite trocado por uma reconstrução
+            # concorrente: recalcula tudo a partir do estoque, dentro desta transação de escrita
+            db.session.flush()
+            self.reconstruir()
+
+    def get_resumo(self):
+        # Só leitura: sem a linha (banco ainda não migrado), devolve os totais zerados
+        resumo = db.session.get(ResumoEstoque, 1)
+        if not resumo:
+            return {
+                "total_produtos": 0,
+                "total_destinatarios": 0,
+                "saldo_total_disponivel": ZERO,
+                "produtos_saldo_baixo": 0,
+                "limite_saldo_baixo": self.limite_padrao
+            }
+        return {
+            "total_produtos": resumo.total_produtos,
+            "total_destinatarios": resumo.total_destinatarios,
+            "saldo_total_disponivel": resumo.saldo_total_disponivel,
+            "produtos_saldo_baixo": resumo.produtos_saldo_baixo,
+            "limite_saldo_baixo": resumo.limite_saldo_baixo
+        }
+
+    def get_resumo_produtos(self, apenas_saldo_baixo=False, limite=100):
+        consulta = ResumoProduto.query
+        if apenas_saldo_baixo:
+            consulta = consulta.filter(ResumoProduto.linhas_saldo_baixo > 0)
+        return [
+            {
+                "codigo_produto": p.codigo_produto,
+                "saldo_disponivel": p.saldo_disponivel,
+                "linhas": p.linhas,
+                "linhas_saldo_baixo": p.linhas_saldo_baixo
+            }
+            for p in executar_leitura(consulta.order_by(ResumoProduto.saldo_disponivel.desc()).limit(limite)).scalars()
+        ]
+
+    def get_resumo_destinatarios(self, limite=100):
+        return [
+            {
+                "cnpj_destinatario": d.cnpj_destinatario,
+                "nome_destinatario": d.nome_destinatario,
+                "saldo_disponivel": d.saldo_disponivel,
+                "linhas": d.linhas
+            }
+            for d in executar_leitura(
+                ResumoDestinatario.query.order_by(ResumoDestinatario.saldo_disponivel.desc()).limit(limite)
+            ).scalars()
+        ]
+
+    def reconstruir(self, conexao=None, limite=None):
+        """Recalcula os agregados com consultas agrupadas, sem commit.
+
+        Roda na transação corrente da sessão ou em `conexao` (migrações). Sem
+        `limite`, mantém o limite de saldo baixo já gravado.
+        """
+        executar = (conexao or db.session).execute
+        limite = self.limite_saldo_baixo(conexao) if limite is None else Decimal(limite)
+        saldo_baixo = case(
+            ((EstoqueConsignacao.saldo_disponivel_nf > 0) & (EstoqueConsignacao.saldo_disponivel_nf < limite), 1),
+            else_=0
+        )
+
+        executar(delete(ResumoProduto))
+        executar(insert(ResumoProduto).from_select(
+            ["codigo_produto", "saldo_disponivel", "linhas", "linhas_saldo_baixo"],
+            select(
+                EstoqueConsignacao.codigo_produto,
+                func.coalesce(func.sum(EstoqueConsignacao.saldo_disponivel_nf), 0),
+                func.count(),
+                func.sum(saldo_baixo)
+            ).group_by(EstoqueConsignacao.codigo_produto)
+        ))
+
+        executar(delete(ResumoDestinatario))
+        executar(insert(ResumoDestinatario).from_select(
+            ["cnpj_destinatario", "nome_destinatario", "saldo_disponivel", "linhas"],
+            select(
+                EstoqueConsignacao.cnpj_destinatario,
+                func.max(EstoqueConsignacao.nome_destinatario),
+                func.coalesce(func.sum(EstoqueConsignacao.saldo_disponivel_nf), 0),
+                func.count()
+            ).group_by(EstoqueConsignacao.cnpj_destinatario)
+        ))
+
+        totais = executar(select(
+            func.count(),
+            func.coalesce(func.sum(ResumoProduto.saldo_disponivel), 0),
+            func.coalesce(func.sum(ResumoProduto.linhas_saldo_baixo), 0)
+        )).one()
+        valores = {
+            "total_produtos": totais[0],
+            "total_destinatarios": executar(select(func.count()).select_from(ResumoDestinatario)).scalar(),
+            "saldo_total_disponivel": totais[1],
+            "produtos_saldo_baixo": totais[2],
+            "limite_saldo_baixo": limite
+        }
+        self._upsert(ResumoEstoque, "id", [dict(valores, id=1)], [], substituir=list(valores), conexao=conexao)
+
+    def _upsert(self, modelo, chave, valores, incrementos, substituir=(), conexao=None):
+        # Um INSERT ... ON CONFLICT DO UPDATE SET col = col + excluded.col (ou = excluded.col, para
+        # `substituir`) para todas as linhas (executemany em lote), devolvendo {chave: total de linhas}
+        if not valores:
+            return {}
+        conexao = conexao or db.session
+        bind = conexao.get_bind() if hasattr(conexao, "get_bind") else conexao # Session ou Connection
+        dialeto = postgresql if bind.dialect.name == "postgresql" else sqlite
+        stmt = dialeto.insert(modelo)
+        colunas = modelo.__table__.c
+        atribuicoes = {coluna: colunas[coluna] + stmt.excluded[coluna] for coluna in incrementos}
+        atribuicoes.update({coluna: stmt.excluded[coluna] for coluna in substituir})
+        stmt = stmt.on_conflict_do_update(index_elements=[chave], set_=atribuicoes)
+        if "linhas" not in colunas:
+            conexao.execute(stmt, valores)
+            return {}
+        stmt = stmt.returning(colunas[chave], colunas.linhas)
+        # Ordenadas pela chave: transações concorrentes bloqueiam as linhas na mesma ordem
+        return dict(conexao.execute(stmt, sorted(valores, key=lambda linha: linha[chave])).all())
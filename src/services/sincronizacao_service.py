@@ -0,0 +1,262 @@
+import contextvars
+import os
+import queue
+import threading
+from datetime import datetime, timedelta
+from src import metricas
+from src.extensions import db, sessao_ingestao
+from src.models.sincronizacao import FalhaSincronizacao, SincronizacaoMaino
+from src.services.estoque_service import GravacaoIncremental
+
+# Marcador enviado por cada thread de download ao terminar
+_FIM = object()
+
+
+class SincronizacaoService:
+    """Pipeline de sincronização com o Mainô.
+
+    Os XMLs são baixados por um número limitado de threads (estágio de busca)
+    e entregues por uma fila limitada ao estágio de parse/persistência, que
+    roda na thread chamadora para manter a sessão do banco em uma única
+    thread. Quando a fila enche, as threads de busca ficam bloqueadas
+    (backpressure). A gravação é feita em chunks (GravacaoIncremental): as
+    entradas cuja NF de saída ainda não foi gravada esperam por ela, então a
+    ordem em que os downloads terminam não importa.
+
+    NF-es que falham ficam em `falhas_sincronizacao` com o número de
+    tentativas; a marca d'água não passa delas até `max_tentativas`
+    execuções seguidas terem falhado. Depois disso a NF-e fica registrada
+    como abandonada e a sincronização segue em frente.
+    """
+
+    def __init__(self, maino_api, xml_processor, estoque_service, concorrencia=None, tamanho_fila=None):
+        self.maino_api = maino_api
+        self.xml_processor = xml_processor
+        self.estoque_service = estoque_service
+        self.concorrencia = max(1, int(concorrencia or os.getenv("MAINO_SYNC_CONCORRENCIA", 8)))
+        self.tamanho_fila = max(1, int(tamanho_fila or os.getenv("MAINO_SYNC_TAMANHO_FILA", self.concorrencia * 4)))
+        # Execuções com falha em uma mesma NF-e antes de a marca d'água seguir sem ela
+        self.max_tentativas = max(1, int(os.getenv("MAINO_SYNC_MAX_TENTATIVAS", 5)))
+
+    def get_estado(self):
+        estado = SincronizacaoMaino.query.first()
+        if not estado:
+            estado = SincronizacaoMaino(ultima_pagina=1)
+            db.session.add(estado)
+            db.session.commit() # Grava já, para não ser descartado por um rollback durante a sincronização
+        return estado
+
+    def get_ultima_sincronizacao(self):
+        estado = SincronizacaoMaino.query.first()
+        return estado.ultima_sincronizacao if estado else None
+
+    def executar(self, dias_atras, completo=False, progresso=None):
+        """Sincroniza a partir da marca d'água persistida.
+
+        A janela começa no dia da última emissão já gravada (limitada a
+        `dias_atras`); com `completo=True` a marca d'água é ignorada e todo o
+        período de `dias_atras` é listado novamente.
+        """
+        estado = self.get_estado()
+        end_date = datetime.now()
+        start_date = end_date - timedelta(days=dias_atras)
+        if not completo and estado.ultima_data_emissao and estado.ultima_data_emissao > start_date:
+            start_date = estado.ultima_data_emissao
+
+        # A paginação só pode ser retomada se a janela começar no mesmo dia
+        pagina_inicial = 1
+        if not completo and estado.data_inicial_janela == start_date.date() and estado.ultima_pagina:
+            pagina_inicial = estado.ultima_pagina
+
+        with metricas.etapa("maino_listagem"):
+            resultado_nfes = self.maino_api.get_nfes_emitidas(start_date, end_date, pagina_inicial=pagina_inicial)
+        if not resultado_nfes["sucesso"]:
+            return resultado_nfes
+
+        with sessao_ingestao():
+            resultado = self.sincronizar(resultado_nfes["nfes"], progresso=progresso)
+
+        pendentes, abandonadas = self._registrar_falhas(resultado.pop("falhas"), resultado.pop("chaves_gravadas"))
+        resultado["nfes_com_falha"] = len(pendentes) + len(abandonadas)
+        resultado["nfes_abandonadas"] = abandonadas
+        estado.ultima_sincronizacao = datetime.now()
+        estado.data_inicial_janela = start_date.date()
+        # Com falhas a tentar de novo, a próxima execução lista a janela desde a primeira página
+        # (as chaves já gravadas são descartadas antes do download)
+        estado.ultima_pagina = 1 if pendentes else resultado_nfes["ultima_pagina"]
+
+        # A marca d'água para na emissão mais antiga entre as falhas a tentar de novo, para que
+        # voltem a ser listadas; sem a data (XML não baixado ou não interpretado), não avança
+        nova_marca = resultado["ultima_data_emissao"]
+        if pendentes:
+            datas = [falha.data_emissao for falha in pendentes]
+            nova_marca = None if None in datas else min(datas)
+        if nova_marca and (not estado.ultima_data_emissao or nova_marca > estado.ultima_data_emissao):
+            estado.ultima_data_emissao = nova_marca
+        db.session.commit()
+
+        resultado["ultima_data_emissao"] = estado.ultima_data_emissao.isoformat() if estado.ultima_data_emissao else None
+        resultado["ultima_sincronizacao"] = estado.ultima_sincronizacao.isoformat()
+        return resultado
+
+    def _registrar_falhas(self, falhas, chaves_gravadas):
+        """Atualiza falhas_sincronizacao; devolve (falhas a tentar de novo, chaves abandonadas agora)."""
+        conhecidas = {falha.chave_acesso: falha for falha in FalhaSincronizacao.query}
+        for chave_acesso in chaves_gravadas:
+            if chave_acesso in conhecidas:
+                db.session.delete(conhecidas.pop(chave_acesso))
+
+        pendentes = []
+        abandonadas = []
+        agora = datetime.now()
+        for chave_acesso, data_emissao, erro in falhas:
+            falha = conhecidas.get(chave_acesso)
+            if falha is None:
+                falha = FalhaSincronizacao(chave_acesso=chave_acesso, tentativas=0)
+                db.session.add(falha)
+            falha.tentativas += 1
+            falha.data_emissao = data_emissao or falha.data_emissao
+            falha.ultimo_erro = erro
+            falha.atualizado_em = agora
+            if falha.tentativas < self.max_tentativas:
+                pendentes.append(falha)
+            elif falha.tentativas == self.max_tentativas:
+                abandonadas.append(chave_acesso)
+        return pendentes, abandonadas
+
+    def sincronizar(self, nfes_para_processar, progresso=None):
+        """Baixa, interpreta e grava as NF-es listadas.
+
+        `progresso`, se informado, recebe os eventos buscado/processado/persistido/erro
+        (ver JobProgresso).
+        """
+        chaves = queue.Queue()
+        erros = []
+
+        def registrar_erro(mensagem):
+            erros.append(mensagem)
+            if progresso:
+                progresso.erro(mensagem)
+        chaves_listadas = []
+        for nfe_item in nfes_para_processar:
+            chave_acesso = nfe_item.get("chaveAcesso")
+            if not chave_acesso:
+                registrar_erro(f"NF-e sem chave de acesso: {nfe_item.get('numero')}")
+                continue
+            chaves_listadas.append(chave_acesso)
+
+        # Descarta, antes de baixar qualquer XML, as chaves já gravadas
+        chaves_existentes = self.estoque_service.get_chaves_existentes(chaves_listadas)
+        for chave_acesso in dict.fromkeys(chaves_listadas):
+            if chave_acesso not in chaves_existentes:
+                chaves.put(chave_acesso)
+
+        resultados = queue.Queue(maxsize=self.tamanho_fila)
+        parar = threading.Event()
+        total_threads = min(self.concorrencia, chaves.qsize()) or 1
+        # Cada thread herda uma cópia do contexto (endpoint das métricas)
+        threads = [
+            threading.Thread(
+                target=contextvars.copy_context().run,
+                args=(self._buscar_xmls, chaves, resultados, parar),
+                daemon=True
+            )
+            for _ in range(total_threads)
+        ]
+        for thread in threads:
+            thread.start()
+
+        contagem = {"processadas": 0, "saida": 0, "entrada": 0, "ja_processadas": len(chaves_existentes)}
+        falhas = [] # (chave_acesso, data_emissao ou None, erro)
+        chaves_gravadas = list(chaves_existentes)
+        # As já gravadas também contam para a marca d'água (a emissão delas vem do banco)
+        ultima_data_emissao = self.estoque_service.get_ultima_emissao(chaves_existentes)
+
+        def ao_gravar(chave_acesso, dados_nfe, tipo_operacao, resultado):
+            nonlocal ultima_data_emissao
+            data_emissao = dados_nfe["data_emissao"].replace(tzinfo=None)
+            if resultado.get("duplicada"):
+                # Gravada por outra execução entre a listagem e agora
+                contagem["ja_processadas"] += 1
+            elif not resultado["sucesso"]:
+                # processar_lote já registrou a mensagem no progresso
+                erros.append(f"NF {dados_nfe['numero_nf']}: {resultado['erro']}")
+                falhas.append((chave_acesso, data_emissao, resultado["erro"]))
+            else:
+                contagem["processadas"] += 1
+                contagem["saida" if tipo_operacao == "SAIDA" else "entrada"] += 1
+            if resultado["sucesso"] or resultado.get("duplicada"):
+                chaves_gravadas.append(chave_acesso)
+            if ultima_data_emissao is None or data_emissao > ultima_data_emissao:
+                ultima_data_emissao = data_emissao
+
+        gravacao = GravacaoIncremental(self.estoque_service, ao_gravar, progresso=progresso)
+        threads_ativas = total_threads
+        try:
+            while threads_ativas:
+                item = resultados.get()
+                if item is _FIM:
+                    threads_ativas -= 1
+                    continue
+
+                chave_acesso, resultado_xml_completo = item
+                if progresso:
+                    progresso.buscado()
+                if not resultado_xml_completo["sucesso"]:
+                    erro = f"Erro ao buscar XML da NF-e {chave_acesso}: {resultado_xml_completo['erro']}"
+                    registrar_erro(erro)
+                    falhas.append((chave_acesso, None, erro))
+                    continue
+
+                documento, erro = self.interpretar_xml(resultado_xml_completo["xml_content"], progresso)
+                if erro:
+                    registrar_erro(f"NF-e {chave_acesso}: {erro}")
+                    falhas.append((chave_acesso, None, erro))
+                    continue
+                gravacao.adicionar(chave_acesso, *documento)
+            gravacao.finalizar()
+        finally:
+            # Em caso de falha no consumidor, libera as threads de busca
+            parar.set()
+            while threads_ativas:
+                if resultados.get() is _FIM:
+                    threads_ativas -= 1
+
+        return {
+            "sucesso": True,
+            "nfes_encontradas": len(nfes_para_processar),
+            "nfes_ja_processadas": contagem["ja_processadas"],
+            "nfes_processadas": contagem["processadas"],
+            "nfes_saida": contagem["saida"],
+            "nfes_entrada": contagem["entrada"],
+            "erros": erros,
+            "falhas": falhas,
+            "chaves_gravadas": chaves_gravadas,
+            "ultima_data_emissao": ultima_data_emissao
+        }
+
+    def _buscar_xmls(self, chaves, resultados, parar):
+        try:
+            while not parar.is_set():
+                try:
+                    chave_acesso = chaves.get_nowait()
+                except queue.Empty:
+                    break
+                with metricas.etapa("maino_xml"):
+                    resultado_xml = self.maino_api.get_nfe_xml_by_chave(chave_acesso)
+                resultados.put((chave_acesso, resultado_xml))
+        finally:
+            resultados.put(_FIM)
+
+    def interpretar_xml(self, xml_content, progresso=None):
+        # Devolve ((dados_nfe, tipo_operacao), None) ou (None, mensagem de erro)
+        with metricas.etapa("parse_xml"):
+            resultado_xml = self.xml_processor.parse_nfe_xml(xml_content)
+        if not resultado_xml["sucesso"]:
+            return None, f"Erro ao processar XML: {resultado_xml['erro']}"
+        if progresso:
+            progresso.processado()
+
+        dados_nfe = resultado_xml["dados_nfe"]
+        dados_nfe["xml_content"] = xml_content
+        return (dados_nfe, resultado_xml["tipo_operacao"]), None
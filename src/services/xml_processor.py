@@ -1,6 +1,83 @@
+import multiprocessing
+import os
+import re
+import zipfile
 import xml.etree.ElementTree as ET
-from src.models.nfe import NotaFiscal, ItemNotaFiscal
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from decimal import Decimal
+
+TAMANHO_BLOCO_LEITURA = 64 * 1024
+
+# Campos do cabeçalho lidos no parse em streaming: (tag pai, tag) -> chave em dados_nfe
+CAMPOS_CABECALHO = {
+    ("ide", "nNF"): "numero_nf",
+    ("ide", "serie"): "serie",
+    ("ide", "dhEmi"): "data_emissao",
+    ("dest", "CNPJ"): "cnpj",
+    ("dest", "CPF"): "cpf",
+    ("dest", "xNome"): "nome_destinatario",
+}
+
+# Campos de produto lidos dentro de det/prod: tag -> chave do item
+CAMPOS_PRODUTO = {
+    "cProd": "codigo_produto",
+    "xProd": "descricao_produto",
+    "qCom": "quantidade",
+    "vUnCom": "valor_unitario",
+    "vProd": "valor_total",
+    "CFOP": "cfop",
+    "xLote": "x_lote",
+    "nLote": "n_lote",
+}
+
+# Estado por processo do pool de parse (criado sob demanda em cada processo filho)
+_processor_filho = None
+_zips_abertos = {}
+
+
+def _parse_payload(payload):
+    """Interpreta um XML dentro de um processo do pool.
+
+    `payload` é o conteúdo (str/bytes) ou uma tupla (caminho_zip, nome_do_membro);
+    neste caso o próprio filho lê o membro do ZIP, sem trafegar o XML na ida.
+    Falhas de leitura (membro corrompido, codificação inválida) viram um
+    resultado de erro deste payload, como as de parse.
+    """
+    global _processor_filho
+    if _processor_filho is None:
+        _processor_filho = XMLProcessor()
+    try:
+        if isinstance(payload, tuple):
+            caminho_zip, nome = payload
+            if caminho_zip not in _zips_abertos:
+                _zips_abertos[caminho_zip] = zipfile.ZipFile(caminho_zip, "r")
+            dados = _zips_abertos[caminho_zip].read(nome)
+        else:
+            dados = payload
+        # Bytes vão direto ao parser: a declaração XML define a codificação
+        resultado = _processor_filho.parse_nfe_xml(dados)
+        if resultado["sucesso"]:
+            resultado["xml_content"] = _texto_xml(dados)
+        return resultado
+    except Exception as e:
+        return {"sucesso": False, "erro": f"Erro ao ler XML: {e}"}
+
+
+def _texto_xml(dados):
+    # XML como str para gravação (o banco guarda UTF-8); fora de UTF-8, usa a codificação declarada
+    if isinstance(dados, str):
+        return dados
+    try:
+        return dados.decode("utf-8")
+    except UnicodeDecodeError:
+        declaracao = re.match(rb"""<\?xml[^>]*encoding=["']([A-Za-z0-9._-]+)["']""", dados.lstrip())
+        if not declaracao:
+            raise
+        texto = dados.decode(declaracao.group(1).decode("ascii"))
+        # O texto será gravado em UTF-8: a declaração passa a dizer isso
+        return re.sub(r"""(<\?xml[^>]*encoding=["'])[A-Za-z0-9._-]+""", r"\g<1>UTF-8", texto, count=1)
+
 
 class XMLProcessor:
     def __init__(self):
@@ -13,8 +90,19 @@ class XMLProcessor:
         # CFOPs de Entrada (Venda de Mercadoria Consignada)
         self.cfops_venda_consignada = ["5114", "6114"]
 
-    def parse_nfe_xml(self, xml_content):
+    def parse_nfe_xml(self, xml_content, streaming=True):
+        """Interpreta uma NF-e.
+
+        `xml_content` pode ser str, bytes ou um objeto de arquivo. Por padrão
+        usa o parser em streaming (uma passada, sem montar a árvore inteira);
+        `streaming=False` usa o parser baseado em ElementTree completo.
+        """
+        if streaming:
+            return self.parse_nfe_stream(xml_content)
+
         try:
+            if hasattr(xml_content, "read"):
+                xml_content = xml_content.read()
             root = ET.fromstring(xml_content)
             ns = {
                 "nfe": "http://www.portalfiscal.inf.br/nfe",
@@ -23,7 +111,6 @@ class XMLProcessor:
 
             # Dados da NF-e
             ide = root.find(".//nfe:ide", ns)
-            emit = root.find(".//nfe:emit", ns)
             dest = root.find(".//nfe:dest", ns)
 
             numero_nf = ide.find("nfe:nNF", ns).text
@@ -40,15 +127,21 @@ class XMLProcessor:
             # Tipo de Operação
             tipo_operacao = self._determine_operation_type(cfop)
 
+            # NF-es referenciadas (nas entradas, as NFs de saída de origem)
+            chaves_referenciadas = []
+            for ref in root.findall(".//nfe:NFref/nfe:refNFe", ns):
+                if ref.text and ref.text not in chaves_referenciadas:
+                    chaves_referenciadas.append(ref.text)
+
             # Itens da NF-e
             itens = []
             for det in root.findall(".//nfe:det", ns):
                 prod = det.find("nfe:prod", ns)
                 codigo_produto = prod.find("nfe:cProd", ns).text
                 descricao_produto = prod.find("nfe:xProd", ns).text
-                quantidade = float(prod.find("nfe:qCom", ns).text)
-                valor_unitario = float(prod.find("nfe:vUnCom", ns).text)
-                valor_total = float(prod.find("nfe:vProd", ns).text)
+                quantidade = Decimal(prod.find("nfe:qCom", ns).text.strip())
+                valor_unitario = Decimal(prod.find("nfe:vUnCom", ns).text.strip())
+                valor_total = Decimal(prod.find("nfe:vProd", ns).text.strip())
 
                 # Lote (se existir, pode estar em diferentes tags dependendo da NF-e)
                 numero_lote = None
@@ -82,7 +175,8 @@ class XMLProcessor:
                     "nome_destinatario": nome_destinatario,
                     "cfop": cfop,
                     "data_emissao": data_emissao,
-                    "itens": itens
+                    "itens": itens,
+                    "nf_saida_referenciada_chaves": chaves_referenciadas
                 },
                 "tipo_operacao": tipo_operacao,
                 "itens_processados": len(itens)
@@ -94,6 +188,149 @@ class XMLProcessor:
                 "erro": f"Erro ao processar XML: {e}"
             }
 
+    def parse_nfe_stream(self, fonte):
+        # Uma única passada com XMLPullParser: lê cabeçalho e itens na ordem do documento
+        # e descarta cada <det> assim que o item é montado, mantendo a memória constante.
+        try:
+            parser = ET.XMLPullParser(events=("start", "end"))
+            caminho = []
+            cabecalho = {}
+            chave_acesso = None
+            cfop = None
+            itens = []
+            item = None
+            chaves_referenciadas = []
+
+            for bloco in self._ler_blocos(fonte):
+                parser.feed(bloco)
+                for evento, elem in parser.read_events():
+                    tag = elem.tag.rsplit("}", 1)[-1]
+                    if evento == "start":
+                        caminho.append(tag)
+                        if tag == "infNFe" and chave_acesso is None:
+                            chave_acesso = elem.get("Id")[3:] # Remove "NFe"
+                        elif tag == "det":
+                            item = {}
+                        continue
+
+                    caminho.pop()
+                    pai = caminho[-1] if caminho else None
+                    if item is not None:
+                        if pai == "prod" and tag in CAMPOS_PRODUTO:
+                            item[CAMPOS_PRODUTO[tag]] = elem.text
+                        elif pai == "rastro" and tag == "nLote" and "rastro_lote" not in item:
+                            item["rastro_lote"] = elem.text
+                        elif tag == "det":
+                            itens.append(self._montar_item(item))
+                            if cfop is None:
+                                cfop = item.get("cfop")
+                            item = None
+                            elem.clear()
+                    elif (pai, tag) in CAMPOS_CABECALHO:
+                        cabecalho[CAMPOS_CABECALHO[(pai, tag)]] = elem.text
+                    elif pai == "NFref" and tag == "refNFe" and elem.text and elem.text not in chaves_referenciadas:
+                        # NF-es referenciadas (ide/NFref/refNFe): nas entradas, as NFs de saída de origem
+                        chaves_referenciadas.append(elem.text)
+            parser.close()
+
+            if chave_acesso is None or cfop is None or "numero_nf" not in cabecalho:
+                raise ValueError("estrutura de NF-e inválida (infNFe, ide ou det ausente)")
+
+            data_emissao = datetime.fromisoformat(cabecalho["data_emissao"].replace("Z", "+00:00"))
+            cnpj_destinatario = cabecalho.get("cnpj") or cabecalho.get("cpf")
+            if cnpj_destinatario is None or "nome_destinatario" not in cabecalho:
+                raise ValueError("destinatário (dest) não encontrado")
+
+            return {
+                "sucesso": True,
+                "dados_nfe": {
+                    "numero_nf": cabecalho["numero_nf"],
+                    "serie": cabecalho.get("serie"),
+                    "chave_acesso": chave_acesso,
+                    "cnpj_destinatario": cnpj_destinatario,
+                    "nome_destinatario": cabecalho["nome_destinatario"],
+                    "cfop": cfop,
+                    "data_emissao": data_emissao,
+                    "itens": itens,
+                    "nf_saida_referenciada_chaves": chaves_referenciadas
+                },
+                "tipo_operacao": self._determine_operation_type(cfop),
+                "itens_processados": len(itens)
+            }
+
+        except Exception as e:
+            return {
+                "sucesso": False,
+                "erro": f"Erro ao processar XML: {e}"
+            }
+
+    def parse_em_lote(self, payloads, workers=None, tamanho_chunk=None):
+        """Interpreta muitos XMLs em paralelo, em um pool de processos.
+
+        Gera listas de resultados (na ordem de entrada), uma por chunk; cada
+        resultado traz também "xml_content" como str. O chunk seguinte já é
+        enviado ao pool antes de o atual ser entregue, para que o processo pai
+        grave no banco enquanto os filhos interpretam. Com `workers=1` o parse
+        roda no próprio processo; 0 (ou vazio) usa a quantidade de CPUs.
+        """
+        workers = int(workers or os.getenv("XML_PARSE_WORKERS") or 0) or os.cpu_count() or 1
+        tamanho_chunk = int(tamanho_chunk or os.getenv("XML_PARSE_TAMANHO_CHUNK", 200))
+        chunks = self._dividir(payloads, tamanho_chunk)
+
+        if workers == 1:
+            for chunk in chunks:
+                yield [_parse_payload(payload) for payload in chunk]
+            return
+
+        # "spawn": o pool costuma ser criado a partir de uma thread de job, e fork com threads ativas é inseguro
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            chunksize = max(1, tamanho_chunk // (workers * 4))
+            pendente = None
+            for chunk in chunks:
+                proximo = executor.map(_parse_payload, chunk, chunksize=chunksize)
+                if pendente is not None:
+                    yield list(pendente)
+                pendente = proximo
+            if pendente is not None:
+                yield list(pendente)
+
+    def membros_zip(self, caminho_zip):
+        # Referências (caminho, membro) para cada XML do ZIP, para parse_em_lote
+        with zipfile.ZipFile(caminho_zip, "r") as zf:
+            return [(caminho_zip, nome) for nome in zf.namelist() if nome.endswith(".xml")]
+
+    def _dividir(self, payloads, tamanho_chunk):
+        chunk = []
+        for payload in payloads:
+            chunk.append(payload)
+            if len(chunk) == tamanho_chunk:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _ler_blocos(self, fonte):
+        if isinstance(fonte, (str, bytes)):
+            for inicio in range(0, len(fonte), TAMANHO_BLOCO_LEITURA):
+                yield fonte[inicio:inicio + TAMANHO_BLOCO_LEITURA]
+            return
+        while True:
+            bloco = fonte.read(TAMANHO_BLOCO_LEITURA)
+            if not bloco:
+                return
+            yield bloco
+
+    def _montar_item(self, item):
+        # Lote: tag rastro/nLote, depois xLote e nLote diretamente em prod (mesma prioridade do parser completo)
+        return {
+            "codigo_produto": item["codigo_produto"],
+            "descricao_produto": item["descricao_produto"],
+            "numero_lote": item.get("rastro_lote") or item.get("x_lote") or item.get("n_lote"),
+            "quantidade": Decimal(item["quantidade"].strip()),
+            "valor_unitario": Decimal(item["valor_unitario"].strip()),
+            "valor_total": Decimal(item["valor_total"].strip())
+        }
+
     def _determine_operation_type(self, cfop):
         if cfop in self.cfops_saida:
             return "SAIDA"
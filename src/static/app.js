@@ -72,7 +72,7 @@ document.addEventListener("DOMContentLoaded", () => {
             const data = await response.json();
             document.getElementById("total-produtos").textContent = data.total_produtos;
             document.getElementById("total-destinatarios").textContent = data.total_destinatarios;
-            document.getElementById("saldo-total").textContent = data.saldo_total_disponivel.toFixed(2);
+            document.getElementById("saldo-total").textContent = Number(data.saldo_total_disponivel).toFixed(2);
             document.getElementById("saldo-baixo").textContent = data.produtos_saldo_baixo;
 
             // Placeholder para produtos com saldo baixo e últimas movimentações
@@ -201,16 +201,29 @@ document.addEventListener("DOMContentLoaded", () => {
                 <td class="px-6 py-4 whitespace-nowrap text-sm text-gray-500">${item.nome_destinatario || item.cnpj_destinatario}</td>
                 <td class="px-6 py-4 whitespace-nowrap text-sm text-blue-600 font-medium">${item.nf_saida_numero || "N/A"}</td>
                 <td class="px-6 py-4 whitespace-nowrap text-sm text-gray-500">${item.nf_saida_data_emissao || "N/A"}</td>
-                <td class="px-6 py-4 whitespace-nowrap text-sm text-gray-500">${item.quantidade_consignada_nf || 0}</td>
-                <td class="px-6 py-4 whitespace-nowrap text-sm text-gray-500">${item.quantidade_retornada_nf || 0}</td>
-                <td class="px-6 py-4 whitespace-nowrap text-sm text-gray-500">${item.quantidade_faturada_nf || 0}</td>
-                <td class="px-6 py-4 whitespace-nowrap text-sm font-bold ${item.saldo_disponivel_nf > 0 ? 'text-green-600' : 'text-red-600'}">${item.saldo_disponivel_nf || 0}</td>
+                <td class="px-6 py-4 whitespace-nowrap text-sm text-gray-500">${Number(item.quantidade_consignada_nf || 0)}</td>
+                <td class="px-6 py-4 whitespace-nowrap text-sm text-gray-500">${Number(item.quantidade_retornada_nf || 0)}</td>
+                <td class="px-6 py-4 whitespace-nowrap text-sm text-gray-500">${Number(item.quantidade_faturada_nf || 0)}</td>
+                <td class="px-6 py-4 whitespace-nowrap text-sm font-bold ${Number(item.saldo_disponivel_nf) > 0 ? 'text-green-600' : 'text-red-600'}">${Number(item.saldo_disponivel_nf || 0)}</td>
             `;
             tabelaResultados.appendChild(row);
         });
         resultadosConsultaDiv.classList.remove("hidden");
     }
 
+    // Aguarda a conclusão de um job em segundo plano, atualizando a mensagem de progresso
+    async function aguardarJob(jobId) {
+        while (true) {
+            const response = await fetch(`${API_BASE_URL}/api/estoque/jobs/${jobId}`);
+            const job = await response.json();
+            if (job.status === "CONCLUIDO" || job.status === "ERRO") {
+                return job;
+            }
+            loadingText.textContent = `Sincronizando... ${job.documentos_buscados} buscadas, ${job.documentos_processados} processadas, ${job.documentos_persistidos} gravadas`;
+            await new Promise(resolve => setTimeout(resolve, 2000));
+        }
+    }
+
     // Sincronizar com Mainô
     document.getElementById("sincronizar-manual").addEventListener("click", async () => {
         const diasSync = document.getElementById("dias-sync").value;
@@ -223,7 +236,11 @@ document.addEventListener("DOMContentLoaded", () => {
                 },
                 body: JSON.stringify({ dias_atras: parseInt(diasSync) })
             });
-            const result = await response.json();
+            let result = await response.json();
+            if (result.sucesso) {
+                const job = await aguardarJob(result.job_id);
+                result = job.resultado || { sucesso: false, erro: job.erros.join(", ") };
+            }
 
             const resultadoSyncDiv = document.getElementById("resultado-sync");
             const syncDetailsDiv = document.getElementById("sync-details");
@@ -233,6 +250,7 @@ document.addEventListener("DOMContentLoaded", () => {
                 syncDetailsDiv.innerHTML = `
                     <p><strong>Status:</strong> <span class="text-green-700">Sucesso</span></p>
                     <p><strong>NF-es Encontradas:</strong> ${result.nfes_encontradas}</p>
+                    <p><strong>NF-es Já Processadas:</strong> ${result.nfes_ja_processadas}</p>
                     <p><strong>NF-es Processadas:</strong> ${result.nfes_processadas}</p>
                     <p><strong>NF-es de Saída:</strong> ${result.nfes_saida}</p>
                     <p><strong>NF-es de Entrada:</strong> ${result.nfes_entrada}</p>
@@ -272,6 +290,7 @@ document.addEventListener("DOMContentLoaded", () => {
                     integracaoStatusDiv.innerHTML = `
                         <p><strong>Status:</strong> <span class="text-green-700">Conectado</span></p>
                         <p><strong>Mensagem:</strong> Conexão com a API do Mainô estabelecida.</p>
+                        <p><strong>Última Sincronização:</strong> ${result.ultima_sincronizacao ? new Date(result.ultima_sincronizacao).toLocaleString("pt-BR") : "Nunca"}</p>
                     `;
                 } else {
                     statusIndicator.querySelector(".status-indicator").className = "status-indicator status-warning";
@@ -312,7 +331,11 @@ document.addEventListener("DOMContentLoaded", () => {
                 },
                 body: JSON.stringify({ dias_atras: diasSync })
             });
-            const result = await response.json();
+            let result = await response.json();
+            if (result.sucesso) {
+                const job = await aguardarJob(result.job_id);
+                result = job.resultado || { sucesso: false, erro: job.erros.join(", ") };
+            }
             if (result.sucesso) {
                 showToast("Sincronização rápida concluída!", "success");
             } else {
@@ -0,0 +1,22 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+# A importação da app não inicializa o banco: o worker sobe junto com o mestre do
+# gunicorn e a inicialização explícita abaixo passa pelo bloqueio das migrações
+os.environ.setdefault('DB_INICIALIZAR_NA_IMPORTACAO', 'false')
+
+# Processo worker dedicado: executa os jobs PENDENTE gravados pela aplicação web
+# (usar com JOBS_EXECUTAR_NA_WEB=false na web).
+# Os imports ficam aqui dentro: os filhos "spawn" do parse em lote reimportam este
+# módulo como __mp_main__ e não devem montar a app nem tocar no banco
+if __name__ == '__main__':
+    from src.cache import exigir_cache_compartilhado
+    # As invalidações feitas aqui precisam chegar ao cache lido pela web
+    exigir_cache_compartilhado("os jobs gravam neste processo, a web lê em outro")
+    from src.main import app, inicializar_banco
+    from src.routes.estoque import job_service
+
+    inicializar_banco()
+    job_service.executar_pendentes(app)
@@ -0,0 +1,25 @@
+import os
+import tempfile
+import pytest
+
+# Configuração antes de importar a aplicação: banco SQLite temporário e cache desligado
+_diretorio = tempfile.mkdtemp(prefix="consignacoes-testes-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_diretorio, 'testes.db')}"
+os.environ.setdefault("MAINO_API_KEY", "teste")
+os.environ["CACHE_BACKEND"] = "nenhum"
+os.environ["JOBS_EXECUTAR_NA_WEB"] = "false"
+
+from src.main import app as aplicacao
+from src.extensions import db
+
+
+@pytest.fixture
+def app():
+    with aplicacao.app_context():
+        yield aplicacao
+        # Cada teste começa com as tabelas vazias
+        db.session.remove()
+        for tabela in reversed(db.metadata.sorted_tables):
+            db.session.execute(tabela.delete())
+        db.session.commit()
+
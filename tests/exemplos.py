@@ -0,0 +1,31 @@
+"""XMLs de NF-e mínimos para os testes (só as tags que o XMLProcessor lê)."""
+
+NAMESPACE_NFE = "http://www.portalfiscal.inf.br/nfe"
+
+
+def xml_nfe(chave_acesso, numero_nf, cfop, itens, data_emissao="2026-01-10T10:00:00-03:00",
+            cnpj_destinatario="11222333000181", referencias=()):
+    """Monta uma NF-e com `itens` = [(codigo_produto, numero_lote, quantidade)].
+
+    O lote vai em rastro/nLote; `referencias` são as chaves das NFs em NFref.
+    """
+    dets = "".join(
+        f'<det nItem="{numero}"><prod><cProd>{codigo}</cProd><xProd>Produto {codigo}</xProd>'
+        f'<CFOP>{cfop}</CFOP><qCom>{quantidade}</qCom><vUnCom>12.3456789012</vUnCom><vProd>10.00</vProd>'
+        + (f'<rastro><nLote>{lote}</nLote></rastro>' if lote else '') +
+        '</prod></det>'
+        for numero, (codigo, lote, quantidade) in enumerate(itens, start=1)
+    )
+    nfref = "".join(f"<NFref><refNFe>{chave}</refNFe></NFref>" for chave in referencias)
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?><nfeProc xmlns="{NAMESPACE_NFE}"><NFe>'
+        f'<infNFe Id="NFe{chave_acesso}"><ide><nNF>{numero_nf}</nNF><serie>1</serie>'
+        f'<dhEmi>{data_emissao}</dhEmi>{nfref}</ide><emit><CNPJ>99888777000166</CNPJ></emit>'
+        f'<dest><CNPJ>{cnpj_destinatario}</CNPJ><xNome>Cliente Teste</xNome></dest>{dets}'
+        '</infNFe></NFe></nfeProc>'
+    )
+
+
+def chave(numero):
+    # Chave de acesso fictícia de 44 dígitos
+    return str(numero).rjust(44, "0")
@@ -0,0 +1,22 @@
+from src.extensions import db
+from src.models.job import Job
+from src.models.nfe import NotaFiscal, EstoqueConsignacao
+from src.models.user import User
+
+
+def test_modelos_compartilham_engine_e_pool(app):
+    # Todos os modelos usam a instância única de src.extensions: um só engine, um só pool
+    for modelo in (User, NotaFiscal, EstoqueConsignacao, Job):
+        assert modelo.metadata is db.metadata
+        assert db.session.get_bind(mapper=modelo.__mapper__) is db.engine
+
+
+def test_usuario_e_nota_na_mesma_transacao(app):
+    db.session.add(User(username="ana", email="ana@example.com"))
+    db.session.add(NotaFiscal(
+        numero_nf="1", serie="1", chave_acesso="1" * 44, cnpj_destinatario="11222333000181",
+        nome_destinatario="Cliente", cfop="5917", tipo_operacao="SAIDA"
+    ))
+    db.session.commit()
+    assert User.query.count() == 1
+    assert NotaFiscal.query.count() == 1
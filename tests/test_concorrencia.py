@@ -0,0 +1,103 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+from sqlalchemy import func, update
+from src.extensions import db
+from src.models.nfe import EstoqueConsignacao, MovimentoEstoque, NotaFiscal
+from src.services.estoque_service import EstoqueService
+from src.services.xml_processor import XMLProcessor
+from tests.exemplos import chave, xml_nfe
+from tests.test_estoque_service import gravar
+
+PROCESSOS = 6
+RETORNOS_POR_PROCESSO = 5
+
+
+def _postar_retornos(numeros):
+    # Roda em um processo filho ("spawn"): monta a própria app sobre o mesmo banco de arquivo
+    os.environ["DB_INICIALIZAR_NA_IMPORTACAO"] = "false"
+    from src.main import app
+    cliente = app.test_client()
+    status = []
+    for numero in numeros:
+        resposta = cliente.post("/api/estoque/processar-xml", json={"xml_content": xml_nfe(
+            chave(numero), str(numero), "1918", [("P1", "L1", "1.0001")], referencias=[chave(1)]
+        )})
+        status.append(resposta.status_code)
+    return status
+
+
+def test_retornos_concorrentes_contra_a_mesma_saida(app):
+    gravar(EstoqueService(), xml_nfe(chave(1), "1", "5917", [("P1", "L1", "100")]))
+
+    lotes = [
+        range(100 + processo * RETORNOS_POR_PROCESSO, 100 + (processo + 1) * RETORNOS_POR_PROCESSO)
+        for processo in range(PROCESSOS)
+    ]
+    with ProcessPoolExecutor(max_workers=PROCESSOS, mp_context=multiprocessing.get_context("spawn")) as executor:
+        status = [codigo for resultado in executor.map(_postar_retornos, lotes) for codigo in resultado]
+    assert status == [200] * PROCESSOS * RETORNOS_POR_PROCESSO
+
+    db.session.expire_all()
+    estoque = EstoqueConsignacao.query.one()
+    retornado = Decimal("1.0001") * PROCESSOS * RETORNOS_POR_PROCESSO
+    assert estoque.quantidade_retornada_nf == retornado
+    assert estoque.saldo_disponivel_nf == Decimal("100") - retornado
+    assert estoque.versao == PROCESSOS * RETORNOS_POR_PROCESSO
+
+    # O snapshot bate com a soma do razão de movimentos
+    movimentos = dict(db.session.query(MovimentoEstoque.tipo_operacao, func.sum(MovimentoEstoque.quantidade)).filter(
+        MovimentoEstoque.estoque_id == estoque.id
+    ).group_by(MovimentoEstoque.tipo_operacao).all())
+    assert movimentos["SAIDA"] == estoque.quantidade_consignada_nf
+    assert movimentos["ENTRADA_RETORNO"] == estoque.quantidade_retornada_nf
+    assert movimentos["SAIDA"] - movimentos["ENTRADA_RETORNO"] == estoque.saldo_disponivel_nf
+
+
+def _simular_concorrente(monkeypatch, estoque_service, conflitos):
+    # Outro "processo" baixa o registro entre a leitura dos saldos e o UPDATE versionado
+    carregar = estoque_service._carregar_estoques_referenciados
+    chamadas = []
+
+    def carregar_e_alterar(chaves_referenciadas):
+        resultado = carregar(chaves_referenciadas)
+        chamadas.append(1)
+        if len(chamadas) <= conflitos:
+            db.session.execute(update(EstoqueConsignacao).values(versao=EstoqueConsignacao.versao + 1))
+        return resultado
+
+    monkeypatch.setattr(estoque_service, "_carregar_estoques_referenciados", carregar_e_alterar)
+    return chamadas
+
+
+def test_conflito_de_versao_refaz_a_gravacao(app, monkeypatch):
+    estoque_service = EstoqueService()
+    gravar(estoque_service, xml_nfe(chave(1), "1", "5917", [("P1", "L1", "10")]))
+    chamadas = _simular_concorrente(monkeypatch, estoque_service, conflitos=2)
+
+    gravar(estoque_service, xml_nfe(chave(2), "2", "1918", [("P1", "L1", "4")], referencias=[chave(1)]))
+
+    assert len(chamadas) == 3 # Duas tentativas em conflito e a terceira gravada
+    db.session.expire_all()
+    estoque = EstoqueConsignacao.query.one()
+    assert estoque.saldo_disponivel_nf == Decimal("6")
+    assert MovimentoEstoque.query.filter_by(tipo_operacao="ENTRADA_RETORNO").count() == 1
+
+
+def test_conflito_persistente_desiste_sem_gravar(app, monkeypatch):
+    estoque_service = EstoqueService()
+    estoque_service.tentativas_conflito = 3
+    gravar(estoque_service, xml_nfe(chave(1), "1", "5917", [("P1", "L1", "10")]))
+    chamadas = _simular_concorrente(monkeypatch, estoque_service, conflitos=99)
+
+    xml_content = xml_nfe(chave(2), "2", "1918", [("P1", "L1", "4")], referencias=[chave(1)])
+    dados_nfe = XMLProcessor().parse_nfe_xml(xml_content)["dados_nfe"]
+    dados_nfe["xml_content"] = xml_content
+    resultado = estoque_service.processar_nfe(dados_nfe, "ENTRADA_RETORNO")
+
+    assert not resultado["sucesso"]
+    assert "alterado por outro processo" in resultado["erro"]
+    assert len(chamadas) == 3
+    assert NotaFiscal.query.count() == 1
+    assert EstoqueConsignacao.query.one().saldo_disponivel_nf == Decimal("10")
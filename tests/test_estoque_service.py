@@ -0,0 +1,336 @@
+from datetime import date
+from decimal import Decimal
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from src import metricas
+from src.database.migrations import MIGRACOES, MigracoesPendentes, aplicar_migracoes, verificar_migracoes
+from src.extensions import db
+from src.models.nfe import EstoqueConsignacao, MovimentoEstoque, XmlNotaFiscal
+from src.models.resumo import ResumoEstoque, ResumoProduto
+from src.services.estoque_service import EstoqueService
+from src.services.xml_processor import XMLProcessor
+from tests.exemplos import chave, xml_nfe
+
+
+def gravar(estoque_service, xml_content):
+    resultado_xml = XMLProcessor().parse_nfe_xml(xml_content)
+    resultado_xml["dados_nfe"]["xml_content"] = xml_content
+    resultado = estoque_service.processar_nfe(resultado_xml["dados_nfe"], resultado_xml["tipo_operacao"])
+    assert resultado["sucesso"], resultado
+    return resultado
+
+
+def gravar_movimentacao(estoque_service):
+    # Remessa de 10 + 4 (dois lotes), retorno de 3 e venda de 1.5 do lote L1
+    gravar(estoque_service, xml_nfe(chave(1), "1", "5917", [("P1", "L1", "10"), ("P1", "L2", "4")],
+                                    data_emissao="2026-01-05T10:00:00-03:00"))
+    gravar(estoque_service, xml_nfe(chave(2), "2", "1918", [("P1", "L1", "3")], referencias=[chave(1)],
+                                    data_emissao="2026-01-10T10:00:00-03:00"))
+    gravar(estoque_service, xml_nfe(chave(3), "3", "5114", [("P1", "L1", "1.5")], referencias=[chave(1)],
+                                    data_emissao="2026-01-20T10:00:00-03:00"))
+
+
+def test_baixas_geram_movimentos_e_saldo(app):
+    estoque_service = EstoqueService()
+    gravar_movimentacao(estoque_service)
+
+    lote_1 = EstoqueConsignacao.query.filter_by(numero_lote="L1").one()
+    assert lote_1.quantidade_retornada_nf == Decimal("3")
+    assert lote_1.quantidade_faturada_nf == Decimal("1.5")
+    assert lote_1.saldo_disponivel_nf == Decimal("5.5")
+    assert MovimentoEstoque.query.filter_by(estoque_id=lote_1.id).count() == 3
+
+
+def test_reconstruir_saldos_a_partir_dos_movimentos(app):
+    estoque_service = EstoqueService()
+    gravar_movimentacao(estoque_service)
+
+    # Corrompe o snapshot e o resumo: o razão de movimentos é a fonte da verdade
+    db.session.query(EstoqueConsignacao).update({
+        EstoqueConsignacao.quantidade_retornada_nf: 0,
+        EstoqueConsignacao.quantidade_faturada_nf: 0,
+        EstoqueConsignacao.saldo_disponivel_nf: 999,
+    }, synchronize_session=False)
+    db.session.query(ResumoProduto).update({ResumoProduto.saldo_disponivel: 0}, synchronize_session=False)
+    db.session.commit()
+
+    resultado = estoque_service.reconstruir_saldos()
+    assert resultado == {"sucesso": True, "registros_atualizados": 2}
+
+    db.session.expire_all()
+    saldos = {e.numero_lote: e for e in EstoqueConsignacao.query}
+    assert saldos["L1"].quantidade_consignada_nf == Decimal("10")
+    assert saldos["L1"].quantidade_retornada_nf == Decimal("3")
+    assert saldos["L1"].quantidade_faturada_nf == Decimal("1.5")
+    assert saldos["L1"].saldo_disponivel_nf == Decimal("5.5")
+    assert saldos["L2"].saldo_disponivel_nf == Decimal("4")
+    assert db.session.get(ResumoProduto, "P1").saldo_disponivel == Decimal("9.5")
+    assert estoque_service.get_resumo_estoque()["saldo_total_disponivel"] == Decimal("9.5")
+
+
+def test_saldos_em_data_anterior(app):
+    estoque_service = EstoqueService()
+    gravar_movimentacao(estoque_service)
+
+    # Antes da venda: só o retorno foi baixado
+    saldos = {s["numero_lote"]: s["saldo_disponivel"] for s in estoque_service.get_saldos_em(date(2026, 1, 15))}
+    assert saldos == {"L1": Decimal("7"), "L2": Decimal("4")}
+
+
+def test_saldos_em_streaming_com_etag(app):
+    gravar_movimentacao(EstoqueService())
+    cliente = app.test_client()
+
+    resposta = cliente.get("/api/estoque/saldo-produto/P1")
+    assert resposta.is_streamed
+    assert [saldo["numero_lote"] for saldo in resposta.get_json()["saldos"]] == ["L1", "L2"]
+    assert resposta.get_json()["saldos"][0]["saldo_disponivel_nf_exato"] == "5.5000"
+
+    etag = resposta.headers["ETag"]
+    assert cliente.get("/api/estoque/saldo-produto/P1", headers={"If-None-Match": etag}).status_code == 304
+
+
+def test_aging_em_data_anterior(app):
+    estoque_service = EstoqueService()
+    gravar_movimentacao(estoque_service)
+    gravar(estoque_service, xml_nfe(chave(4), "4", "5917", [("P1", "L3", "2")], data_emissao="2026-02-10T10:00:00-03:00"))
+
+    def faixas(data_referencia):
+        linha, = estoque_service.get_aging(agrupar="produto", data_referencia=data_referencia)["linhas"]
+        assert sum(linha["faixas"].values()) == linha["saldo_total"]
+        return linha["saldo_total"], {nome: valor for nome, valor in linha["faixas"].items() if valor}
+
+    # Antes da venda e da remessa de fevereiro: 7 de L1 e 4 de L2, com 10 dias
+    assert faixas(date(2026, 1, 15)) == (Decimal("11"), {"0_30": Decimal("11")})
+    # Depois de tudo: as NFs de janeiro na faixa 31-60 e a de fevereiro na 0-30
+    assert faixas(date(2026, 3, 1)) == (Decimal("11.5"), {"31_60": Decimal("9.5"), "0_30": Decimal("2")})
+    # Antes da primeira remessa não há saldo
+    assert estoque_service.get_aging(agrupar="produto", data_referencia=date(2026, 1, 1))["linhas"] == []
+
+
+def consultas_ao_gravar(estoque_service, itens):
+    # Consultas SQL para gravar uma remessa com `itens` linhas e depois o retorno de todas elas
+    numero = len(itens)
+    gravar(estoque_service, xml_nfe(chave(numero), str(numero), "5917", itens))
+    token = metricas.definir_endpoint(f"teste_retorno_{numero}")
+    try:
+        gravar(estoque_service, xml_nfe(chave(numero + 1000), str(numero + 1000), "1918",
+                                        [(codigo, lote, "1") for codigo, lote, _ in itens], referencias=[chave(numero)]))
+        return metricas.contagem("consignacoes_sql_segundos")
+    finally:
+        metricas.restaurar_endpoint(token)
+
+
+def test_consultas_do_retorno_nao_crescem_com_os_itens(app):
+    # A NF de saída e os registros de estoque referenciados são carregados de uma vez por documento
+    estoque_service = EstoqueService()
+    poucos = consultas_ao_gravar(estoque_service, [(f"A{item}", "L1", "5") for item in range(5)])
+    muitos = consultas_ao_gravar(estoque_service, [(f"B{item}", "L1", "5") for item in range(200)])
+    # No SQLite o INSERT dos itens com RETURNING na ordem dos parâmetros vira um comando por linha
+    # (o dialeto não tem sentinela); no PostgreSQL é um único comando
+    extras = 200 - 5 if db.engine.dialect.name == "sqlite" else 0
+    assert 0 < muitos <= poucos + extras
+
+
+def test_validar_faturamento_soma_linhas_repetidas(app):
+    estoque_service = EstoqueService()
+    gravar_movimentacao(estoque_service)
+    # Segunda remessa de L1, mais nova, e um produto sem lote
+    gravar(estoque_service, xml_nfe(chave(4), "4", "5917", [("P1", "L1", "2"), ("P2", None, "1")],
+                                    data_emissao="2026-02-01T10:00:00-03:00"))
+    itens = [
+        {"codigo_produto": "P1", "numero_lote": "L1", "quantidade": 3},
+        {"codigo_produto": "P1", "numero_lote": "L1", "quantidade": "4"},
+        {"codigo_produto": "P1", "numero_lote": "L2", "quantidade": 5},
+        {"codigo_produto": "P2", "quantidade": 1},
+    ]
+
+    resultado = estoque_service.validar_disponibilidade_faturamento("11222333000181", itens)
+    assert not resultado["sucesso"]
+    assert [(item["codigo_produto"], item["numero_lote"], item["quantidade_solicitada"], item["saldo_disponivel"], item["suficiente"])
+            for item in resultado["itens"]] == [
+        ("P1", "L1", Decimal("7"), Decimal("7.5"), True),
+        ("P1", "L2", Decimal("5"), Decimal("4"), False),
+        ("P2", None, Decimal("1"), Decimal("1"), True),
+    ]
+    assert "alocacoes" not in resultado["itens"][0]
+
+    alocado = estoque_service.validar_disponibilidade_faturamento("11222333000181", itens, alocar=True)
+    assert [item["saldo_disponivel"] for item in alocado["itens"]] == [item["saldo_disponivel"] for item in resultado["itens"]]
+    # FIFO: a NF 1 (janeiro) inteira antes da NF 4 (fevereiro)
+    assert [(alocacao["nf_saida_numero"], alocacao["quantidade"]) for alocacao in alocado["itens"][0]["alocacoes"]] == [
+        ("1", Decimal("5.5")), ("4", Decimal("1.5"))
+    ]
+
+
+def test_rota_validar_faturamento_interpreta_entrada(app):
+    gravar_movimentacao(EstoqueService())
+    cliente = app.test_client()
+    corpo = {"cnpj_destinatario": "11222333000181", "itens": [{"codigo_produto": "P1", "numero_lote": "L1", "quantidade": 1}]}
+
+    resposta = cliente.post("/api/estoque/validar-faturamento", json=dict(corpo, alocar="false"))
+    assert resposta.status_code == 200
+    assert "alocacoes" not in resposta.get_json()["itens"][0]
+    resposta = cliente.post("/api/estoque/validar-faturamento", json=dict(corpo, alocar="true"))
+    assert resposta.get_json()["itens"][0]["alocacoes"][0]["quantidade_exato"] == "1"
+
+    assert cliente.post("/api/estoque/validar-faturamento", json=dict(corpo, alocar="talvez")).status_code == 400
+    for quantidade in ("abc", None, -1, "NaN"):
+        invalido = dict(corpo, itens=[{"codigo_produto": "P1", "numero_lote": "L1", "quantidade": quantidade}])
+        resposta = cliente.post("/api/estoque/validar-faturamento", json=invalido)
+        assert resposta.status_code == 400, quantidade
+        assert not resposta.get_json()["sucesso"]
+
+
+def test_saldos_paginados_e_filtrados(app):
+    estoque_service = EstoqueService()
+    gravar_movimentacao(estoque_service)
+    gravar(estoque_service, xml_nfe(chave(4), "4", "5917", [("P1", "L3", "2")], data_emissao="2026-02-10T10:00:00-03:00"))
+    cliente = app.test_client()
+
+    def lotes(url):
+        dados = cliente.get(url).get_json()
+        return [saldo["numero_lote"] for saldo in dados["saldos"]], dados["proximo_cursor"]
+
+    # Paginação por cursor: cada página devolve o id a passar em apos_id
+    pagina, cursor = lotes("/api/estoque/saldo-produto/P1?limite=2")
+    assert pagina == ["L1", "L2"] and cursor is not None
+    assert lotes(f"/api/estoque/saldo-produto/P1?limite=2&apos_id={cursor}") == (["L3"], None)
+
+    assert lotes("/api/estoque/saldo-destinatario/11222333000181?lote=L2") == (["L2"], None)
+    assert lotes("/api/estoque/saldo-produto/P1?data_inicio=2026-02-01") == (["L3"], None)
+    assert lotes("/api/estoque/saldo-produto/P1?data_fim=2026-01-05") == (["L1", "L2"], None)
+
+    # Sem saldo: L2 inteiro retornado
+    gravar(estoque_service, xml_nfe(chave(5), "5", "1918", [("P1", "L2", "4")], referencias=[chave(1)]))
+    assert lotes("/api/estoque/saldo-produto/P1?apenas_com_saldo=true") == (["L1", "L3"], None)
+
+    assert cliente.get("/api/estoque/saldo-produto/P1?limite=0").status_code == 400
+
+
+def test_aging_atual_por_faixa(app):
+    estoque_service = EstoqueService()
+    gravar_movimentacao(estoque_service)
+    hoje = date.today()
+    gravar(estoque_service, xml_nfe(chave(4), "4", "5917", [("P2", "L9", "3")], data_emissao=f"{hoje.isoformat()}T08:00:00-03:00"))
+
+    linhas = {linha["codigo_produto"]: linha for linha in estoque_service.get_aging(agrupar="produto")["linhas"]}
+    assert linhas["P2"]["faixas"]["0_30"] == Decimal("3")
+    assert linhas["P1"]["saldo_total"] == Decimal("9.5")
+    assert sum(linhas["P1"]["faixas"].values()) == Decimal("9.5")
+
+    assert app.test_client().get("/api/estoque/aging?agrupar=cor").status_code == 400
+
+
+def criar_banco_inicial(caminho):
+    # Esquema da primeira versão: quantidades em FLOAT, XML na própria nota e sem schema_migracoes
+    engine = create_engine(f"sqlite:///{caminho}")
+    with engine.begin() as conn:
+        for comando in (
+            "CREATE TABLE notas_fiscais (id INTEGER PRIMARY KEY, numero_nf VARCHAR(20) NOT NULL, serie VARCHAR(5), "
+            "chave_acesso VARCHAR(44) NOT NULL UNIQUE, cnpj_destinatario VARCHAR(14) NOT NULL, nome_destinatario VARCHAR(255) NOT NULL, "
+            "cfop VARCHAR(4) NOT NULL, tipo_operacao VARCHAR(50) NOT NULL, data_emissao DATETIME, xml_content TEXT)",
+            "CREATE TABLE itens_nota_fiscal (id INTEGER PRIMARY KEY, nota_fiscal_id INTEGER NOT NULL REFERENCES notas_fiscais(id), "
+            "codigo_produto VARCHAR(50) NOT NULL, descricao_produto VARCHAR(255) NOT NULL, numero_lote VARCHAR(50), "
+            "quantidade FLOAT NOT NULL, valor_unitario FLOAT, valor_total FLOAT)",
+            "CREATE TABLE estoque_consignacao (id INTEGER PRIMARY KEY, codigo_produto VARCHAR(50) NOT NULL, "
+            "descricao_produto VARCHAR(255) NOT NULL, numero_lote VARCHAR(50), cnpj_destinatario VARCHAR(14) NOT NULL, "
+            "nome_destinatario VARCHAR(255) NOT NULL, quantidade_consignada_nf FLOAT, quantidade_retornada_nf FLOAT, "
+            "quantidade_faturada_nf FLOAT, saldo_disponivel_nf FLOAT, nf_saida_id INTEGER NOT NULL REFERENCES notas_fiscais(id))",
+            "INSERT INTO notas_fiscais VALUES (1, '1', '1', 'K1', '11222333000181', 'Cliente', '5917', 'SAIDA', "
+            "'2026-01-05 10:00:00', '<nfeProc>xml original</nfeProc>')",
+            "INSERT INTO itens_nota_fiscal VALUES (1, 1, 'P1', 'Produto', 'L1', 10.5, 12.3456789012, 129.63)",
+            "INSERT INTO estoque_consignacao VALUES (1, 'P1', 'Produto', 'L1', '11222333000181', 'Cliente', 10.5, 0.25, 1.1, 9.15, 1)",
+        ):
+            conn.execute(text(comando))
+    return engine
+
+
+def test_migracoes_em_banco_da_versao_inicial(tmp_path):
+    engine = criar_banco_inicial(tmp_path / "inicial.db")
+    aplicar_migracoes(engine, criar_tabelas=True)
+
+    with engine.connect() as conn:
+        assert [versao for (versao,) in conn.execute(text("SELECT versao FROM schema_migracoes ORDER BY versao"))] == [
+            versao for versao, _, _ in MIGRACOES
+        ]
+        # XML comprimido na tabela lateral e a coluna antiga removida
+        assert "xml_content" not in {coluna["name"] for coluna in inspect(conn).get_columns("notas_fiscais")}
+        compressao, conteudo = conn.execute(text("SELECT compressao, conteudo FROM xml_notas_fiscais")).one()
+        assert XmlNotaFiscal(compressao=compressao, conteudo=conteudo).texto() == "<nfeProc>xml original</nfeProc>"
+        # Quantidades como inteiros escalados (tipo INTEGER de fato, não REAL)
+        assert conn.execute(text(
+            "SELECT quantidade, typeof(quantidade), valor_unitario, valor_total FROM itens_nota_fiscal"
+        )).one() == (105000, "integer", 123456789012, 12963)
+        assert conn.execute(text(
+            "SELECT quantidade_consignada_nf, quantidade_retornada_nf, quantidade_faturada_nf, saldo_disponivel_nf, versao "
+            "FROM estoque_consignacao"
+        )).one() == (105000, 2500, 11000, 91500, 0)
+        # Movimentos iniciais: a remessa e um ajuste por tipo de baixa já existente
+        assert sorted(conn.execute(text("SELECT tipo_operacao, quantidade FROM movimentos_estoque"))) == [
+            ("ENTRADA_RETORNO", 2500), ("ENTRADA_VENDA", 11000), ("SAIDA", 105000)
+        ]
+        # Resumo criado pela migração a partir do estoque existente
+        assert conn.execute(text(
+            "SELECT total_produtos, saldo_total_disponivel, produtos_saldo_baixo FROM resumo_estoque WHERE id = 1"
+        )).one() == (1, 91500, 1)
+
+    # Rodar de novo não faz nada
+    aplicar_migracoes(engine, criar_tabelas=True)
+    engine.dispose()
+
+
+def test_resumo_so_le_e_usa_o_limite_gravado(app):
+    estoque_service = EstoqueService()
+    # Sem a linha do resumo a leitura devolve zeros e não grava nada
+    assert estoque_service.get_resumo_estoque()["total_produtos"] == 0
+    assert db.session.get(ResumoEstoque, 1) is None
+
+    gravar_movimentacao(estoque_service)
+    resumo = estoque_service.get_resumo_estoque()
+    assert (resumo["produtos_saldo_baixo"], resumo["limite_saldo_baixo"]) == (2, Decimal("10"))
+
+    # Outro processo com outro ESTOQUE_LIMITE_SALDO_BAIXO segue o limite gravado, sem reconstruir
+    outro_processo = EstoqueService()
+    outro_processo.resumo_service.limite_padrao = Decimal("5")
+    gravar(outro_processo, xml_nfe(chave(4), "4", "5917", [("P2", "L1", "7")]))
+    assert outro_processo.get_resumo_estoque()["produtos_saldo_baixo"] == 3
+
+    # O limite só muda pela reconstrução
+    estoque_service.reconstruir_saldos(limite_saldo_baixo="5")
+    resumo = estoque_service.get_resumo_estoque()
+    assert (resumo["produtos_saldo_baixo"], resumo["limite_saldo_baixo"]) == (1, Decimal("5"))
+
+
+def test_valores_exatos_no_resumo_e_no_aging(app):
+    gravar_movimentacao(EstoqueService())
+    cliente = app.test_client()
+
+    assert cliente.get("/api/estoque/resumo").get_json()["saldo_total_disponivel_exato"] == "9.5000"
+    produto, = cliente.get("/api/estoque/resumo/produtos").get_json()["produtos"]
+    assert produto["saldo_disponivel_exato"] == "9.5000"
+    destinatario, = cliente.get("/api/estoque/resumo/destinatarios").get_json()["destinatarios"]
+    assert destinatario["saldo_disponivel_exato"] == "9.5000"
+    linha, = cliente.get("/api/estoque/aging?data_referencia=2026-01-25").get_json()["linhas"]
+    assert (linha["saldo_total_exato"], linha["faixas"]["0_30_exato"]) == ("9.5000", "9.5000")
+
+
+def test_subida_so_confere_a_versao_do_esquema(tmp_path):
+    # Banco existente e desatualizado: a subida recusa, sem converter nada
+    engine = criar_banco_inicial(tmp_path / "inicial.db")
+    with pytest.raises(MigracoesPendentes):
+        verificar_migracoes(engine)
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT typeof(quantidade) FROM itens_nota_fiscal")).scalar() == "real"
+    # Depois do comando de release a subida passa
+    aplicar_migracoes(engine, criar_tabelas=True)
+    verificar_migracoes(engine)
+    engine.dispose()
+
+    # Banco novo: tabelas criadas e todos os passos registrados na própria subida
+    novo = create_engine(f"sqlite:///{tmp_path / 'novo.db'}")
+    verificar_migracoes(novo)
+    with novo.connect() as conn:
+        assert conn.execute(text("SELECT COUNT(*) FROM schema_migracoes")).scalar() == len(MIGRACOES)
+    verificar_migracoes(novo)
+    novo.dispose()
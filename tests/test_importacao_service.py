@@ -0,0 +1,43 @@
+import pytest
+from decimal import Decimal
+from src.models.job import ArquivoImportacao
+from src.models.nfe import EstoqueConsignacao
+from src.services.estoque_service import EstoqueService
+from src.services.importacao_service import ImportacaoService
+from src.services.xml_processor import XMLProcessor
+from tests.exemplos import chave, xml_nfe
+
+
+@pytest.fixture
+def importacao(app):
+    estoque_service = EstoqueService()
+    estoque_service.tamanho_chunk = 2 # Vários chunks mesmo com poucos XMLs
+    return ImportacaoService(XMLProcessor(), estoque_service)
+
+
+def test_entrada_antes_da_saida_em_chunks_diferentes(importacao):
+    xmls = [
+        xml_nfe(chave(10), "10", "1918", [("P1", "L1", "2")], referencias=[chave(1)]), # Retorno antes da remessa
+        "<nao-e-xml",
+        xml_nfe(chave(2), "2", "5917", [("P2", "L1", "5")]),
+        xml_nfe(chave(3), "3", "5917", [("P3", "L1", "5")]),
+        xml_nfe(chave(1), "1", "5917", [("P1", "L1", "10")]),
+    ]
+    resultado = importacao.importar(xmls=xmls, workers=1)
+
+    assert [r["indice"] for r in resultado["resultados"]] == [0, 1, 2, 3, 4]
+    assert [r["sucesso"] for r in resultado["resultados"]] == [True, False, True, True, True]
+    assert resultado["nfes_processadas"] == 4
+    assert EstoqueConsignacao.query.filter_by(codigo_produto="P1").one().saldo_disponivel_nf == Decimal("8")
+
+
+def test_arquivo_removido_mesmo_com_falha(importacao, monkeypatch):
+    arquivo_id = importacao.guardar_arquivo("lote.zip", b"PK\x05\x06" + b"\x00" * 18) # ZIP vazio
+
+    def falhar(*args):
+        raise RuntimeError("falha simulada")
+
+    monkeypatch.setattr(importacao, "_importar", falhar)
+    with pytest.raises(RuntimeError):
+        importacao.importar(arquivo_id=arquivo_id)
+    assert ArquivoImportacao.query.count() == 0
@@ -0,0 +1,27 @@
+import json
+import time
+from datetime import datetime, timedelta
+from src.extensions import db
+from src.models.job import Job
+from src.services.job_service import JobService
+
+
+def test_heartbeat_durante_etapa_longa(app):
+    # Uma etapa sem eventos de progresso maior que o timeout de órfão não devolve o job à fila
+    job_service = JobService()
+    job_service.timeout_orfao = timedelta(seconds=0.3)
+    job_service.intervalo_heartbeat = 0.05
+
+    def etapa_longa(parametros, progresso):
+        time.sleep(0.6)
+        atualizado_em = db.session.query(Job.atualizado_em).filter(Job.id == job.id).scalar()
+        return {"sucesso": True, "atraso": (datetime.utcnow() - atualizado_em).total_seconds()}
+
+    job_service.registrar("ETAPA_LONGA", etapa_longa)
+    job = job_service.enfileirar("ETAPA_LONGA")
+    job_service.executar(app, job.id)
+
+    db.session.expire_all()
+    job = db.session.get(Job, job.id)
+    assert job.status == "CONCLUIDO", job.resultado
+    assert json.loads(job.resultado)["atraso"] < job_service.timeout_orfao.total_seconds()
@@ -0,0 +1,106 @@
+from datetime import datetime, timedelta
+import pytest
+from src.models.nfe import NotaFiscal
+from src.models.sincronizacao import FalhaSincronizacao, SincronizacaoMaino
+from src.services.estoque_service import EstoqueService
+from src.services.sincronizacao_service import SincronizacaoService
+from src.services.xml_processor import XMLProcessor
+from tests.exemplos import chave, xml_nfe
+
+HOJE = datetime.now().replace(microsecond=0)
+
+
+def emissao(dias_atras):
+    return HOJE - timedelta(days=dias_atras)
+
+
+def nfe(numero, cfop, dias_atras, referencias=()):
+    return xml_nfe(chave(numero), str(numero), cfop, [("P1", "L1", "1")],
+                   data_emissao=emissao(dias_atras).isoformat(), referencias=referencias)
+
+
+class MainoFalso:
+    """Listagem e download em memória; registra a página inicial pedida a cada listagem."""
+
+    def __init__(self, xmls, ultima_pagina=3, falhas_download=()):
+        self.xmls = xmls # chave -> XML, na ordem da listagem
+        self.ultima_pagina = ultima_pagina
+        self.falhas_download = set(falhas_download)
+        self.paginas_iniciais = []
+
+    def get_nfes_emitidas(self, data_inicio, data_fim, pagina_inicial=1):
+        self.paginas_iniciais.append(pagina_inicial)
+        return {"sucesso": True, "nfes": [{"chaveAcesso": c} for c in self.xmls], "ultima_pagina": self.ultima_pagina}
+
+    def get_nfe_xml_by_chave(self, chave_acesso):
+        if chave_acesso in self.falhas_download:
+            return {"sucesso": False, "erro": "timeout"}
+        return {"sucesso": True, "xml_content": self.xmls[chave_acesso]}
+
+
+@pytest.fixture
+def estoque_service(app):
+    estoque_service = EstoqueService()
+    estoque_service.tamanho_chunk = 1 # Cada NF-e em um chunk: força a retenção das entradas
+    return estoque_service
+
+
+def sincronizar(maino, estoque_service, max_tentativas=5):
+    servico = SincronizacaoService(maino, XMLProcessor(), estoque_service, concorrencia=1)
+    servico.max_tentativas = max_tentativas
+    return servico.executar(30)
+
+
+def test_retorno_baixado_antes_da_remessa(estoque_service):
+    maino = MainoFalso({
+        chave(2): nfe(2, "1918", 1, referencias=[chave(1)]),
+        chave(1): nfe(1, "5917", 3),
+    })
+    resultado = sincronizar(maino, estoque_service)
+
+    assert resultado["nfes_processadas"] == 2
+    assert resultado["erros"] == []
+    estado = SincronizacaoMaino.query.one()
+    assert estado.ultima_data_emissao == emissao(1)
+    assert estado.ultima_pagina == 3
+
+
+def test_retomada_da_paginacao_na_mesma_janela(estoque_service):
+    maino = MainoFalso({chave(1): nfe(1, "5917", 3)}, ultima_pagina=7)
+    for _ in range(3):
+        sincronizar(maino, estoque_service)
+    # A segunda execução já começa na marca d'água; a terceira, na mesma janela, retoma da última página lida
+    assert maino.paginas_iniciais == [1, 1, 7]
+
+
+def test_falha_de_gravacao_segura_a_marca_ate_o_limite(estoque_service):
+    maino = MainoFalso({
+        chave(1): nfe(1, "5917", 5),
+        chave(2): nfe(2, "1918", 4, referencias=[chave(99)]), # NF de saída inexistente
+        chave(3): nfe(3, "5917", 2),
+    })
+    resultado = sincronizar(maino, estoque_service, max_tentativas=2)
+    estado = SincronizacaoMaino.query.one()
+    assert resultado["nfes_com_falha"] == 1
+    assert estado.ultima_data_emissao == emissao(4)
+    assert estado.ultima_pagina == 1
+    assert FalhaSincronizacao.query.one().tentativas == 1
+
+    resultado = sincronizar(maino, estoque_service, max_tentativas=2)
+    assert resultado["nfes_abandonadas"] == [chave(2)]
+    assert SincronizacaoMaino.query.one().ultima_data_emissao == emissao(2)
+    assert FalhaSincronizacao.query.one().tentativas == 2
+
+
+def test_falha_resolvida_sai_da_tabela(estoque_service):
+    maino = MainoFalso({chave(1): nfe(1, "5917", 5), chave(2): nfe(2, "5917", 3)}, falhas_download=[chave(2)])
+    sincronizar(maino, estoque_service)
+    # Sem a data da NF-e que não foi baixada, a marca d'água não avança
+    assert SincronizacaoMaino.query.one().ultima_data_emissao is None
+    assert FalhaSincronizacao.query.count() == 1
+
+    maino.falhas_download.clear()
+    sincronizar(maino, estoque_service)
+    assert FalhaSincronizacao.query.count() == 0
+    assert NotaFiscal.query.count() == 2
+    assert SincronizacaoMaino.query.one().ultima_data_emissao == emissao(3)
@@ -0,0 +1,60 @@
+import io
+import zipfile
+import pytest
+from src.services.xml_processor import XMLProcessor
+from tests.exemplos import chave, xml_nfe
+
+
+@pytest.fixture
+def processor():
+    return XMLProcessor()
+
+
+@pytest.mark.parametrize("xml_content", [
+    xml_nfe(chave(1), "10", "5917", [("P1", "L1", "10.5000"), ("P2", None, "3")]),
+    xml_nfe(chave(2), "11", "1918", [("P1", "L1", "0.0001")], referencias=[chave(1), chave(3)]),
+    xml_nfe(chave(4), "12", "5114", [("P3", "L9", "7")], data_emissao="2026-02-28T23:59:59-03:00"),
+])
+def test_parse_streaming_igual_ao_da_arvore(processor, xml_content):
+    por_arvore = processor.parse_nfe_xml(xml_content, streaming=False)
+    em_streaming = processor.parse_nfe_xml(xml_content, streaming=True)
+    assert por_arvore["sucesso"]
+    assert em_streaming == por_arvore
+
+
+def test_parse_streaming_de_arquivo_e_bytes(processor):
+    xml_content = xml_nfe(chave(1), "10", "5917", [("P1", "L1", "2.5")])
+    esperado = processor.parse_nfe_xml(xml_content, streaming=False)
+    assert processor.parse_nfe_xml(xml_content.encode("utf-8")) == esperado
+    assert processor.parse_nfe_stream(io.BytesIO(xml_content.encode("utf-8"))) == esperado
+
+
+def test_parse_em_lote_preserva_ordem(processor):
+    xmls = [xml_nfe(chave(numero), str(numero), "5917", [("P1", "L1", "1")]) for numero in range(1, 8)]
+    chunks = list(processor.parse_em_lote(xmls, workers=1, tamanho_chunk=3))
+    assert [len(chunk) for chunk in chunks] == [3, 3, 1]
+    assert [resultado["dados_nfe"]["numero_nf"] for chunk in chunks for resultado in chunk] == [str(n) for n in range(1, 8)]
+
+
+def test_parse_em_lote_isola_membros_ilegiveis_do_zip(processor, tmp_path):
+    latin1 = xml_nfe(chave(1), "1", "5917", [("P1", "L1", "1")]).replace(
+        'encoding="UTF-8"', 'encoding="ISO-8859-1"').replace("Cliente Teste", "Distribuição")
+    caminho = tmp_path / "lote.zip"
+    with zipfile.ZipFile(caminho, "w", compression=zipfile.ZIP_STORED) as arquivo:
+        arquivo.writestr("latin1.xml", latin1.encode("iso-8859-1"))
+        arquivo.writestr("corrompido.xml", xml_nfe(chave(2), "2", "5917", [("P1", "L1", "1")]))
+        arquivo.writestr("ok.xml", xml_nfe(chave(3), "3", "5917", [("P1", "L1", "1")]))
+    # Troca bytes do conteúdo do segundo membro: a leitura falha no CRC
+    bruto = bytearray(caminho.read_bytes())
+    posicao = bruto.index(b"<nNF>2</nNF>")
+    bruto[posicao + 5] = ord("9")
+    caminho.write_bytes(bytes(bruto))
+
+    resultados = [r for chunk in processor.parse_em_lote(processor.membros_zip(str(caminho)), workers=1) for r in chunk]
+
+    assert resultados[0]["sucesso"]
+    assert resultados[0]["dados_nfe"]["nome_destinatario"] == "Distribuição"
+    assert 'encoding="UTF-8"' in resultados[0]["xml_content"]
+    assert not resultados[1]["sucesso"]
+    assert "Erro ao ler XML" in resultados[1]["erro"]
+    assert resultados[2]["sucesso"]